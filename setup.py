@@ -14,12 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+
 from setuptools import setup, find_packages
 
 from swift_lfs import __version__ as version
 
 
 name = 'swift_lfs'
+requires = ['swift(>=1.4.7)']
+if sys.version_info < (2, 7):
+    requires.append('ordereddict')
 
 
 setup(
@@ -39,10 +44,14 @@ setup(
         'Programming Language :: Python :: 2.6',
         'Environment :: No Input/Output (Daemon)',
         ],
-    requires=['swift(>=1.4.7)'],
+    requires=requires,
     entry_points={
         'paste.filter_factory': [
             'swift_lfs=swift_lfs.lfs:filter_factory',
             ],
+        'swift_lfs.fs': [
+            'xfs=swift_lfs.fs.xfs:LFSXFS',
+            'zfs=swift_lfs.fs.zfs:LFSZFS',
+            ],
         },
 )
@@ -18,3 +18,7 @@ from swift.common.exceptions import SwiftException
 
 class LFSException(SwiftException):
     pass
+
+
+class LFSTimeout(LFSException):
+    pass
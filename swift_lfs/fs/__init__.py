@@ -14,13 +14,97 @@
 # limitations under the License.
 
 import os
+import errno
+import random
+from shutil import rmtree
+from uuid import uuid4
+from hashlib import md5
+from inspect import getargspec
+from collections import defaultdict, deque
 
 import eventlet
+from eventlet import tpool, Timeout
+from eventlet.event import Event
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
-from swift.common.utils import readconf, mkdirs, whataremyips
+from swift.common.utils import readconf, mkdirs, whataremyips, TRUE_VALUES
 from swift.common.exceptions import SwiftConfigurationError
 
-from swift_lfs.exceptions import LFSException
+from swift_lfs.exceptions import LFSException, LFSTimeout
+from swift_lfs.packstore import PackStore, DEFAULT_SEGMENT_SIZE
+from swift_lfs.shmstatus import SharedStatus
+from swift_lfs.tmpfile import TmpFilePool, cleanup_orphans
+from swift_lfs.utils import LRUCache, OrderedDict, list_from_csv
+
+
+# {<fs name>: <LFS class>}, resolved once per process
+_backends = {}
+# {(<config path>, <section>): (<config mtime>, <section conf>)}
+_backend_confs = {}
+
+
+def register_backend(fs, cls):
+    """
+    Registers LFS class for fs, overrides built-in and entry point lookup.
+
+    :param fs: fs name as used in fs config option
+    :param cls: LFS subclass
+    """
+    _backends[fs] = cls
+
+
+def _load_entry_point(fs):
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+    for entry_point in pkg_resources.iter_entry_points('swift_lfs.fs', fs):
+        return entry_point.load()
+    return None
+
+
+def load_backend(fs):
+    """
+    Resolves LFS class for fs. Built-in swift_lfs.fs.<fs> modules are tried
+    first, then the swift_lfs.fs entry point group.
+
+    :param fs: fs name
+    :returns: LFS subclass
+    :raises ImportError: if there is no backend for fs
+    """
+    cls = _backends.get(fs)
+    if cls is not None:
+        return cls
+    try:
+        cls_name = 'LFS%s' % fs.upper()
+        module = __import__('swift_lfs.fs.%s' % fs, fromlist=[cls_name])
+        cls = getattr(module, cls_name)
+    except ImportError, e:
+        cls = _load_entry_point(fs)
+        if cls is None:
+            raise e
+    _backends[fs] = cls
+    return cls
+
+
+def get_backend_conf(conf_path, section):
+    """
+    Returns section of config file, parsed once per file modification.
+
+    :param conf_path: path to config file
+    :param section: section name
+    :returns: dict with section options
+    """
+    mtime = os.path.getmtime(conf_path)
+    cached = _backend_confs.get((conf_path, section))
+    if cached and cached[0] == mtime:
+        return cached[1]
+    section_conf = readconf(conf_path, section)
+    _backend_confs[(conf_path, section)] = (mtime, section_conf)
+    return section_conf
 
 
 def get_lfs(conf, ring, datadir, default_port, logger):
@@ -37,12 +121,9 @@ def get_lfs(conf, ring, datadir, default_port, logger):
     """
     fs = conf.get('fs', 'xfs')
     try:
-        module_name = 'swift_lfs.fs.%s' % fs
-        cls_name = 'LFS%s' % fs.upper()
-        module = __import__(module_name, fromlist=[cls_name])
-        cls = getattr(module, cls_name)
+        cls = load_backend(fs)
         if '__file__' in conf and fs in conf:
-            fs_conf = readconf(conf['__file__'], fs)
+            fs_conf = get_backend_conf(conf['__file__'], fs)
             conf = dict(conf, **fs_conf)
         return cls(conf, ring, datadir, default_port, logger)
     except ImportError, e:
@@ -50,93 +131,1108 @@ def get_lfs(conf, ring, datadir, default_port, logger):
             _('Cannot load LFS. Invalid FS: %s. %s') % (fs, e))
 
 
+# addresses of this node, enumerated once per process
+_my_ips = None
+# {<ring path>: (<ring mtime>, {(<ip>, <port>): [(<position>, <dev>), ...]})}
+_ring_indexes = {}
+
+
+def get_my_ips():
+    """
+    Returns set of this node addresses, whataremyips() is called only once.
+    """
+    global _my_ips
+    if _my_ips is None:
+        _my_ips = set(whataremyips())
+    return _my_ips
+
+
+def _index_devs(devs):
+    index = {}
+    for position, dev in enumerate(devs):
+        if dev:
+            index.setdefault((dev['ip'], int(dev['port'])), []).append(
+                (position, dev))
+    return index
+
+
+def get_local_devices(ring, port):
+    """
+    Returns ring devices of this node served on port. The (ip, port) index
+    of ring devices is shared by the process and rebuilt only when the ring
+    file changes.
+
+    :param ring: swift Ring
+    :param port: server port
+    :returns: list of ring devices in ring order
+    """
+    devs = ring.devs
+    path = getattr(ring, 'serialized_path', None)
+    index = None
+    if path:
+        # mtime of the ring data loaded by Ring, the file itself could
+        # be newer until Ring reloads it
+        mtime = getattr(ring, '_mtime', None)
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                pass
+        cached = _ring_indexes.get(path)
+        if cached and mtime is not None and cached[0] == mtime:
+            index = cached[1]
+        else:
+            index = _index_devs(devs)
+            _ring_indexes[path] = (mtime, index)
+    else:
+        index = _index_devs(devs)
+    local_devs = {}
+    for ip in get_my_ips():
+        local_devs.update(index.get((ip, port), []))
+    return [local_devs[position] for position in sorted(local_devs)]
+
+
+def get_tier_roots(conf, storage_type, devices):
+    """
+    Reads placement of datadir and tmp of the storage type. datadir_roots
+    and tmp_roots map storage types to directories holding
+    <device>/<datadir> and <device>/tmp, e.g.
+    datadir_roots = account:/srv/ssd, container:/srv/ssd
+    Datadir defaults to devices, tmp defaults to the datadir root. Objects
+    are committed by renaming tmp files into datadir, so a tmp root must be
+    on the filesystem of the datadir root, setup_tier refuses other
+    placements.
+
+    :param conf: LFS configuration
+    :param storage_type: storage type of the daemon
+    :param devices: devices root
+    :returns: dict {'datadir': <root>, 'tmp': <root>}
+    :raises SwiftConfigurationError: if a map is malformed
+    """
+    roots = {}
+    for kind, default in (('datadir', devices), ('tmp', None)):
+        placement = {}
+        for item in list_from_csv(conf.get('%s_roots' % kind)):
+            if ':' not in item:
+                raise SwiftConfigurationError(
+                    _('Invalid %(kind)s_roots entry "%(item)s", expected '
+                      '<storage_type>:<root>') % {'kind': kind, 'item': item})
+            name, root = item.split(':', 1)
+            placement[name.strip()] = root.strip()
+        roots[kind] = placement.get(storage_type) or default or \
+            roots['datadir']
+    return roots
+
+
+def same_filesystem(path, other):
+    return os.stat(path).st_dev == os.stat(other).st_dev
+
+
+def isdirs(paths):
+    return all(os.path.isdir(path) for path in paths)
+
+
+# calls which timed out but still hold a native thread,
+# {<key>: set([<call state>])}
+_hung_calls = defaultdict(set)
+
+
+def call_in_thread(timeout, func, *args, **kwargs):
+    """
+    Runs blocking function in a native thread, so a hung filesystem call
+    doesn't stall the eventlet hub.
+
+    A call which timed out keeps its thread until the kernel returns. While
+    a timed out call with the same key, e.g. the device name, is pending,
+    new calls fail at once, so probes of a hung device can't use up the
+    thread pool.
+
+    :param timeout: seconds to wait for the result, None waits forever
+    :param func: function to call
+    :param key: keyword only, key of hung call tracking, None disables it
+    :returns: result of func
+    :raises LFSTimeout: if func didn't finish in time or a previous call
+                        with the key is still pending
+    """
+    key = kwargs.pop('key', None)
+    name = getattr(func, '__name__', func)
+    if key is not None and _hung_calls.get(key):
+        raise LFSTimeout(_('%(func)s skipped, earlier call for %(key)s is '
+                           'still pending') % {'func': name, 'key': key})
+    # written by both the native thread and the caller, whoever comes
+    # second clears the hung call
+    state = {'done': False, 'hung': False}
+
+    def run():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            state['done'] = True
+            if state['hung']:
+                _hung_calls[key].discard(id(state))
+
+    timer = Timeout(timeout)
+    try:
+        return tpool.execute(run)
+    except Timeout, t:
+        if t is not timer:
+            raise
+        if key is not None:
+            state['hung'] = True
+            _hung_calls[key].add(id(state))
+            if state['done']:
+                _hung_calls[key].discard(id(state))
+        raise LFSTimeout(_('%s timed out after %ss') % (name, timeout))
+    finally:
+        timer.cancel()
+
+
+def bind_device(func, device):
+    """
+    Returns env hook calling func on device of the request, unless the
+    caller passes another device.
+
+    :param func: LFS method with device argument
+    :param device: device name
+    """
+    # bound method, without self
+    position = getargspec(func).args.index('device') - 1
+
+    def hook(*args, **kwargs):
+        if len(args) > position:
+            if args[position] is None:
+                args = args[:position] + (device,) + args[position + 1:]
+        elif kwargs.get('device') is None:
+            kwargs['device'] = device
+        return func(*args, **kwargs)
+    return hook
+
+
+class StatusSnapshot(object):
+    """
+    Immutable view of device statuses. LFS publishes a new snapshot every
+    time a device status or status info changes, readers never see a half
+    updated state.
+
+    :param version: snapshot version, grows with every publish
+    :param statuses: dict {<device name>: <device status>}
+    :param info: dict {<section>: <value>} with backend details reported by
+                 ?status&info
+    """
+
+    __slots__ = ('version', 'statuses', 'body', 'etag', 'info', 'info_body')
+
+    def __init__(self, version, statuses, info=None):
+        self.version = version
+        self.statuses = statuses
+        self.body = '\n'.join('%s:%s' % (device, status)
+                              for device, status in sorted(statuses.items()))
+        self.etag = md5(self.body).hexdigest()
+        self.info = info or {}
+        self.info_body = json.dumps(dict(self.info, devices=statuses),
+                                    sort_keys=True)
+
+
 class LFS(object):
     """Base class for all FS"""
 
+    # fallocate pooled tmp files when the expected size is known
+    tmp_preallocate = False
+    # env hooks bound to the device of the request, see get_env_hooks
+    device_hooks = ('swift.setup_datadir', 'swift.setup_tmp',
+                    'swift.setup_partition', 'swift.invalidate_partition',
+                    'swift.with_partition', 'swift.destroy_partition',
+                    'swift.get_tmp_file', 'swift.get_pack_store')
+
     def __init__(self, conf, ring, datadir, default_port, logger):
         self.logger = logger
         self.datadir = datadir
         self.conf = conf
         self.devices = conf.get('devices', '/srv/node/')
-        port = int(conf.get('bind_port', default_port))
-        my_ips = whataremyips()
-        # device is a tuple (<device name>, <device mirror_copies>)
-        self.device = None
-        self.device_mirror_copies = 1
-        for dev in ring.devs:
-            if dev['ip'] in my_ips and dev['port'] == port:
-                self.device_mirror_copies = int(dev.get('mirror_copies', 1))
-                self.device = dev['device']
-                break
-        if not self.device:
+        self.storage_type = conf.get('storage_type')
+        self.ring = ring
+        self.port = int(conf.get('bind_port', default_port))
+        # local devices of this daemon in ring order,
+        # {<device name>: {'mirror_copies': .., 'mountpoint': ..}}
+        self.local_devices = self.get_ring_devices()
+        if not self.local_devices:
             raise SwiftConfigurationError(
                 _("Can\'t find device for this daemon"))
+        # first local device is used when a caller doesn't name the device
+        self.device = self.local_devices.keys()[0]
+        self.device_mirror_copies = \
+            self.local_devices[self.device]['mirror_copies']
+        self.ring_check_interval = int(conf.get('ring_check_interval', 15))
+        self.ring_watcher = None
+        self._reloading = False
         self.faulted_devices = set()
         self.degraded_devices = set()
         self.unavailable_devices = set()
+        self.timeout_devices = set()
+        # roots of <device>/<datadir> and <device>/tmp, see get_tier_roots
+        self.tier_roots = get_tier_roots(conf, self.storage_type,
+                                         self.devices)
+        # devices which tier directories have gone, reported unavailable
+        self.tier_faults = set()
+        # devices which setup timed out, reported timeout until it succeeds
+        self.setup_pending = set()
+        self.status_check_interval = int(conf.get('status_check_interval', 30))
+        self.status_check_min_interval = float(
+            conf.get('status_check_min_interval', 2))
+        self.status_check_backoff = float(
+            conf.get('status_check_backoff', 2))
+        self.status_check_jitter = float(conf.get('status_check_jitter', 0.1))
+        self.status_checker = None
+        self.status_info = {}
+        self.status_snapshot = StatusSnapshot(0, {})
+        # recent device status transitions for ?status&watch,
+        # (<status sequence>, <device name>, <device status>)
+        self.status_events = deque(
+            maxlen=int(conf.get('status_event_history', 1024)))
+        # transitions up to this sequence are no longer in status_events
+        self.status_events_floor = 0
+        # identifies the sequence space of status_sequence, changes when
+        # the sequence starts over
+        self.status_epoch = uuid4().hex
+        self._status_event = Event()
+        # one elected process per node probes devices and shares statuses
+        # with the other workers through SharedStatus
+        self.shared_status_enabled = \
+            conf.get('shared_status', 'no').lower() in TRUE_VALUES
+        self.shared_status_dir = conf.get('shared_status_dir',
+                                          '/var/run/swift')
+        self.shared_status_poll_interval = float(
+            conf.get('shared_status_poll_interval', 1))
+        self.shared_status = None
+        self.shared_status_seq = 0
+        self.shared_status_follower = None
+        self.publish_status()
+        # partition directories known to exist, per device
+        self.partition_cache_size = int(conf.get('partition_cache_size',
+                                                 4096))
+        self.partition_cache = {}
+        # free space sampled by the capacity checker,
+        # {<device name>: {'size': .., 'available': .., 'used_percent': ..}}
+        self.capacity = {}
+        # {<device name>: 'ok' | 'nearfull' | 'full'}
+        self.fill_states = {}
+        self.capacity_check_interval = int(
+            conf.get('capacity_check_interval', 60))
+        self.fill_throttle_percent = float(
+            conf.get('fill_throttle_percent', 90))
+        self.fill_reject_percent = float(conf.get('fill_reject_percent', 97))
+        self.capacity_checker = None
+        # pre-created tmp files, {<device name>: TmpFilePool}
+        self.tmp_pool_size = int(conf.get('tmp_pool_size', 0))
+        self.tmp_pools = {}
+        self.tmp_orphan_age = int(conf.get('tmp_orphan_age', 86400))
+        self.tmp_cleanup_interval = int(conf.get('tmp_cleanup_interval',
+                                                 3600))
+        self.tmp_cleaner = None
+        # append-only pack stores of partitions for small chunks, on by
+        # default for chunk servers
+        self.pack_store_enabled = conf.get(
+            'pack_store', 'yes' if self.storage_type == 'chunk' else 'no'
+        ).lower() in TRUE_VALUES
+        self.pack_segment_size = int(conf.get('pack_segment_size',
+                                              DEFAULT_SEGMENT_SIZE))
+        self.pack_fsync = conf.get('pack_fsync', 'yes').lower() in TRUE_VALUES
+        self.pack_compact_interval = int(conf.get('pack_compact_interval',
+                                                  3600))
+        self.pack_compact_garbage = float(conf.get('pack_compact_garbage',
+                                                   0.5))
+        # {(<device name>, <partition>): PackStore}
+        self.pack_stores = LRUCache(
+            max(int(conf.get('pack_store_cache_size', 1024)), 1),
+            on_evict=lambda key, store: store.close())
+        self.pack_compactor = None
+
+    def _leader_only(self, func):
+        if not self.shared_status_enabled:
+            return func
+
+        def check():
+            shared = self.shared_status
+            if shared is None:
+                return None
+            if not shared.leader:
+                # election happens on the first pass in a worker, a parent
+                # which set up the node before fork never takes the lock
+                self.sync_shared_status()
+            if shared.leader:
+                return func()
+        return check
+
+    def sync_shared_status(self):
+        """
+        Takes over status checks when the leader is gone, otherwise follows
+        statuses published by the leader.
+        """
+        shared = self.shared_status
+        if shared.leader:
+            return
+        if shared.elect():
+            self.logger.info(_('Elected as status checker for %s'),
+                             shared.path)
+            # sequence of the segment goes on, so does its epoch
+            data = self.read_shared_status()
+            if data is not None:
+                self.status_epoch = data[1].get('epoch', self.status_epoch)
+            self.write_shared_status()
+            if self.status_checker:
+                self.status_checker.poke()
+            return
+        self.refresh_status()
+
+    def write_shared_status(self):
+        """
+        Publishes local statuses to the other workers.
+        """
+        self.shared_status_seq = self.shared_status.write(json.dumps(
+            {'pid': os.getpid(),
+             'epoch': self.status_epoch,
+             'statuses': self.status_snapshot.statuses,
+             'capacity': self.capacity}))
+
+    def read_shared_status(self):
+        """
+        Reads statuses published by the leader.
+
+        :returns: tuple (<sequence>, <payload dict>) or None
+        """
+        shared = self.shared_status
+        data = shared.read()
+        if data is None:
+            return None
+        try:
+            payload = json.loads(data[1])
+            payload['statuses'].items()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.logger.error(_('Invalid shared status in %s'), shared.path)
+            return None
+        return data[0], payload
+
+    def refresh_status(self):
+        """
+        Applies statuses published by the leader, no-op in the leader and
+        when shared statuses are disabled.
+        """
+        shared = self.shared_status
+        if not shared or shared.leader or \
+                shared.sequence() == self.shared_status_seq:
+            return
+        data = self.read_shared_status()
+        if data is None:
+            return
+        self.shared_status_seq, payload = data
+        epoch = payload.get('epoch', self.status_epoch)
+        if epoch != self.status_epoch:
+            # transitions numbered in another sequence space are useless
+            self.status_epoch = epoch
+            self.status_events.clear()
+            self.status_events_floor = self.shared_status_seq
+        statuses = payload['statuses']
+        capacity = payload.get('capacity')
+        if capacity:
+            self.capacity = capacity
+            self.fill_states = dict((device, sample['fill'])
+                                    for device, sample in capacity.items())
+            self.status_info = dict(self.status_info, capacity=capacity)
+        sets = {'faulted': self.faulted_devices,
+                'degraded': self.degraded_devices,
+                'unavailable': self.unavailable_devices,
+                'timeout': self.timeout_devices}
+        for device, status in statuses.items():
+            if device not in self.local_devices:
+                continue
+            self.remove_device_from_devices(device)
+            if status in sets:
+                sets[status].add(device)
+        self.publish_status()
+
+    def create_status_checker(self, func):
+        """
+        Creates status checker thread configured from status_check_* options.
+
+        :param func: check function, see LFSStatus
+        :returns: LFSStatus
+        """
+        checker = LFSStatus(self.status_check_interval, self.logger, func,
+                            min_interval=self.status_check_min_interval,
+                            backoff=self.status_check_backoff,
+                            jitter=self.status_check_jitter)
+        if self.tiered:
+            checker.add(self.check_tiers)
+        checker.funcs = [self._leader_only(func) for func in checker.funcs]
+        return checker
+
+    @property
+    def tiered(self):
+        return any(root != self.devices
+                   for root in self.tier_roots.values())
+
+    def tier_dirs(self, device):
+        """
+        Returns device directories of datadir and tmp tiers.
+
+        :param device: device name
+        :returns: list of paths
+        """
+        roots = set(self.tier_roots.values())
+        return [os.path.join(root, device) for root in sorted(roots)]
+
+    def datadir_path(self, device):
+        return os.path.join(self.tier_roots['datadir'], device, self.datadir)
+
+    def tmp_path(self, device):
+        return os.path.join(self.tier_roots['tmp'], device, 'tmp')
+
+    def setup_tier(self, device):
+        """
+        Creates datadir and tmp of the device on their tiers. Without tiers
+        they are created on demand as before, so nothing is written to an
+        unmounted device.
+
+        :param device: device name
+        :raises LFSException: if a tier root is missing or not writable
+        :raises SwiftConfigurationError: if tmp and datadir are on different
+                                         filesystems
+        """
+        if not self.tiered:
+            return
+        for root in set(self.tier_roots.values()):
+            if not os.path.isdir(root):
+                raise LFSException(_('Tier root %s does not exist') % root)
+        for path in (self.datadir_path(device), self.tmp_path(device)):
+            mkdirs(path)
+            if not os.access(path, os.W_OK):
+                raise LFSException(_('%s is not writable') % path)
+        if not same_filesystem(self.datadir_path(device),
+                               self.tmp_path(device)):
+            raise SwiftConfigurationError(
+                _('%(tmp)s and %(datadir)s are on different filesystems, '
+                  'tmp files could not be renamed into datadir') %
+                {'tmp': self.tmp_path(device),
+                 'datadir': self.datadir_path(device)})
+
+    def check_tiers(self):
+        """
+        Checks device directories on datadir and tmp tiers which are not
+        covered by device checks of the backend. Device with a missing
+        directory is reported unavailable.
+        """
+        faults = self.get_tier_faults()
+        if faults != self.tier_faults:
+            self.tier_faults = faults
+            self.publish_status()
+        if faults:
+            return self.tier_error_callback, ()
+        return None
+
+    def get_tier_faults(self):
+        """
+        Returns devices which tier directories are missing.
+
+        :returns: set of device names
+        """
+        faults = set()
+        for device in self.local_devices:
+            try:
+                if not call_in_thread(self.status_check_interval, isdirs,
+                                      self.tier_dirs(device), key=device):
+                    faults.add(device)
+            except LFSTimeout:
+                faults.add(device)
+        return faults
+
+    def tier_error_callback(self):
+        self.logger.warning(_('Tier directories missing on %s') %
+                            ', '.join(sorted(self.tier_faults)))
+
+    def get_ring_devices(self):
+        """
+        Returns local devices of this daemon from the ring.
+
+        :returns: OrderedDict {<device name>: {'mirror_copies': ..,
+                                               'mountpoint': ..}}
+        """
+        devices = OrderedDict()
+        for dev in get_local_devices(self.ring, self.port):
+            devices[dev['device']] = {
+                'mirror_copies': int(dev.get('mirror_copies', 1)),
+                'mountpoint': os.path.join(self.devices, dev['device'])}
+        return devices
 
     def setup_node(self):
+        """
+        Prepares every local device for service and starts the ring watcher.
+        """
+        try:
+            self.setup_devices(self.local_devices.keys())
+        except LFSTimeout, e:
+            # a hung device must not keep the others out of service
+            self.logger.error(_('Device setup timed out: %s'), e)
+            self.setup_each_device(self.local_devices.keys())
+        if self.tiered:
+            self.set_status_info('tiers', dict(self.tier_roots))
+        if self.shared_status_enabled:
+            self.shared_status = SharedStatus(os.path.join(
+                self.shared_status_dir, 'lfs-%s-%d.status' %
+                (self.storage_type or self.datadir, self.port)))
+            # transitions are numbered by the shared sequence from now on
+            self.status_events.clear()
+            self.status_events_floor = self.shared_status.sequence()
+            # the follower elects a leader on its first pass in a worker
+            self.shared_status_follower = LFSStatus(
+                self.shared_status_poll_interval, self.logger,
+                self.sync_shared_status)
+            eventlet.spawn(self.shared_status_follower)
+        if self.ring_check_interval > 0:
+            self.ring_watcher = LFSStatus(self.ring_check_interval,
+                                          self.logger, self.reload_devices)
+            eventlet.spawn(self.ring_watcher)
+        if self.capacity_check_interval > 0:
+            self.capacity_checker = LFSStatus(
+                self.capacity_check_interval, self.logger,
+                self._leader_only(self.check_capacity))
+            eventlet.spawn(self.capacity_checker)
+        if self.tmp_cleanup_interval > 0:
+            self.tmp_cleaner = LFSStatus(self.tmp_cleanup_interval,
+                                         self.logger,
+                                         self._leader_only(self.cleanup_tmp))
+            eventlet.spawn(self.tmp_cleaner)
+        if self.pack_store_enabled and self.pack_compact_interval > 0:
+            self.pack_compactor = LFSStatus(self.pack_compact_interval,
+                                            self.logger, self.compact_packs)
+            eventlet.spawn(self.pack_compactor)
+
+    def sample_capacity(self, device):
+        """
+        Samples free space of the device, called from a native thread.
+
+        :param device: device name
+        :returns: dict {'size': <bytes>, 'available': <bytes>}
+        """
+        st = os.statvfs(os.path.join(self.tier_roots['datadir'], device))
+        return {'size': st.f_blocks * st.f_frsize,
+                'available': st.f_bavail * st.f_frsize}
+
+    def check_capacity(self):
+        """
+        Samples free space of all local devices and publishes fill levels,
+        so admission decisions on the request path need no syscalls.
+        """
+        capacity = {}
+        fill_states = {}
+        for device in self.local_devices:
+            try:
+                sample = call_in_thread(self.capacity_check_interval,
+                                        self.sample_capacity, device,
+                                        key=device)
+            except Exception:
+                self.logger.exception(
+                    _('Cannot sample capacity of %s'), device)
+                continue
+            if sample['size']:
+                sample['used_percent'] = round(
+                    100.0 - sample['available'] * 100.0 / sample['size'], 2)
+            else:
+                sample['used_percent'] = 100.0
+            if sample['used_percent'] >= self.fill_reject_percent:
+                fill_states[device] = 'full'
+            elif sample['used_percent'] >= self.fill_throttle_percent:
+                fill_states[device] = 'nearfull'
+            else:
+                fill_states[device] = 'ok'
+            sample['fill'] = fill_states[device]
+            capacity[device] = sample
+        self.capacity = capacity
+        self.fill_states = fill_states
+        self.set_status_info('capacity', capacity)
+        if self.shared_status and self.shared_status.leader:
+            self.write_shared_status()
+        return None
+
+    def reload_devices(self):
+        """
+        Picks up ring changes. New devices are set up in a separate green
+        thread, then the whole device set is swapped at once, so requests
+        never see a device which is not ready.
+        """
+        if self._reloading:
+            return None
+        pending = [device for device in self.local_devices
+                   if device in self.setup_pending]
+        if pending:
+            self.setup_each_device(pending)
+        new_devices = self.get_ring_devices()
+        if new_devices == self.local_devices:
+            return None
+        self._reloading = True
+        eventlet.spawn_n(self._swap_devices, new_devices)
+        return None
+
+    def _swap_devices(self, new_devices):
+        try:
+            for device in new_devices.keys():
+                if device in self.local_devices:
+                    continue
+                try:
+                    self.setup_devices([device])
+                except (Exception, SystemExit):
+                    self.logger.exception(
+                        _('Cannot set up new device %s'), device)
+                    del new_devices[device]
+            if not new_devices:
+                self.logger.error(_('Ring has no devices for this daemon, '
+                                    'keeping old devices'))
+                return
+            removed = [device for device in self.local_devices
+                       if device not in new_devices]
+            self.local_devices = new_devices
+            self.device = new_devices.keys()[0]
+            self.device_mirror_copies = \
+                new_devices[self.device]['mirror_copies']
+            for device in removed:
+                self.remove_device_from_devices(device)
+                self.tier_faults.discard(device)
+                self.setup_pending.discard(device)
+                self.invalidate_partition(device=device)
+                self.partition_cache.pop(device, None)
+                tmp_pool = self.tmp_pools.pop(device, None)
+                if tmp_pool:
+                    tmp_pool.close()
+            self.publish_status()
+            self.logger.info(_('Local devices reloaded from ring: %s'),
+                             ', '.join(new_devices))
+        finally:
+            self._reloading = False
+
+    def setup_each_device(self, devices):
+        """
+        Sets up devices one by one. A device which setup failed or timed out
+        reports timeout status and is retried by the ring watcher.
+
+        :param devices: list of device names
+        """
+        for device in devices:
+            try:
+                self.setup_devices([device])
+            except LFSException, e:
+                self.logger.error(_('Cannot set up %(device)s: %(error)s') %
+                                  {'device': device, 'error': e})
+                self.setup_pending.add(device)
+            else:
+                self.setup_pending.discard(device)
+        self.publish_status()
+
+    def setup_devices(self, devices):
+        """
+        Prepares devices for service.
+
+        :param devices: list of device names
+        """
+        for device in devices:
+            self.setup_device(device)
+            self.setup_tier(device)
+
+    def setup_device(self, device):
         pass
 
-    def setup_datadir(self):
+    def setup_datadir(self, device=None):
         """
-        Setup datadir, devises/device/datadir
+        Setup datadir, devises/device/datadir or datadir tier root
 
+        :param device: device name, if None current device is used
         :returns: path to datadir
         """
-        path = os.path.join(self.devices, self.device, self.datadir)
+        path = self.datadir_path(device or self.device)
         mkdirs(path)
         return path
 
-    def setup_tmp(self):
+    def setup_tmp(self, device=None):
         """
-        Setup tmp, devises/device/tmp
+        Setup tmp, devises/device/tmp or tmp tier root
 
+        :param device: device name, if None current device is used
         :returns: path to tmp
         """
-        path = os.path.join(self.devices, self.device, 'tmp')
+        path = self.tmp_path(device or self.device)
         mkdirs(path)
         return path
 
-    def setup_partition(self, partition):
+    def get_env_hooks(self, device=None):
+        """
+        Returns storage functions the middleware puts into WSGI environment.
+        Hooks of device_hooks called without device work on the given
+        device, servers pass only the partition.
+
+        :param device: local device of the request, if None hooks work on
+                       the current device
+        :returns: dict {<env key>: <function>}
+        """
+        hooks = {
+            'swift.storage': self,
+            'swift.setup_datadir': self.setup_datadir,
+            'swift.setup_tmp': self.setup_tmp,
+            'swift.setup_partition': self.setup_partition,
+            'swift.invalidate_partition': self.invalidate_partition,
+            'swift.with_partition': self.with_partition,
+            'swift.destroy_partition': self.destroy_partition,
+            'swift.get_tmp_file': self.get_tmp_file,
+        }
+        if self.pack_store_enabled:
+            hooks['swift.get_pack_store'] = self.get_pack_store
+        return self.bind_hooks(hooks, device)
+
+    def bind_hooks(self, hooks, device):
+        """
+        Binds hooks of device_hooks to the device.
+
+        :param hooks: dict {<env key>: <function>}
+        :param device: device name or None
+        :returns: hooks
+        """
+        if device is not None:
+            for key in self.device_hooks:
+                if key in hooks:
+                    hooks[key] = bind_device(hooks[key], device)
+        return hooks
+
+    def get_tmp_file(self, size=None, device=None):
+        """
+        Returns temporary file in devises/device/tmp, from the device tmp
+        pool if tmp_pool_size is set. The caller owns the file and must
+        rename or unlink it.
+
+        :param size: expected file size or None
+        :param device: device name, if None current device is used
+        :returns: tuple (<fd>, <path>)
+        """
+        device = device or self.device
+        tmp_pool = self.tmp_pools.get(device)
+        if tmp_pool is None:
+            tmp_pool = self.tmp_pools[device] = TmpFilePool(
+                self.setup_tmp(device), self.tmp_pool_size, self.logger,
+                self.tmp_preallocate)
+        return tmp_pool.get(size)
+
+    def get_pack_store(self, partition, device=None):
+        """
+        Returns pack store of the partition in <partition>/packs, small
+        chunks are appended to its segment files instead of being written
+        as a file each.
+
+        :param partition: partition
+        :param device: device name, if None current device is used
+        :returns: swift_lfs.packstore.PackStore
+        """
+        device = device or self.device
+        store = self.pack_stores.get((device, partition))
+        if store is None:
+            # index is rebuilt from all segments, don't block the hub
+            store = tpool.execute(
+                PackStore,
+                os.path.join(self.setup_partition(partition, device),
+                             'packs'),
+                self.pack_segment_size, self.pack_fsync, self.logger)
+            opened = self.pack_stores.get((device, partition))
+            if opened is not None:
+                # opened by another greenthread meanwhile
+                store.close()
+                return opened
+            self.pack_stores.set((device, partition), store)
+        return store
+
+    def compact_packs(self):
+        """
+        Compacts open pack stores with enough replaced or deleted chunks.
+        """
+        for (device, partition), store in self.pack_stores.items():
+            try:
+                removed = store.compact(self.pack_compact_garbage)
+            except Exception:
+                self.logger.exception(_('Cannot compact packs of %s/%s'),
+                                      device, partition)
+                continue
+            if removed:
+                self.logger.info(_('Compacted %d pack segments of %s/%s'),
+                                 removed, device, partition)
+        return None
+
+    def cleanup_tmp(self):
+        """
+        Removes tmp files left by crashed workers on all local devices.
+        """
+        for device in self.local_devices:
+            tmpdir = self.tmp_path(device)
+            removed = tpool.execute(cleanup_orphans, tmpdir,
+                                    self.tmp_orphan_age, self.logger)
+            if removed:
+                self.logger.info(_('Removed %d orphaned tmp files from %s'),
+                                 removed, tmpdir)
+        return None
+
+    def setup_partition(self, partition, device=None):
+        """
+        Creates partition directory, devises/device/datadir/partition.
+        Paths of already created partitions are served from the partition
+        cache without touching the filesystem, so a directory removed by
+        another process stays cached until invalidate_partition, see
+        with_partition.
+
+        :param partition: partition
+        :param device: device name, if None current device is used
+        :returns: path to partition directory
+        """
+        device = device or self.device
+        cache = self.partition_cache.get(device)
+        if cache is None:
+            cache = self.partition_cache[device] = \
+                LRUCache(self.partition_cache_size)
+        path = cache.get(partition)
+        if path is None:
+            path = self.create_partition(partition, device)
+            cache.set(partition, path)
+        return path
+
+    def with_partition(self, func, partition, device=None):
+        """
+        Calls func with the partition path. Replicators run in other
+        processes and remove handoff partitions behind the partition cache
+        of the workers: when func fails with ENOENT, e.g. on mkdir or
+        rename in the partition, the cached path is dropped and func is
+        called once more with the partition set up again.
+
+        :param func: function taking partition path
+        :param partition: partition
+        :param device: device name, if None current device is used
+        :returns: result of func
+        """
+        device = device or self.device
+        try:
+            return func(self.setup_partition(partition, device))
+        except (IOError, OSError), err:
+            if err.errno != errno.ENOENT:
+                raise
+        self.invalidate_partition(partition, device)
+        return func(self.setup_partition(partition, device))
+
+    def create_partition(self, partition, device):
         """
-        Creates partition directory, devises/device/datadir/partition
+        Creates partition directory, called on partition cache miss.
 
         :param partition: partition
+        :param device: device name
         :returns: path to partition directory
         """
-        path = os.path.join(self.devices, self.device, self.datadir, partition)
+        path = os.path.join(self.datadir_path(device), partition)
         mkdirs(path)
         return path
 
+    def destroy_partition(self, partition, device=None):
+        """
+        Removes partition with all its data, e.g. handoff partition after
+        it was replicated to primary nodes.
+
+        :param partition: partition
+        :param device: device name, if None current device is used
+        """
+        device = device or self.device
+        self.invalidate_partition(partition, device)
+        path = os.path.join(self.datadir_path(device), partition)
+        tpool.execute(rmtree, path, True)
+
+    def invalidate_partition(self, partition=None, device=None):
+        """
+        Drops partitions from the partition cache and closes their pack
+        stores. Must be called when a partition directory is removed or the
+        device is remounted: LFS calls it on remounts and in
+        destroy_partition, a server which removes or finds a partition
+        directory missing behind LFS calls env['swift.invalidate_partition']
+        or does the work through env['swift.with_partition'].
+
+        :param partition: partition, if None all partitions of the device
+                          are dropped
+        :param device: device name, if None current device is used
+        """
+        device = device or self.device
+        if partition is None:
+            stores = [key for key, _store in self.pack_stores.items()
+                      if key[0] == device]
+        else:
+            stores = [(device, partition)]
+        for key in stores:
+            store = self.pack_stores.pop(key)
+            if store is not None:
+                store.close()
+        cache = self.partition_cache.get(device)
+        if cache is None:
+            return
+        if partition is None:
+            cache.clear()
+        else:
+            cache.pop(partition)
+
     def remove_device_from_devices(self, device):
         for devices in (self.degraded_devices, self.faulted_devices,
-                        self.unavailable_devices):
+                        self.unavailable_devices, self.timeout_devices):
             if device in devices:
                 devices.remove(device)
 
+    def _device_status(self, device):
+        if device in self.faulted_devices:
+            return 'faulted'
+        elif device in self.degraded_devices:
+            return 'degraded'
+        elif device in self.unavailable_devices or \
+                device in self.tier_faults:
+            return 'unavailable'
+        elif device in self.timeout_devices or \
+                device in self.setup_pending:
+            return 'timeout'
+        return 'online'
+
+    def set_device_status(self, device, status):
+        """
+        Moves device to the status set and publishes new status snapshot.
+
+        :param device: device name
+        :param status: one of online, degraded, faulted, unavailable, timeout
+        :returns: True if status of device has changed
+        """
+        old_status = self.status_snapshot.statuses.get(device)
+        self.remove_device_from_devices(device)
+        devices = {'faulted': self.faulted_devices,
+                   'degraded': self.degraded_devices,
+                   'unavailable': self.unavailable_devices,
+                   'timeout': self.timeout_devices}.get(status)
+        if devices is not None:
+            devices.add(device)
+        self.publish_status()
+        if old_status != status:
+            if self.status_checker:
+                # look closer at the device which has just changed
+                self.status_checker.poke()
+            return True
+        return False
+
+    def publish_status(self):
+        """
+        Publishes new status snapshot if any device status has changed.
+
+        :returns: current StatusSnapshot
+        """
+        statuses = dict((device, self._device_status(device))
+                        for device in self.local_devices)
+        snapshot = self.status_snapshot
+        if statuses != snapshot.statuses or \
+                self.status_info is not snapshot.info:
+            old_statuses = snapshot.statuses
+            snapshot = StatusSnapshot(snapshot.version + 1, statuses,
+                                      self.status_info)
+            self.status_info = snapshot.info
+            self.status_snapshot = snapshot
+            if statuses != old_statuses:
+                if self.shared_status and self.shared_status.leader:
+                    self.write_shared_status()
+                self.record_status_events(self.status_sequence(),
+                                          old_statuses, statuses)
+        return snapshot
+
+    def status_sequence(self):
+        """
+        Returns sequence of the current device statuses. It is the sequence
+        of the shared status segment, same in all workers of the node, or
+        the snapshot version when statuses are not shared.
+        """
+        if self.shared_status:
+            return self.shared_status_seq
+        return self.status_snapshot.version
+
+    def record_status_events(self, version, old_statuses, statuses):
+        """
+        Appends device transitions to status_events and wakes up watchers.
+
+        :param version: status sequence of the new statuses
+        :param old_statuses: dict {<device name>: <device status>}
+        :param statuses: dict {<device name>: <device status>}
+        """
+        events = self.status_events
+        for device in sorted(set(old_statuses) | set(statuses)):
+            status = statuses.get(device, 'removed')
+            if old_statuses.get(device) == status:
+                continue
+            if len(events) == events.maxlen:
+                self.status_events_floor = events[0][0] if events \
+                    else version
+            events.append((version, device, status))
+        event, self._status_event = self._status_event, Event()
+        event.send(version)
+
+    def get_status_events(self, since):
+        """
+        Returns device transitions published after the sequence.
+
+        :param since: last status sequence seen by the client
+        :returns: list of (<sequence>, <device name>, <device status>) or
+                  None if transitions after since are no longer kept or
+                  since is ahead of the current sequence, the client has to
+                  resync from the current statuses
+        """
+        if since < self.status_events_floor or \
+                since > self.status_sequence():
+            return None
+        return [event for event in self.status_events if event[0] > since]
+
+    def wait_status_events(self, since, timeout):
+        """
+        Waits until a device status changes after the sequence.
+
+        :param since: last status sequence seen by the client
+        :param timeout: seconds to wait
+        :returns: see get_status_events, empty list on timeout
+        """
+        events = self.get_status_events(since)
+        if events == []:
+            with Timeout(timeout, False):
+                self._status_event.wait()
+            events = self.get_status_events(since)
+        return events
+
+    def set_status_info(self, section, value):
+        """
+        Reports backend details through ?status&info.
+
+        :param section: section name
+        :param value: JSON serializable value, must not be changed later
+        """
+        if self.status_info.get(section) == value:
+            return
+        info = dict(self.status_info)
+        info[section] = value
+        self.status_info = info
+        self.publish_status()
+
     def get_device_status(self, devices=None):
         """
         Return statuses of devices
 
-        :param devices: list of devices
+        :param devices: list of devices, if None all local devices
         :returns: dict ({ <device name> : (<device status>, <mirror_count>})
                   with device statuses or None if there is not any device
         """
         if devices and not isinstance(devices, list):
             raise LFSException("Devices should be a list")
-        dev_statuses = {}
+        self.refresh_status()
+        statuses = self.status_snapshot.statuses
         if not devices:
-            devices = [self.device]
+            return dict(statuses) or None
+        dev_statuses = {}
         for device in devices:
-            if device in self.faulted_devices:
-                status = 'faulted'
-            elif device in self.degraded_devices:
-                status = 'degraded'
-            elif device in self.unavailable_devices:
-                status = 'unavailable'
-            else:
-                status = 'online'
+            status = statuses.get(device)
+            if status is None:
+                status = self._device_status(device)
             dev_statuses[device] = status
         if not dev_statuses:
             dev_statuses = None
@@ -147,29 +1243,98 @@ class LFSStatus(object):
     """
     Status Checker thread which checks the status of filesystem and calls back
     to LFS if it sees any issues.
-    This thread periodically calls the check_func, if the filesystem is
-    healthy. If check_func returns non-zero, it temporary stops checking
-    until the fault is cleared.
+    This thread calls the check functions with an adaptive interval. Right
+    after a state change, an error or a poke the checks run every
+    min_interval seconds, while the filesystem stays in the same state,
+    healthy or not, the interval grows by backoff factor up to interval.
+    Each sleep is randomized by jitter, so many daemons on one host don't
+    probe at the same moment.
 
-    :param interval: interval in seconds for checking FS
+    :param interval: maximum interval in seconds for checking FS
     :param logger: logger object
-    :param func: method for checking FS. Takes exactly one argument which
-                 should be a tuple. Returns 0 if FS is healthy
+    :param func: method for checking FS. Takes no arguments. Returns None if
+                 FS is healthy or tuple (<callback function>, <args>)
+    :param min_interval: minimum interval in seconds, defaults to interval
+    :param backoff: interval multiplier applied after each healthy check
+    :param jitter: fraction of the interval used to randomize the sleep
     """
 
-    def __init__(self, interval, logger, func):
+    def __init__(self, interval, logger, func, min_interval=None,
+                 backoff=2, jitter=0):
         self.interval = interval
-        self.func = func
+        self.min_interval = min(min_interval or interval, interval)
+        self.backoff = max(backoff, 1)
+        self.jitter = jitter
+        self.funcs = [func]
         self.logger = logger
         self.daemon = True
+        self.next_interval = self.min_interval
+        # indexes of funcs which reported an issue in the last pass
+        self.issues = ()
+        # last pass saw a different state than the one before or an error
+        self.changed = False
+        self._wakeup = Event()
 
-    def __call__(self):
-        while True:
+    def add(self, func):
+        """
+        Adds one more check function, all functions are called in one pass.
+
+        :param func: method for checking FS, see func
+        """
+        self.funcs.append(func)
+
+    def poke(self):
+        """
+        Resets the interval to min_interval and wakes up the checker.
+        """
+        self.next_interval = self.min_interval
+        if not self._wakeup.ready():
+            self._wakeup.send()
+
+    def check(self):
+        """
+        Runs all check functions once.
+
+        :returns: True if any function reported an issue or failed
+        """
+        failed = errors = False
+        issues = []
+        for index, func in enumerate(self.funcs):
             try:
-                ret = self.func()
+                ret = func()
                 if ret is not None:
+                    failed = True
+                    issues.append(index)
                     # ret must be a tuple (<callback function>, <args>)
                     ret[0](*ret[1])
             except Exception:
+                failed = errors = True
                 self.logger.exception(_('Unhandled status checker thread'))
-            eventlet.sleep(self.interval)
+        issues = tuple(issues)
+        self.changed = errors or issues != self.issues
+        self.issues = issues
+        return failed
+
+    def get_sleep(self, changed):
+        """
+        Computes sleep before the next pass.
+
+        :param changed: the last check saw a state change or an error
+        :returns: seconds to sleep
+        """
+        if changed:
+            self.next_interval = self.min_interval
+        sleep = self.next_interval
+        self.next_interval = min(self.next_interval * self.backoff,
+                                 self.interval)
+        if self.jitter:
+            sleep *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(sleep, 0)
+
+    def __call__(self):
+        while True:
+            self.check()
+            sleep = self.get_sleep(self.changed)
+            self._wakeup = Event()
+            with Timeout(sleep, False):
+                self._wakeup.wait()
@@ -0,0 +1,193 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from swift_lfs.exceptions import LFSException
+
+
+# compression settings from the cheapest to the strongest
+COMPRESSION_LEVELS = ['off', 'lz4'] + ['gzip-%d' % i for i in range(1, 10)]
+# settings outside of COMPRESSION_LEVELS, used to find the starting level
+LEVEL_ALIASES = {'on': 'lz4', 'lzjb': 'lz4', 'zle': 'off', 'gzip': 'gzip-6'}
+
+
+def normalize_level(level):
+    level = LEVEL_ALIASES.get(level, level)
+    if level not in COMPRESSION_LEVELS:
+        raise LFSException(_('Unsupported compression: %s') % level)
+    return level
+
+
+def read_cpu_times(stat_path='/proc/stat'):
+    """
+    Reads aggregate CPU times.
+
+    :param stat_path: path to /proc/stat
+    :returns: tuple (<busy jiffies>, <total jiffies>) or None
+    """
+    try:
+        with open(stat_path) as fp:
+            fields = fp.readline().split()
+    except IOError:
+        return None
+    if not fields or fields[0] != 'cpu':
+        return None
+    times = [int(field) for field in fields[1:]]
+    # idle and iowait
+    idle = sum(times[3:5])
+    return sum(times) - idle, sum(times)
+
+
+class CPUMeter(object):
+    """
+    Measures CPU usage between calls, falls back to load average when
+    /proc/stat is not available.
+    """
+
+    def __init__(self, stat_path='/proc/stat'):
+        self.stat_path = stat_path
+        self.last = read_cpu_times(stat_path)
+
+    def usage(self):
+        """
+        :returns: CPU usage in percent since the previous call
+        """
+        now = read_cpu_times(self.stat_path)
+        last, self.last = self.last, now
+        if now and last and now[1] > last[1]:
+            return 100.0 * (now[0] - last[0]) / (now[1] - last[1])
+        try:
+            cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+        except (ValueError, OSError):
+            cpus = 1
+        return min(100.0 * os.getloadavg()[0] / max(cpus, 1), 100.0)
+
+
+class CompressionTuner(object):
+    """
+    Chooses dataset compression from compression ratio and CPU usage
+    samples. Compression goes one level down when data doesn't compress or
+    CPU is busy, and one level up when data compresses well and CPU is
+    idle. A step needs hysteresis samples in a row voting the same way.
+    Data written with compression off has no compression ratio, so after
+    probe_samples samples at off the tuner tries the next level again.
+
+    :param level: current compression
+    :param min_level: lowest allowed compression
+    :param max_level: highest allowed compression
+    :param ratio_low: compressratio below which compression goes down
+    :param ratio_high: compressratio above which compression may go up
+    :param cpu_low: CPU percent below which compression may go up
+    :param cpu_high: CPU percent above which compression goes down
+    :param hysteresis: samples in a row needed for a step
+    :param probe_samples: samples at off before trying compression again
+    :param min_written: logical bytes written between usage samples, see
+                        sample_usage
+    """
+
+    def __init__(self, level, min_level='off', max_level='gzip-6',
+                 ratio_low=1.1, ratio_high=1.5, cpu_low=50, cpu_high=80,
+                 hysteresis=3, probe_samples=24, min_written=16777216):
+        self.min_index = COMPRESSION_LEVELS.index(normalize_level(min_level))
+        self.max_index = COMPRESSION_LEVELS.index(normalize_level(max_level))
+        if self.min_index > self.max_index:
+            raise LFSException(_('compression_min is above compression_max'))
+        self.index = min(max(COMPRESSION_LEVELS.index(normalize_level(level)),
+                             self.min_index), self.max_index)
+        self.ratio_low = ratio_low
+        self.ratio_high = ratio_high
+        self.cpu_low = cpu_low
+        self.cpu_high = cpu_high
+        self.hysteresis = max(hysteresis, 1)
+        self.probe_samples = probe_samples
+        self.min_written = min_written
+        self.votes = 0
+        self.off_samples = 0
+        # (<logicalused>, <used>) of the previous usage sample
+        self.last_usage = None
+
+    @property
+    def level(self):
+        return COMPRESSION_LEVELS[self.index]
+
+    def vote(self, ratio, cpu):
+        """
+        :returns: -1 to go down, 1 to go up, 0 to stay
+        """
+        if cpu >= self.cpu_high:
+            return -1
+        if self.level == 'off':
+            self.off_samples += 1
+            if self.off_samples >= self.probe_samples and \
+                    cpu < self.cpu_low:
+                return 1
+            return 0
+        if ratio < self.ratio_low:
+            return -1
+        if ratio >= self.ratio_high and cpu < self.cpu_low:
+            return 1
+        return 0
+
+    def sample(self, ratio, cpu):
+        """
+        Accounts new sample.
+
+        :param ratio: compressratio of the dataset
+        :param cpu: CPU usage in percent
+        :returns: new compression if it should be changed, otherwise None
+        """
+        vote = self.vote(ratio, cpu)
+        if not vote or (self.votes and (vote > 0) != (self.votes > 0)):
+            self.votes = vote
+        else:
+            self.votes += vote
+        if abs(self.votes) < self.hysteresis and \
+                not (vote > 0 and self.level == 'off'):
+            return None
+        index = min(max(self.index + vote, self.min_index), self.max_index)
+        self.votes = 0
+        if index == self.index:
+            return None
+        self.index = index
+        self.off_samples = 0
+        return self.level
+
+    def sample_usage(self, logical, used, cpu):
+        """
+        Accounts new sample of dataset space usage. Compression ratio of the
+        data written since the previous sample is used, cumulative
+        compressratio of the dataset hardly moves once it holds a lot of
+        data written with other settings. Samples with less than
+        min_written new logical bytes are merged with the next one.
+
+        :param logical: logicalused of the dataset in bytes
+        :param used: used of the dataset in bytes
+        :param cpu: CPU usage in percent
+        :returns: compression ratio of the new data or None if there was
+                  not enough new data to sample
+        """
+        if self.last_usage is None or logical < self.last_usage[0]:
+            # first sample or data was deleted, start over
+            self.last_usage = (logical, used)
+            return None
+        written = logical - self.last_usage[0]
+        allocated = used - self.last_usage[1]
+        if written < max(self.min_written, 1) or allocated <= 0:
+            return None
+        self.last_usage = (logical, used)
+        ratio = float(written) / allocated
+        self.sample(ratio, cpu)
+        return ratio
@@ -13,9 +13,203 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from swift_lfs.fs import LFS
+import os
+import re
+import subprocess
+
+import eventlet
+
+from swift.common.utils import TRUE_VALUES
+
+from swift_lfs.fs import LFS, call_in_thread
+from swift_lfs.exceptions import LFSTimeout
+
+
+GEOMETRY_RE = re.compile(r'agcount=(\d+), agsize=(\d+) blks')
+BSIZE_RE = re.compile(r'^data\s*=\s*bsize=(\d+)', re.M)
+
+
+def unescape_mount_path(path):
+    """Decodes octal escapes (\\040 for space) used in mountinfo"""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+
+def parse_mountinfo(path):
+    """
+    Parses mount table in /proc/<pid>/mountinfo format.
+
+    :param path: path to mountinfo file
+    :returns: dict {<mount point>: {'fstype': .., 'source': ..,
+                                    'options': set(..)}}
+    """
+    mounts = {}
+    with open(path) as fp:
+        for line in fp:
+            fields = line.split()
+            try:
+                sep = fields.index('-', 6)
+                mount_point = unescape_mount_path(fields[4])
+                options = set(fields[5].split(','))
+                options.update(fields[sep + 3].split(','))
+                mounts[mount_point] = {'fstype': fields[sep + 1],
+                                       'source': fields[sep + 2],
+                                       'options': options}
+            except (ValueError, IndexError):
+                continue
+    return mounts
+
+
+def get_geometry(mountpoint):
+    """
+    Reads allocation group geometry of XFS filesystem with xfs_info.
+
+    :param mountpoint: mount point of the filesystem
+    :returns: dict {'agcount': .., 'agsize': .., 'bsize': ..} or None
+    """
+    proc = subprocess.Popen(['xfs_info', mountpoint],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode:
+        return None
+    match = GEOMETRY_RE.search(out)
+    if not match:
+        return None
+    geometry = {'agcount': int(match.group(1)),
+                'agsize': int(match.group(2))}
+    match = BSIZE_RE.search(out)
+    if match:
+        geometry['bsize'] = int(match.group(1))
+    return geometry
+
+
+def set_filestreams(path):
+    """
+    Sets XFS filestreams flag on directory, new subdirectories inherit it
+    and the allocator keeps each of them in its own allocation group.
+
+    :param path: directory path
+    :returns: True on success
+    """
+    return subprocess.call(['xfs_io', '-c', 'chattr +S', path]) == 0
 
 
 class LFSXFS(LFS):
 
     fs = 'xfs'
+    tmp_preallocate = True
+
+    def __init__(self, conf, ring, srvdir, default_port, logger):
+        super(LFSXFS, self).__init__(conf, ring, srvdir, default_port, logger)
+        self.mountinfo_path = conf.get('mountinfo_path',
+                                       '/proc/self/mountinfo')
+        self.probe_timeout = float(conf.get('probe_timeout', 10))
+        self.ag_spread = conf.get('ag_spread', 'no').lower() in TRUE_VALUES
+        self.mount_check = \
+            conf.get('mount_check', 'true').lower() in TRUE_VALUES
+        # {<device name>: {'agcount': .., 'agsize': .., 'bsize': ..}}
+        self.geometry = {}
+        self.status_checker = self.create_status_checker(self.check_device)
+
+    def setup_node(self):
+        """
+        Reads geometry of every device and runs device status checker thread.
+        """
+        super(LFSXFS, self).setup_node()
+        self.set_status_info('xfs_geometry', dict(self.geometry))
+        eventlet.spawn(self.status_checker)
+
+    def setup_device(self, device):
+        """
+        Reads allocation group geometry of the device. With ag_spread on,
+        datadir gets filestreams flag, so partition directories are spread
+        over allocation groups and concurrent writes to different partitions
+        allocate in parallel.
+
+        :param device: device name
+        """
+        mountpoint = self.local_devices[device]['mountpoint']
+        try:
+            geometry = call_in_thread(self.probe_timeout, get_geometry,
+                                      mountpoint, key=device)
+        except (OSError, LFSTimeout), e:
+            self.logger.warning(_('Cannot read XFS geometry of %s: %s'),
+                                device, e)
+            return
+        if not geometry:
+            return
+        self.geometry[device] = geometry
+        try:
+            mount = call_in_thread(self.probe_timeout, parse_mountinfo,
+                                   self.mountinfo_path,
+                                   key=self.mountinfo_path).get(mountpoint)
+        except LFSTimeout, e:
+            self.logger.warning(_("Can't read mount table: %s"), e)
+            mount = None
+        if mount and 'inode32' in mount['options'] and \
+                geometry['agcount'] > 1:
+            self.logger.warning(
+                _('%s is mounted with inode32, directories are not spread '
+                  'over %d allocation groups'), device, geometry['agcount'])
+        if self.ag_spread and geometry['agcount'] > 1:
+            datadir = self.setup_datadir(device)
+            if not call_in_thread(self.probe_timeout, set_filestreams,
+                                  datadir, key=device):
+                self.logger.warning(_('Cannot set filestreams on %s'),
+                                    datadir)
+
+    def get_mount_status(self, mounts, device):
+        """
+        Returns status of the device from mount table.
+
+        :param mounts: parsed mount table, see parse_mountinfo
+        :param device: device name
+        :returns: device status
+        """
+        mountpoint = os.path.normpath(
+            self.local_devices[device]['mountpoint'])
+        mount = mounts.get(mountpoint)
+        if not mount:
+            return 'unavailable' if self.mount_check else 'online'
+        if mount['fstype'] != 'xfs':
+            return 'unavailable'
+        if 'ro' in mount['options']:
+            # XFS shuts down to read only after I/O errors
+            return 'faulted'
+        return 'online'
+
+    def check_device(self):
+        """
+        Checks mount state of all local devices in one pass.
+        """
+        try:
+            mounts = call_in_thread(self.probe_timeout, parse_mountinfo,
+                                    self.mountinfo_path,
+                                    key=self.mountinfo_path)
+        except LFSTimeout, e:
+            self.logger.error(_("Can't read mount table: %s"), e)
+            for device in self.local_devices:
+                self.set_device_status(device, 'timeout')
+            return self.error_callback, tuple()
+        need_cb = False
+        for device in self.local_devices:
+            status = self.get_mount_status(mounts, device)
+            if self.set_device_status(device, status):
+                self.invalidate_partition(device=device)
+            if status != 'online':
+                need_cb = True
+        if need_cb:
+            return self.error_callback, tuple()
+        return None
+
+    def error_callback(self):
+        if self.faulted_devices:
+            self.logger.warning(
+                _("Read only XFS devices: %s") %
+                ', '.join(self.faulted_devices))
+        if self.unavailable_devices:
+            self.logger.warning(
+                _("Unmounted XFS devices: %s") %
+                ', '.join(self.unavailable_devices))
+        if self.timeout_devices:
+            self.logger.warning(
+                _("TIMED OUT devices: %s") % ', '.join(self.timeout_devices))
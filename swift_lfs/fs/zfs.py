@@ -14,12 +14,22 @@
 # limitations under the License.
 
 import os
+import re
+import subprocess as native_subprocess
 import sys
+import time
 
 import eventlet
+from eventlet import Timeout
+from eventlet.green import subprocess
 
-from swift_lfs.fs import LFS, LFSStatus
-from swift_lfs.exceptions import LFSException
+from swift.common.utils import TRUE_VALUES
+from swift.common.exceptions import SwiftConfigurationError
+
+from swift_lfs.fs import LFS, LFSStatus, call_in_thread
+from swift_lfs.fs.compression import CompressionTuner, CPUMeter
+from swift_lfs.exceptions import LFSException, LFSTimeout
+from swift_lfs.utils import OrderedDict
 
 try:
     from nspyzfs import NSPyZFSError, dataset, pool
@@ -27,57 +37,819 @@ except ImportError:
     raise LFSException(_("Can't import required module nspyzfs"))
 
 
+# pool health which needs attention -> device status
+ZFS_HEALTH = {
+    'DEGRADED': 'degraded',
+    'FAULTED': 'faulted',
+    'SPLIT': 'faulted',
+    'UNAVAIL': 'unavailable',
+    'UNKNOWN': 'online',
+    'TIMEOUT': 'timeout',
+}
+
+
+# snapshot names accepted by snapshot API
+SNAPSHOT_NAME_RE = re.compile(r'^[A-Za-z0-9_.:-]+$')
+
+
+def popen_zfs(args, **kwargs):
+    """
+    Starts zfs command, pipes are cooperative with eventlet.
+
+    :param args: zfs arguments
+    :returns: subprocess.Popen
+    """
+    return subprocess.Popen(['zfs'] + list(args), **kwargs)
+
+
+def run_zfs(*args, **kwargs):
+    """
+    Runs zfs command.
+
+    :param args: zfs arguments
+    :param timeout: keyword only, seconds to wait for the command, which is
+                    killed when it runs longer, None waits forever
+    :returns: command output
+    :raises LFSException: if command fails
+    :raises LFSTimeout: if command didn't finish in time
+    """
+    timeout = kwargs.pop('timeout', None)
+    proc = popen_zfs(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timer = Timeout(timeout)
+    try:
+        out, err = proc.communicate()
+    except Timeout, t:
+        if t is not timer:
+            raise
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        # zfs stuck in the kernel exits once the pool returns
+        eventlet.spawn_n(proc.wait)
+        raise LFSTimeout(_('zfs %(args)s timed out after %(timeout)ss') %
+                         {'args': ' '.join(args), 'timeout': timeout})
+    finally:
+        timer.cancel()
+    if proc.returncode:
+        raise LFSException(_('zfs %s failed: %s') %
+                           (' '.join(args), err.strip()))
+    return out
+
+
+def get_pool_fragmentation(pool_name):
+    """
+    Reads fragmentation of free space of the pool with zpool get, blocks,
+    so it is called in a native thread.
+
+    :param pool_name: pool name
+    :returns: fragmentation percent or None if the pool doesn't report it
+    :raises LFSException: if zpool fails
+    """
+    proc = native_subprocess.Popen(
+        ['zpool', 'get', '-Hp', 'fragmentation', pool_name],
+        stdout=native_subprocess.PIPE, stderr=native_subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise LFSException(_('zpool get fragmentation %s failed: %s') %
+                           (pool_name, err.strip()))
+    try:
+        return int(out.split('\t')[2].rstrip('%'))
+    except (IndexError, ValueError):
+        # '-' without spacemap_histogram feature
+        return None
+
+
+# dataset properties managed per storage_type, set in [zfs] section by
+# <storage_type>_<property> options, e.g. object_recordsize = 1M, other
+# properties are left as the operator set them
+PROFILE_PROPERTIES = ('recordsize', 'logbias', 'primarycache', 'atime',
+                      'sync', 'xattr')
+# applied with default_profile = yes: account and container servers do
+# small random SQLite I/O, object and chunk servers write large files
+# sequentially. Only properties every ZFS implementation accepts, e.g.
+# xattr=sa is ZFS on Linux only.
+DEFAULT_PROFILES = {
+    'account': {'recordsize': '16K', 'logbias': 'latency',
+                'primarycache': 'all', 'atime': 'off', 'sync': 'standard'},
+    'container': {'recordsize': '16K', 'logbias': 'latency',
+                  'primarycache': 'all', 'atime': 'off', 'sync': 'standard'},
+    'manifest': {'recordsize': '16K', 'logbias': 'latency',
+                 'primarycache': 'all', 'atime': 'off', 'sync': 'standard'},
+    'object': {'recordsize': '128K', 'logbias': 'throughput',
+               'primarycache': 'all', 'atime': 'off', 'sync': 'standard'},
+    'chunk': {'recordsize': '128K', 'logbias': 'throughput',
+              'primarycache': 'all', 'atime': 'off', 'sync': 'standard'},
+}
+
+
+# properties holding sizes
+SIZE_PROPERTIES = ('recordsize', 'volblocksize', 'quota', 'refquota',
+                   'reservation', 'refreservation')
+SIZE_SUFFIXES = dict((suffix, 1024 ** power)
+                     for power, suffix in enumerate('BKMGTPE'))
+
+
+def get_properties(fs, names):
+    """
+    Reads dataset properties.
+
+    :param fs: dataset name
+    :param names: property names
+    :returns: dict {<property>: <value>}
+    """
+    return dict((name, dataset.get(fs, name)) for name in names)
+
+
+def get_bulk_properties(datasets, names, timeout=None):
+    """
+    Reads properties of many datasets with one zfs get.
+
+    :param datasets: dataset names
+    :param names: property names
+    :param timeout: seconds to wait for zfs, see run_zfs
+    :returns: dict {<dataset>: {<property>: <value>}}
+    """
+    out = run_zfs('get', '-H', '-o', 'name,property,value', ','.join(names),
+                  *datasets, timeout=timeout)
+    props = dict((fs, {}) for fs in datasets)
+    for line in out.splitlines():
+        try:
+            fs, name, value = line.split('\t', 2)
+        except ValueError:
+            continue
+        props.setdefault(fs, {})[name] = value
+    return props
+
+
+def set_bulk_properties(fs, props, timeout=None):
+    """
+    Sets properties of dataset with one zfs set, falls back to setting them
+    one by one with ZFS versions which accept one property per call.
+
+    :param fs: dataset name
+    :param props: dict {<property>: <value>}
+    :param timeout: seconds to wait for each zfs, see run_zfs
+    """
+    args = ['%s=%s' % item for item in sorted(props.items())]
+    if len(args) > 1:
+        try:
+            run_zfs('set', *(args + [fs]), timeout=timeout)
+            return
+        except LFSTimeout:
+            raise
+        except LFSException:
+            pass
+    for arg in args:
+        run_zfs('set', arg, fs, timeout=timeout)
+
+
+def same_property(name, current, wanted):
+    """
+    Compares property values, sizes are compared by value, so 128K
+    matches 131072.
+    """
+    if current == wanted:
+        return True
+    if current is None or name not in SIZE_PROPERTIES:
+        return False
+    try:
+        return parse_size(current) == parse_size(wanted)
+    except ValueError:
+        return False
+
+
+def parse_size(value):
+    """
+    Parses ZFS size like 1024, 1.5K or 3T.
+
+    :param value: size as reported by ZFS
+    :returns: size in bytes
+    """
+    value = str(value).strip().upper()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(float(value or 0))
+
+
+def get_profile(conf, storage_type):
+    """
+    Returns dataset properties managed for storage_type: properties set
+    in the configuration, on top of DEFAULT_PROFILES with default_profile
+    on.
+
+    :param conf: ZFS configuration
+    :param storage_type: storage type of the server
+    :returns: dict {<property>: <value>}
+    """
+    profile = {}
+    if conf.get('default_profile', 'no').lower() in TRUE_VALUES:
+        profile.update(DEFAULT_PROFILES.get(storage_type, {}))
+    for name in PROFILE_PROPERTIES:
+        value = conf.get('%s_%s' % (storage_type, name))
+        if value:
+            profile[name] = value
+    return profile
+
+
 class LFSZFS(LFS):
 
     fs = 'zfs'
+    device_hooks = LFS.device_hooks + (
+        'swift.snapshot', 'swift.list_snapshots', 'swift.destroy_snapshot',
+        'swift.send_snapshot', 'swift.receive_snapshot',
+        'swift.partition_usage')
 
     def __init__(self, conf, ring, srvdir, default_port, logger):
         super(LFSZFS, self).__init__(conf, ring, srvdir, default_port, logger)
-        self.status_check_interval = int(conf.get('status_check_interval', 30))
         self.compression = conf.get('compression', 'off')
+        self.probe_timeout = float(conf.get('probe_timeout', 10))
+        self.profile = get_profile(conf, self.storage_type)
+        # every partition is a child dataset <device>/<datadir>/<partition>
+        self.partition_datasets = \
+            conf.get('partition_datasets', 'no').lower() in TRUE_VALUES
+        # receive_snapshot overwrites partitions with remote data, it is
+        # exported to the pipeline only when enabled explicitly
+        self.snapshot_receive = \
+            conf.get('snapshot_receive', 'no').lower() in TRUE_VALUES
+        # devices which datadir is ready for partition datasets
+        self.datadirs_ready = set()
+        # devices which datadir is a plain directory from before
+        # partition_datasets was on, partitions stay plain directories
+        self.plain_datadirs = set()
+        # tiers placed on datasets, <parent dataset>/<device> of each device
+        # is mounted below mountpoint of the parent,
+        # {'datadir' | 'tmp': <parent dataset>}
+        self.tier_datasets = dict((kind, root) for kind, root
+                                  in self.tier_roots.items()
+                                  if not root.startswith('/'))
+        if 'tmp' in self.tier_datasets and \
+                self.tier_datasets['tmp'] != self.tier_roots['datadir']:
+            # every dataset is a filesystem of its own, tmp can only share
+            # the device dataset of datadir
+            raise SwiftConfigurationError(
+                _('tmp tier %(tmp)s must be the datadir tier %(datadir)s') %
+                {'tmp': self.tier_datasets['tmp'],
+                 'datadir': self.tier_roots['datadir']})
+        if self.partition_datasets and \
+                self.tier_roots['datadir'] != self.devices and \
+                'datadir' not in self.tier_datasets:
+            self.logger.warning(_('partition_datasets needs datadir on the '
+                                  'device or on a tier dataset, disabled'))
+            self.partition_datasets = False
+        self.adaptive_compression = \
+            conf.get('adaptive_compression', 'no').lower() in TRUE_VALUES
+        self.compression_check_interval = int(
+            conf.get('compression_check_interval', 600))
+        self.compression_bounds = {
+            'min_level': conf.get('compression_min', 'off'),
+            'max_level': conf.get('compression_max', 'gzip-6'),
+            'ratio_low': float(conf.get('compression_ratio_low', 1.1)),
+            'ratio_high': float(conf.get('compression_ratio_high', 1.5)),
+            'cpu_low': float(conf.get('compression_cpu_low', 50)),
+            'cpu_high': float(conf.get('compression_cpu_high', 80)),
+            'hysteresis': int(conf.get('compression_hysteresis', 3)),
+            'probe_samples': int(conf.get('compression_probe_samples', 24)),
+            'min_written': parse_size(conf.get('compression_min_written',
+                                               '16M')),
+        }
+        # {<device name>: CompressionTuner}
+        self.compression_tuners = {}
+        # last decisions, reported by ?status&info
+        self.compression_decisions = []
+        self.cpu_meter = None
+        self.compression_checker = None
+        self.status_checker = self.create_status_checker(self.check_device)
 
-        self.mountpoint = os.path.join(self.devices, self.device)
-        self.filesystem = self.device
+    @property
+    def mountpoint(self):
+        return self.local_devices[self.device]['mountpoint']
 
-        self.status_checker = LFSStatus(
-            self.status_check_interval, self.logger, self.check_device)
+    @property
+    def filesystem(self):
+        # filesystem of a device is the pool named after the device
+        return self.device
+
+    def zfs_call(self, func, *args, **kwargs):
+        """
+        Calls nspyzfs function in a native thread with probe timeout.
+
+        :raises LFSTimeout: if ZFS didn't answer in probe_timeout seconds
+                            or an earlier call on the pool is still hung
+        """
+        if args and isinstance(args[0], basestring):
+            # probes are tracked per pool, first argument names a dataset
+            kwargs['key'] = args[0].split('/', 1)[0]
+        return call_in_thread(self.probe_timeout, func, *args, **kwargs)
 
     def setup_node(self):
         """
-        Creates filesystem for service and runs device status checker thread.
-        """
-        if not dataset.exists_fs(self.filesystem):
-            dataset.create_fs(self.filesystem, True,
-                              mountpoint=self.mountpoint, canmount='on',
-                              compression=self.compression)
-        if dataset.get(self.filesystem, 'mountpoint') != self.mountpoint:
-            dataset.set(self.filesystem, 'mountpoint', self.mountpoint)
-        if dataset.get(self.filesystem, 'mounted') != 'yes':
-            sys.exit("ERROR: Cannot mount %s" % self.filesystem)
-        if dataset.get(self.filesystem, 'compression') != self.compression:
-            dataset.set(self.filesystem, 'compression', self.compression)
+        Creates filesystems for service and runs device status checker thread.
+        """
+        super(LFSZFS, self).setup_node()
+        self.set_status_info('zfs_profile', {
+            'storage_type': self.storage_type,
+            'properties': self.profile})
         eventlet.spawn(self.status_checker)
+        if self.adaptive_compression and self.compression_check_interval > 0:
+            self.cpu_meter = CPUMeter()
+            self.compression_checker = LFSStatus(
+                self.compression_check_interval, self.logger,
+                self._leader_only(self.tune_compression))
+            eventlet.spawn(self.compression_checker)
 
-    def check_device(self):
+    def setup_device(self, device):
+        """
+        Creates and mounts filesystem of the device, see setup_devices.
+
+        :param device: device name
+        """
+        self.setup_devices([device])
+
+    def wanted_properties(self, device):
+        """
+        Returns properties managed by LFS for the device dataset.
+
+        :param device: device name
+        :returns: dict {<property>: <value>}
+        """
+        wanted = dict(self.profile,
+                      mountpoint=self.local_devices[device]['mountpoint'],
+                      compression=self.compression)
+        if self.adaptive_compression:
+            # compression is driven by tune_compression, which starts from
+            # the current value clamped to the configured bounds
+            del wanted['compression']
+        return wanted
+
+    def setup_devices(self, devices):
+        """
+        Creates and mounts filesystems of the devices, see reconcile_devices.
+        When the bulk reconcile of several devices fails or times out, e.g.
+        on a hung or faulted pool, the devices are reconciled one by one, so
+        one bad pool can't keep the others out of service.
+
+        :param devices: list of device names
+        """
+        self.resolve_tier_datasets()
+        try:
+            self.reconcile_devices(devices)
+        except LFSException, e:
+            if len(devices) < 2:
+                raise
+            self.logger.error(_('Reconcile of %(count)d devices failed, '
+                                'reconciling them one by one: %(error)s') %
+                              {'count': len(devices), 'error': e})
+            self.setup_each_device(devices)
+
+    def reconcile_devices(self, devices):
+        """
+        Creates and mounts filesystems of the devices and reconciles their
+        properties with the storage_type profile. Properties of all datasets
+        are read by one bulk query and the differences of each dataset are
+        written by one command. Duration is logged and sent to statsd as
+        zfs.reconcile.timing.
+
+        :param devices: list of device names
+        :raises LFSException: if zfs fails
+        :raises LFSTimeout: if zfs didn't finish in probe_timeout
+        """
+        start = time.time()
+        # {<dataset>: (<device name>, <wanted properties>)}
+        wanted = OrderedDict()
+        for device in devices:
+            wanted[device] = (device, self.wanted_properties(device))
+            for kind, parent in sorted(self.tier_datasets.items()):
+                fs = '%s/%s' % (parent, device)
+                if fs not in wanted:
+                    wanted[fs] = (device, dict(
+                        wanted[device][1], mountpoint=os.path.join(
+                            self.tier_roots[kind], device)))
+        for fs, (device, props) in wanted.items():
+            if not self.zfs_call(dataset.exists_fs, fs):
+                self.zfs_call(dataset.create_fs, fs, True, canmount='on',
+                              **props)
+        names = set(['mounted'])
+        for device, props in wanted.values():
+            names.update(props)
+        current = get_bulk_properties(wanted.keys(), sorted(names),
+                                      timeout=self.probe_timeout)
+        changed = 0
+        for fs, (device, props) in wanted.items():
+            changes = dict((name, value) for name, value in props.items()
+                           if not same_property(
+                               name, current[fs].get(name), value))
+            if changes:
+                changed += 1
+                self.logger.info(_('Setting %s properties on %s'),
+                                 ', '.join('%s=%s' % item for item
+                                           in sorted(changes.items())),
+                                 fs)
+                set_bulk_properties(fs, changes, timeout=self.probe_timeout)
+            if 'mountpoint' in changes:
+                self.invalidate_partition(device=device)
+                current[fs]['mounted'] = \
+                    self.zfs_call(dataset.get, fs, 'mounted')
+            if current[fs].get('mounted') != 'yes':
+                sys.exit("ERROR: Cannot mount %s" % fs)
+        for device in devices:
+            self.setup_tier(device)
+        elapsed = time.time() - start
+        self.logger.timing_since('zfs.reconcile.timing', start)
+        self.logger.info(_('Reconciled %(datasets)d datasets, changed '
+                           '%(changed)d in %(seconds).3fs') %
+                         {'datasets': len(wanted), 'changed': changed,
+                          'seconds': elapsed})
+        self.set_status_info('zfs_reconcile', {
+            'datasets': len(wanted), 'changed': changed,
+            'seconds': round(elapsed, 3)})
+
+    def resolve_tier_datasets(self):
+        """
+        Replaces dataset tiers in tier_roots with mountpoints of the
+        datasets, device datasets of the tier are mounted below them.
+
+        :raises LFSException: if tier dataset is not mounted
+        """
+        for kind, parent in self.tier_datasets.items():
+            if self.tier_roots[kind] != parent:
+                continue
+            if not self.zfs_call(dataset.exists_fs, parent):
+                raise LFSException(_('Tier dataset %s does not exist') %
+                                   parent)
+            root = self.zfs_call(dataset.get, parent, 'mountpoint')
+            if not root.startswith('/'):
+                raise LFSException(_('Tier dataset %(fs)s has mountpoint '
+                                     '%(root)s') % {'fs': parent,
+                                                    'root': root})
+            self.tier_roots[kind] = root
+
+    def get_tier_faults(self):
+        """
+        Adds pools of tier datasets to tier checks, all devices are
+        unavailable when a tier pool is faulted.
+        """
+        faults = super(LFSZFS, self).get_tier_faults()
+        for name in sorted(set(parent.split('/')[0]
+                               for parent in self.tier_datasets.values())):
+            try:
+                health = self.zfs_call(pool.status, name)['health']
+            except (NSPyZFSError, LFSTimeout), e:
+                self.logger.error(_("Can't get status for zfs pool %s: %s"),
+                                  name, e)
+                health = 'TIMEOUT'
+            if ZFS_HEALTH.get(health) in ('faulted', 'unavailable',
+                                          'timeout'):
+                faults.update(self.local_devices)
+        return faults
+
+    def device_dataset(self, device):
+        """
+        Returns dataset holding datadir of the device.
+
+        :param device: device name
+        """
+        parent = self.tier_datasets.get('datadir')
+        if parent:
+            return '%s/%s' % (parent, device)
+        return device
+
+    def sample_capacity(self, device):
+        """
+        Samples space of the device dataset, accounts for reservations and
+        quotas which statvfs doesn't see, and fragmentation of its pool.
+
+        :param device: device name
+        :returns: dict {'size': <bytes>, 'available': <bytes>,
+                        'used': <bytes>, 'fragmentation': <percent>}
+        """
+        if self.tier_roots['datadir'] != self.devices and \
+                'datadir' not in self.tier_datasets:
+            return super(LFSZFS, self).sample_capacity(device)
+        fs = self.device_dataset(device)
+        props = get_properties(fs, ('available', 'used'))
+        available = parse_size(props['available'])
+        used = parse_size(props['used'])
+        sample = {'size': available + used, 'available': available,
+                  'used': used}
         try:
-            status = pool.status(self.device)
-        except NSPyZFSError, e:
-            self.logger.exception(_("Can't get status for zfs pool %s"), e)
+            sample['fragmentation'] = \
+                get_pool_fragmentation(fs.split('/', 1)[0])
+        except (OSError, LFSException), e:
+            self.logger.warning(_('Cannot read fragmentation of %s: %s'),
+                                device, e)
+        return sample
+
+    def get_dataset(self, device=None, partition=None):
+        """
+        Returns dataset name of the device or of the partition.
+
+        :param device: device name, if None current device is used
+        :param partition: partition or None for the whole device
+        :returns: dataset name
+        :raises LFSException: if partition has no own dataset
+        """
+        device = device or self.device
+        if partition is None:
+            return device
+        if not self.partition_datasets:
+            raise LFSException(_('Partition %s of %s is not a dataset') %
+                               (partition, device))
+        return '%s/%s/%s' % (self.device_dataset(device), self.datadir,
+                             partition)
+
+    def setup_datadir(self, device=None):
+        """
+        Setup datadir, with partition_datasets datadir is a dataset
+        <device>/<datadir> mounted at devises/device/datadir
+
+        :param device: device name, if None current device is used
+        :returns: path to datadir
+        """
+        device = device or self.device
+        if not self.partition_datasets:
+            return super(LFSZFS, self).setup_datadir(device)
+        path = self.datadir_path(device)
+        if device in self.datadirs_ready:
+            return path
+        fs = '%s/%s' % (self.device_dataset(device), self.datadir)
+        if not self.zfs_call(dataset.exists_fs, fs):
+            if os.path.exists(path):
+                # existing plain directory from before partition_datasets
+                # was on is used as is
+                self.plain_datadirs.add(device)
+            else:
+                self.zfs_call(dataset.create_fs, fs, True, mountpoint=path,
+                              canmount='on')
+        self.datadirs_ready.add(device)
+        return path
+
+    def create_partition(self, partition, device):
+        """
+        Creates partition directory, with partition_datasets it's a child
+        dataset of datadir dataset. Partitions which are plain directories
+        already, and partitions in a plain datadir, are plain directories.
+
+        :param partition: partition
+        :param device: device name
+        :returns: path to partition directory
+        """
+        if not self.partition_datasets:
+            return super(LFSZFS, self).create_partition(partition, device)
+        path = os.path.join(self.setup_datadir(device), partition)
+        if device in self.plain_datadirs:
+            return super(LFSZFS, self).create_partition(partition, device)
+        fs = self.get_dataset(device, partition)
+        if not os.path.exists(path) and \
+                not self.zfs_call(dataset.exists_fs, fs):
+            self.zfs_call(dataset.create_fs, fs, True, mountpoint=path,
+                          canmount='on')
+        return path
+
+    def destroy_partition(self, partition, device=None):
+        """
+        Removes partition, partition dataset is destroyed at once instead of
+        unlinking its files one by one.
+
+        :param partition: partition
+        :param device: device name, if None current device is used
+        """
+        device = device or self.device
+        if self.partition_datasets:
+            fs = self.get_dataset(device, partition)
+            if self.zfs_call(dataset.exists_fs, fs):
+                self.invalidate_partition(partition, device)
+                run_zfs('destroy', '-r', fs)
+                return
+        super(LFSZFS, self).destroy_partition(partition, device)
+
+    def invalidate_partition(self, partition=None, device=None):
+        """
+        Forgets datadir of the device too when all its partitions are
+        dropped, it is set up again after the device is remounted.
+        """
+        super(LFSZFS, self).invalidate_partition(partition, device)
+        if partition is None:
+            device = device or self.device
+            self.datadirs_ready.discard(device)
+            self.plain_datadirs.discard(device)
+
+    def partition_usage(self, partition, device=None):
+        """
+        Returns space used by partition dataset.
+
+        :param partition: partition
+        :param device: device name, if None current device is used
+        :returns: bytes used or None if partition is not a dataset
+        """
+        if not self.partition_datasets:
             return None
+        fs = self.get_dataset(device, partition)
+        if not self.zfs_call(dataset.exists_fs, fs):
+            return None
+        return parse_size(self.zfs_call(dataset.get, fs, 'used'))
+
+    def _snapshot_name(self, fs, name):
+        if not name or not SNAPSHOT_NAME_RE.match(name):
+            raise LFSException(_('Invalid snapshot name: %s') % name)
+        return '%s@%s' % (fs, name)
+
+    def snapshot(self, name, device=None, partition=None):
+        """
+        Takes snapshot of the device or partition dataset.
+
+        :param name: snapshot name
+        :param device: device name, if None current device is used
+        :param partition: partition or None for the whole device
+        :returns: full snapshot name, <dataset>@<name>
+        """
+        snapshot = self._snapshot_name(
+            self.get_dataset(device, partition), name)
+        run_zfs('snapshot', snapshot)
+        return snapshot
+
+    def list_snapshots(self, device=None, partition=None):
+        """
+        Lists snapshots of the device or partition dataset, oldest first.
+
+        :param device: device name, if None current device is used
+        :param partition: partition or None for the whole device
+        :returns: list of snapshot names without dataset part
+        """
+        out = run_zfs('list', '-H', '-o', 'name', '-t', 'snapshot', '-s',
+                      'creation', '-d', '1',
+                      self.get_dataset(device, partition))
+        return [line.split('@', 1)[1] for line in out.splitlines()
+                if '@' in line]
+
+    def destroy_snapshot(self, name, device=None, partition=None):
+        """
+        Destroys snapshot of the device or partition dataset.
+
+        :param name: snapshot name
+        :param device: device name, if None current device is used
+        :param partition: partition or None for the whole device
+        """
+        run_zfs('destroy', self._snapshot_name(
+            self.get_dataset(device, partition), name))
+
+    def send_snapshot(self, name, base=None, device=None, partition=None,
+                      chunk_size=65536):
+        """
+        Streams snapshot, incremental from base snapshot if base is given.
+
+        :param name: snapshot name
+        :param base: older snapshot name or None for a full stream
+        :param device: device name, if None current device is used
+        :param partition: partition or None for the whole device
+        :param chunk_size: size of chunks to yield
+        :returns: iterator over zfs send stream
+        """
+        fs = self.get_dataset(device, partition)
+        args = ['send']
+        if base:
+            args.extend(['-i', self._snapshot_name(fs, base)])
+        args.append(self._snapshot_name(fs, name))
+        proc = popen_zfs(args, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+
+        def stream():
+            finished = False
+            try:
+                while True:
+                    chunk = proc.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                finished = True
+            finally:
+                if not finished and proc.poll() is None:
+                    proc.kill()
+                err = proc.stderr.read()
+                proc.wait()
+            if proc.returncode:
+                raise LFSException(_('zfs %s failed: %s') %
+                                   (' '.join(args), err.strip()))
+        return stream()
+
+    def receive_snapshot(self, stream, device=None, partition=None):
+        """
+        Receives zfs send stream into a partition dataset. A full stream
+        creates the dataset, an incremental one applies on top of its last
+        snapshot. Local changes are never rolled back and the device
+        dataset is never received into.
+
+        :param stream: iterable over zfs send stream
+        :param device: device name, if None current device is used
+        :param partition: partition
+        :raises LFSException: if partition is None, partition datasets are
+                              off or zfs receive fails
+        """
+        if partition is None:
+            raise LFSException(_('Snapshots are received into partition '
+                                 'datasets only'))
+        args = ['receive', self.get_dataset(device, partition)]
+        proc = popen_zfs(args, stdin=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+        # zfs blocks on a full stderr pipe while stdin is being written
+        stderr = eventlet.spawn(proc.stderr.read)
+        try:
+            for chunk in stream:
+                proc.stdin.write(chunk)
+            proc.stdin.close()
+        except Exception:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            stderr.wait()
+            raise
+        err = stderr.wait()
+        proc.wait()
+        if proc.returncode:
+            raise LFSException(_('zfs %s failed: %s') %
+                               (' '.join(args), err.strip()))
+        self.invalidate_partition(partition, device)
+
+    def tune_compression(self):
+        """
+        Samples space usage of every device and CPU usage, and switches
+        dataset compression when a tuner decides so.
+        """
+        cpu = self.cpu_meter.usage()
+        report = {}
+        for device in self.local_devices:
+            try:
+                props = self.zfs_call(get_properties, device,
+                                      ('compression', 'logicalused', 'used'))
+                current = props['compression']
+                tuner = self.compression_tuners.get(device)
+                if tuner is None:
+                    tuner = self.compression_tuners[device] = \
+                        CompressionTuner(current, **self.compression_bounds)
+                ratio = tuner.sample_usage(parse_size(props['logicalused']),
+                                           parse_size(props['used']), cpu)
+                if ratio is not None:
+                    ratio = round(ratio, 2)
+                if tuner.level != current:
+                    self.set_compression(device, current, tuner.level,
+                                         ratio, cpu)
+            except Exception:
+                self.logger.exception(
+                    _('Cannot tune compression of %s'), device)
+                continue
+            report[device] = {'compression': tuner.level,
+                              'compressratio': ratio}
+        self.set_status_info('compression', {
+            'cpu': round(cpu, 1), 'devices': report,
+            'decisions': list(self.compression_decisions)})
+        return None
+
+    def set_compression(self, device, old, new, ratio, cpu):
+        self.zfs_call(dataset.set, device, 'compression', new)
+        decision = {'device': device, 'from': old, 'to': new,
+                    'compressratio': ratio, 'cpu': round(cpu, 1),
+                    'time': time.time()}
+        self.compression_decisions = \
+            self.compression_decisions[-9:] + [decision]
+        self.logger.info(
+            _('Compression of %(device)s changed from %(from)s to %(to)s, '
+              'compressratio %(compressratio)s, cpu %(cpu)s%%') % decision)
+
+    def get_env_hooks(self, device=None):
+        hooks = super(LFSZFS, self).get_env_hooks()
+        hooks.update({
+            'swift.snapshot': self.snapshot,
+            'swift.list_snapshots': self.list_snapshots,
+            'swift.destroy_snapshot': self.destroy_snapshot,
+            'swift.send_snapshot': self.send_snapshot,
+            'swift.partition_usage': self.partition_usage,
+        })
+        if self.snapshot_receive:
+            hooks['swift.receive_snapshot'] = self.receive_snapshot
+        return self.bind_hooks(hooks, device)
+
+    def check_device(self):
+        """
+        Checks pools of all local devices in one pass.
+        """
         need_cb = False
-        self.remove_device_from_devices(self.device)
-        health = status['health']
-        if health == 'DEGRADED':
-            self.degraded_devices.add(self.device)
-            need_cb = True
-        elif health in ('FAULTED', 'SPLIT'):
-            self.faulted_devices.add(self.device)
-            need_cb = True
-        elif health == 'UNAVAIL':
-            self.unavailable_devices.add(self.device)
-            need_cb = True
-        elif health == 'UNKNOWN':
-            need_cb = True
+        for device in self.local_devices:
+            try:
+                health = self.zfs_call(pool.status, device)['health']
+            except NSPyZFSError, e:
+                self.logger.exception(
+                    _("Can't get status for zfs pool %s"), e)
+                continue
+            except LFSTimeout, e:
+                self.logger.error(_("Can't get status for zfs pool %s: %s"),
+                                  device, e)
+                health = 'TIMEOUT'
+            if self.set_device_status(device,
+                                      ZFS_HEALTH.get(health, 'online')):
+                # pool could be reimported or remounted, forget partitions
+                self.invalidate_partition(device=device)
+            if health in ZFS_HEALTH:
+                need_cb = True
         if need_cb:
             return self.error_callback, tuple()
         return None
@@ -93,3 +865,6 @@ class LFSZFS(LFS):
             self.logger.warning(
                 _("UNAVAILABLE pools: %s") %
                 ', '.join(self.unavailable_devices))
+        if self.timeout_devices:
+            self.logger.warning(
+                _("TIMED OUT pools: %s") % ', '.join(self.timeout_devices))
@@ -13,9 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 from urllib import unquote
 
-from swift.common.swob import Request, Response, HTTPBadRequest, HTTPNotFound
+from swift.common.swob import Request, Response, HTTPBadRequest, \
+    HTTPNotFound, HTTPNotModified, HTTPNoContent
 
 from swift.common.ring import Ring
 from swift.account.server import DATADIR as ACCOUNT_DATADIR
@@ -32,6 +34,11 @@ except ImportError:
     CHUNK_DATADIR = 'chunks'
 
 from swift_lfs.fs import get_lfs
+from swift_lfs.policy import DevicePolicy, request_device
+from swift_lfs.scheduler import IOScheduler
+from swift_lfs.stats import StatsCollector
+from swift_lfs.throttle import AccountThrottle
+from swift_lfs.utils import CloseCallback, CountingInput
 
 
 DATADIRS = {
@@ -51,6 +58,39 @@ DEFAULT_PORT = {
 }
 
 
+def chain_release(*funcs):
+    """
+    Combines release functions of admission steps into one.
+
+    :param funcs: release functions or None
+    :returns: function calling all funcs or None
+    """
+    funcs = [func for func in funcs if func]
+    if len(funcs) < 2:
+        return funcs[0] if funcs else None
+
+    def release():
+        for func in funcs:
+            func()
+    return release
+
+
+def has_query_param(query_string, name):
+    """
+    Checks the raw query string for a parameter without building a request
+
+    :param query_string: value of QUERY_STRING
+    :param name: parameter name
+    :returns: True if parameter is present
+    """
+    if not query_string or name not in query_string:
+        return False
+    for param in query_string.split('&'):
+        if param.split('=', 1)[0] == name:
+            return True
+    return False
+
+
 class LFSMiddleware(object):
 
     def __init__(self, app, conf):
@@ -67,6 +107,18 @@ class LFSMiddleware(object):
         self.storage = get_lfs(conf, ring, DATADIRS[storage_type],
                                DEFAULT_PORT[storage_type], logger)
         self.storage.setup_node()
+        self.policy = DevicePolicy(conf, self.storage)
+        self.account_throttle = AccountThrottle(conf, self.storage)
+        self.scheduler = IOScheduler(conf, self.storage)
+        # admission stages of requests to local devices, in order; requests
+        # waiting for account tokens must not hold device write slots
+        self.admission = (self.account_throttle, self.policy, self.scheduler)
+        self.stats = StatsCollector(storage_type)
+        self.env_hooks = self.storage.get_env_hooks()
+        # {<device name>: env hooks bound to the device}
+        self.device_env_hooks = {}
+        self.status_watch_timeout = float(conf.get('status_watch_timeout',
+                                                   60))
 
     def GET(self, request, storage):
         """
@@ -78,8 +130,16 @@ class LFSMiddleware(object):
         """
         devices = []
         dev_path = unquote(request.path)
+        storage.refresh_status()
+        if 'info' in request.GET:
+            self.account_throttle.publish()
+            return Response(request=request,
+                            body=storage.status_snapshot.info_body,
+                            content_type='application/json')
+        if 'watch' in request.GET:
+            return self.GET_watch(request, storage)
         if not dev_path or dev_path == '/':
-            devices = None
+            return self.GET_snapshot(request, storage.status_snapshot)
         else:
             devices.append(dev_path[1:])
         try:
@@ -95,17 +155,151 @@ class LFSMiddleware(object):
         return Response(request=request, body='\n'.join(out_content),
                         charset='utf-8', content_type='text/plain')
 
+    def GET_snapshot(self, request, snapshot):
+        """
+        Serves pre-rendered status of all devices
+
+        :param request: webob.Request object
+        :param snapshot: StatusSnapshot published by LFS
+        :returns : webob.Response class
+        """
+        if not snapshot.statuses:
+            return HTTPNotFound(request=request, content_type='text/plain')
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [etag.strip().strip('"')
+                     for etag in if_none_match.split(',')]
+            if '*' in etags or snapshot.etag in etags:
+                return HTTPNotModified(request=request, etag=snapshot.etag)
+        return Response(request=request, body=snapshot.body,
+                        etag=snapshot.etag, charset='utf-8',
+                        content_type='text/plain')
+
+    def GET_watch(self, request, storage):
+        """
+        Long-polls device status transitions. ?status&watch&since=<seq>
+        returns transitions published after seq as lines
+        "<seq> <device> <status>" as soon as there are any, or 204 when
+        timeout (?timeout, capped by status_watch_timeout) expires.
+        X-Status-Sequence carries the seq to pass as since next time and
+        X-Status-Epoch the epoch to pass as ?epoch. Sequences are node-wide
+        with shared_status, so any worker can serve the next request.
+        Without since the request waits for the next transition. When
+        transitions after since are no longer kept, since is ahead of the
+        current sequence or epoch differs, the response has
+        X-Status-Resync: true and lists current status of every device.
+
+        :param request: webob.Request object
+        :param storage: LFS storage class
+        :returns : webob.Response class
+        """
+        try:
+            since = int(request.GET.get('since', storage.status_sequence()))
+            timeout = min(float(request.GET.get('timeout',
+                                                self.status_watch_timeout)),
+                          self.status_watch_timeout)
+        except ValueError:
+            return HTTPBadRequest(request=request, content_type='text/plain',
+                                  body='since and timeout must be numbers')
+        epoch = request.GET.get('epoch', storage.status_epoch)
+        events = None
+        if epoch == storage.status_epoch:
+            events = storage.wait_status_events(since, max(timeout, 0))
+        headers = {'X-Status-Epoch': storage.status_epoch}
+        if events is None or epoch != storage.status_epoch:
+            headers['X-Status-Resync'] = 'true'
+            sequence = storage.status_sequence()
+            events = [(sequence, device, status) for device, status
+                      in sorted(storage.status_snapshot.statuses.items())]
+        if not events:
+            headers['X-Status-Sequence'] = str(since)
+            return HTTPNoContent(request=request, headers=headers)
+        headers['X-Status-Sequence'] = str(events[-1][0])
+        return Response(request=request, headers=headers,
+                        body=''.join('%d %s %s\n' % event
+                                     for event in events),
+                        charset='utf-8', content_type='text/plain')
+
+    def GET_stats(self, request):
+        """
+        Serves I/O statistics, ?stats for plain text, ?stats=json or
+        ?stats&format=json for JSON
+
+        :param request: webob.Request object
+        :returns : webob.Response class
+        """
+        if 'json' in (request.GET.get('stats'), request.GET.get('format')):
+            return Response(request=request, body=self.stats.render_json(),
+                            content_type='application/json')
+        return Response(request=request, body=self.stats.render_text(),
+                        charset='utf-8', content_type='text/plain')
+
+    def call_app(self, env, start_response, device=None, release=None):
+        """
+        Passes request to the app, timing it and counting bytes in and out.
+
+        :param device: local device name or None
+        :param release: function to call when request is finished
+        """
+        start = time.time()
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            bytes_in = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            bytes_in = 0
+        wsgi_input = None
+        if not bytes_in and 'wsgi.input' in env:
+            wsgi_input = env['wsgi.input'] = CountingInput(env['wsgi.input'])
+
+        def finish(bytes_out):
+            if release:
+                release()
+            error = not status or status[0][:1] == '5'
+            self.stats.record(
+                device, time.time() - start,
+                wsgi_input.bytes_in if wsgi_input else bytes_in, bytes_out,
+                error)
+
+        try:
+            app_iter = self.app(env, _start_response)
+        except Exception:
+            finish(0)
+            raise
+        return CloseCallback(app_iter, finish)
+
     def __call__(self, env, start_response):
         if env['REQUEST_METHOD'] == 'GET':
-            req = Request(env)
-            if 'status' in req.GET:
-                res = self.GET(req, self.storage)
+            query = env.get('QUERY_STRING')
+            if has_query_param(query, 'status'):
+                res = self.GET(Request(env), self.storage)
                 return res(env, start_response)
-        env['swift.storage'] = self.storage
-        env['swift.setup_datadir'] = self.storage.setup_datadir
-        env['swift.setup_tmp'] = self.storage.setup_tmp
-        env['swift.setup_partition'] = self.storage.setup_partition
-        return self.app(env, start_response)
+            if has_query_param(query, 'stats'):
+                return self.GET_stats(Request(env))(env, start_response)
+        device = request_device(env)
+        if device not in self.storage.local_devices:
+            env.update(self.env_hooks)
+            return self.call_app(env, start_response)
+        hooks = self.device_env_hooks.get(device)
+        if hooks is None:
+            hooks = self.device_env_hooks[device] = \
+                self.storage.get_env_hooks(device)
+        env.update(hooks)
+        releases = []
+        for stage in self.admission:
+            error, release = stage.admit(env, device)
+            if error:
+                release = chain_release(*releases)
+                if release:
+                    release()
+                return error(env, start_response)
+            releases.append(release)
+        return self.call_app(env, start_response, device,
+                             chain_release(*releases))
 
 
 def filter_factory(global_conf, **local_conf):
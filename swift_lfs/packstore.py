@@ -0,0 +1,537 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import errno
+import fcntl
+import struct
+from zlib import crc32
+
+import eventlet
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+
+from swift.common.utils import get_logger, mkdirs
+
+from swift_lfs.exceptions import LFSException
+
+
+# magic, flags, key length, data length, crc32 of the fields before it,
+# key and data
+RECORD = struct.Struct('<4sBHII')
+HEADER = struct.Struct('<4sBHI')
+CRC = struct.Struct('<I')
+# append counter at the start of the lock file
+COUNTER = struct.Struct('<Q')
+MAGIC = 'LFSP'
+FLAG_DELETE = 1
+SEGMENT_SUFFIX = '.pack'
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+
+def segment_name(segment):
+    return '%08d%s' % (segment, SEGMENT_SUFFIX)
+
+
+def record_crc(header, key, data):
+    return crc32(data, crc32(key, crc32(header[:HEADER.size]))) & 0xffffffff
+
+
+def pack_record(flags, key, data):
+    header = HEADER.pack(MAGIC, flags, len(key), len(data))
+    return ''.join((header, CRC.pack(record_crc(header, key, data)), key,
+                    data))
+
+
+def valid_record(buf, offset):
+    """
+    Checks that a complete record with matching crc starts at offset.
+    """
+    if offset + RECORD.size > len(buf):
+        return False
+    header = buf[offset:offset + RECORD.size]
+    magic, _flags, key_len, data_len, crc = RECORD.unpack(header)
+    start = offset + RECORD.size
+    end = start + key_len + data_len
+    if magic != MAGIC or end > len(buf):
+        return False
+    return record_crc(header, buf[start:start + key_len],
+                      buf[start + key_len:end]) == crc
+
+
+def next_record(buf, offset):
+    """
+    Finds the first valid record after offset.
+
+    :returns: offset of the record or None
+    """
+    pos = buf.find(MAGIC, offset + 1)
+    while pos != -1:
+        if valid_record(buf, pos):
+            return pos
+        pos = buf.find(MAGIC, pos + 1)
+    return None
+
+
+class PackStore(object):
+    """
+    Append-only store of small blobs, e.g. chunks of one partition, in a
+    few large segment files instead of a file per blob. Every record is
+    a header, the key and the data; a delete appends a tombstone. The
+    offset index is kept in memory and rebuilt from record headers of
+    mapped segments when the store is opened. Reads go through mmap of
+    the segment. A broken record is skipped up to the next valid one.
+
+    Workers of a node may share a store: appends are serialized by flock
+    on <path>/lock and bump a counter mapped from the lock file. Every
+    operation compares the counter with the one of the last scan and
+    scans records other workers appended only if it changed, so reads
+    make no syscalls. The lock file and maps are opened on use, so a
+    store closed by a cache eviction keeps working for the greenthreads
+    which still hold it. Waiting for the lock of another worker and fsync
+    run in a native thread, greenthreads of one worker are serialized by
+    a semaphore, as they share the flock.
+
+    Only the last segment is appended to, older segments never change
+    until compact rewrites their live records into the last segment and
+    removes them. A segment with a torn or corrupted record is sealed,
+    appends continue in the next one.
+
+    :param path: directory of the segments
+    :param segment_size: size after which a new segment is started
+    :param fsync: fsync every append
+    :param logger: logger of skipped records
+    """
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE, fsync=True,
+                 logger=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.logger = logger or get_logger({}, log_route='packstore')
+        mkdirs(path)
+        self.lock_fd = None
+        # map of the append counter, see _counter
+        self.counter = None
+        self.scanned_counter = None
+        # greenthreads holding or waiting for the lock
+        self.lockers = 0
+        self.mutex = Semaphore()
+        # closed stores release the lock file after every use
+        self.closed = False
+        self._reset()
+        self._sync()
+
+    def _reset(self):
+        # {<key>: (<segment>, <data offset>, <data length>, <record length>)}
+        self.index = {}
+        # {<segment>: {'size': <scanned bytes>, 'live': <live bytes>,
+        #              'end': <file size>, 'skipped': <skipped bytes>}}
+        self.segments = {}
+        self._close_maps()
+
+    def _close_maps(self):
+        for mm in getattr(self, 'maps', {}).values():
+            mm.close()
+        # {<segment>: mmap}
+        self.maps = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, segment_name(segment))
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(segments)
+
+    def _counter(self):
+        """
+        Returns map of the append counter in the lock file.
+        """
+        if self.counter is None:
+            fd = os.open(os.path.join(self.path, 'lock'),
+                         os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                if os.fstat(fd).st_size < COUNTER.size:
+                    os.ftruncate(fd, COUNTER.size)
+                self.counter = mmap.mmap(fd, COUNTER.size)
+            finally:
+                os.close(fd)
+        return self.counter
+
+    def _sync(self):
+        """
+        Scans records appended since the last scan if the append counter
+        changed.
+        """
+        counter = COUNTER.unpack_from(self._counter())[0]
+        if counter == self.scanned_counter:
+            return
+        # a scan while another greenthread appends would index its records
+        # twice
+        with self.mutex:
+            counter = COUNTER.unpack_from(self._counter())[0]
+            if counter != self.scanned_counter:
+                self.refresh()
+                self.scanned_counter = counter
+
+    def refresh(self):
+        """
+        Scans records appended since the last scan.
+        """
+        if not self.segments:
+            segments = self._list_segments()
+        else:
+            segments = [max(self.segments)]
+            while os.path.exists(self._segment_path(segments[-1] + 1)):
+                segments.append(segments[-1] + 1)
+        for segment in segments:
+            self._scan(segment, sealed=segment != segments[-1])
+
+    def _scan(self, segment, sealed=False):
+        """
+        Indexes records of the segment after the scanned offset. A record
+        with broken header is skipped up to the next valid record and the
+        skipped range is logged. Scan stops at a record which runs past the
+        end of the last segment, it may still be written by another worker.
+
+        :param segment: segment number
+        :param sealed: the segment is not the last one
+        """
+        info = self.segments.setdefault(
+            segment, {'size': 0, 'live': 0, 'end': 0, 'skipped': 0})
+        path = self._segment_path(segment)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            # removed by compaction in another worker
+            del self.segments[segment]
+            return
+        try:
+            size = os.fstat(fd).st_size
+            if size == info['size']:
+                info['end'] = size
+                return
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        old = self.maps.pop(segment, None)
+        if old is not None:
+            old.close()
+        self.maps[segment] = mm
+        offset = info['size']
+        while offset + RECORD.size <= size:
+            magic, flags, key_len, data_len, _crc = \
+                RECORD.unpack_from(mm, offset)
+            start = offset + RECORD.size
+            end = start + key_len + data_len
+            if magic != MAGIC or (sealed and end > size):
+                pos = next_record(mm, offset)
+                if pos is None:
+                    break
+                self.logger.error(
+                    _('Skipped corrupted bytes %(start)d-%(end)d in '
+                      '%(path)s') % {'start': offset, 'end': pos,
+                                     'path': path})
+                info['skipped'] += pos - offset
+                offset = pos
+                continue
+            if end > size:
+                break
+            self._apply(mm[start:start + key_len], flags, segment,
+                        start + key_len, data_len, end - offset)
+            offset = end
+        info['size'] = offset
+        info['end'] = size
+
+    def _apply(self, key, flags, segment, data_offset, data_len, record_len):
+        old = self.index.pop(key, None)
+        if old is not None and old[0] in self.segments:
+            self.segments[old[0]]['live'] -= old[3]
+        if flags & FLAG_DELETE:
+            return
+        self.index[key] = (segment, data_offset, data_len, record_len)
+        self.segments[segment]['live'] += record_len
+
+    def _lock(self):
+        self.lockers += 1
+        self.mutex.acquire()
+        try:
+            if self.lock_fd is None:
+                self.lock_fd = os.open(os.path.join(self.path, 'lock'),
+                                       os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, err:
+                if err.errno != errno.EWOULDBLOCK:
+                    raise
+                # held by another worker
+                tpool.execute(fcntl.flock, self.lock_fd, fcntl.LOCK_EX)
+        except Exception:
+            self.mutex.release()
+            self._release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        finally:
+            self.mutex.release()
+            self._release()
+
+    def _release(self):
+        self.lockers -= 1
+        if self.closed and not self.lockers:
+            self._close_lock()
+
+    def _close_lock(self):
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def _append(self, records):
+        """
+        Appends records to the last segment. A segment which ends with a
+        torn record or has corrupted ones is sealed, records are appended
+        to the next one, so valid records are never truncated and maps of
+        other workers never shrink.
+
+        :param records: list of (<key>, <data>, <flags>, <expected entry>),
+                        record is skipped if expected entry is not None
+                        and the index entry of the key differs from it
+        :returns: number of appended records
+        """
+        self._lock()
+        try:
+            self.refresh()
+            segment = max(self.segments) if self.segments else 0
+            info = self.segments.get(segment)
+            offset = info['size'] if info else 0
+            if info and (offset >= self.segment_size or
+                         info['end'] > offset or info['skipped']):
+                segment += 1
+                offset = 0
+            fd = os.open(self._segment_path(segment),
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+            try:
+                chunks = []
+                applied = []
+                for key, data, flags, expected in records:
+                    if expected is not None and \
+                            self.index.get(key) != expected:
+                        continue
+                    chunks.append(pack_record(flags, key, data))
+                    record_len = RECORD.size + len(key) + len(data)
+                    applied.append((key, flags, offset + RECORD.size +
+                                    len(key), len(data), record_len))
+                    offset += record_len
+                buf = ''.join(chunks)
+                while buf:
+                    buf = buf[os.write(fd, buf):]
+                if applied and self.fsync:
+                    tpool.execute(os.fsync, fd)
+            finally:
+                os.close(fd)
+            self.segments.setdefault(
+                segment, {'size': 0, 'live': 0, 'end': 0, 'skipped': 0})
+            for key, flags, data_offset, data_len, record_len in applied:
+                self._apply(key, flags, segment, data_offset, data_len,
+                            record_len)
+            self.segments[segment]['size'] = offset
+            self.segments[segment]['end'] = offset
+            if applied:
+                # records of other workers were scanned by refresh above
+                counter = self._counter()
+                self.scanned_counter = COUNTER.unpack_from(counter)[0] + 1
+                COUNTER.pack_into(counter, 0, self.scanned_counter)
+            return len(applied)
+        finally:
+            self._unlock()
+
+    def _map(self, segment, need):
+        mm = self.maps.get(segment)
+        if mm is None or len(mm) < need:
+            if mm is not None:
+                mm.close()
+            fd = os.open(self._segment_path(segment), os.O_RDONLY)
+            try:
+                mm = self.maps[segment] = mmap.mmap(fd, 0,
+                                                    access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        return mm
+
+    def _read(self, key, entry):
+        segment, data_offset, data_len, _record_len = entry
+        mm = self._map(segment, data_offset + data_len)
+        header = mm[data_offset - len(key) - RECORD.size:
+                    data_offset - len(key)]
+        data = mm[data_offset:data_offset + data_len]
+        if record_crc(header, key, data) != RECORD.unpack(header)[4]:
+            raise LFSException(_('Corrupted record %(key)s in %(path)s') %
+                               {'key': key,
+                                'path': self._segment_path(segment)})
+        return data
+
+    def get(self, key):
+        """
+        Reads data of the key.
+
+        :param key: key
+        :returns: data or None if there is no such key
+        :raises LFSException: if the record is corrupted
+        """
+        self._sync()
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        try:
+            return self._read(key, entry)
+        except (OSError, IOError), err:
+            if err.errno != errno.ENOENT:
+                raise
+        # segment was compacted by another worker
+        with self.mutex:
+            self._reset()
+            self.refresh()
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        return self._read(key, entry)
+
+    def put(self, key, data):
+        """
+        Stores data of the key, replaces older data.
+
+        :param key: key, up to 65535 bytes
+        :param data: data
+        """
+        self._append([(key, data, 0, None)])
+
+    def delete(self, key):
+        """
+        Deletes the key.
+
+        :param key: key
+        :returns: True if the key existed
+        """
+        self._sync()
+        if key not in self.index:
+            return False
+        self._append([(key, '', FLAG_DELETE, None)])
+        return True
+
+    def __contains__(self, key):
+        self._sync()
+        return key in self.index
+
+    def __len__(self):
+        self._sync()
+        return len(self.index)
+
+    def keys(self):
+        self._sync()
+        return self.index.keys()
+
+    def garbage(self, segment):
+        """
+        Returns fraction of the segment taken by replaced and deleted
+        records.
+        """
+        info = self.segments[segment]
+        if not info['size']:
+            return 0.0
+        return 1.0 - float(info['live']) / info['size']
+
+    def compact(self, min_garbage=0.5, batch=64):
+        """
+        Rewrites live records of old segments into the last segment and
+        removes the old segments. The oldest segments up to the newest one
+        with at least min_garbage are compacted together, so tombstones in
+        them can be dropped. Records are copied in batches, other
+        greenthreads and workers keep reading and writing meanwhile.
+
+        :param min_garbage: garbage fraction which makes a segment worth
+                            compacting
+        :param batch: records copied under one lock
+        :returns: number of removed segments
+        """
+        self._sync()
+        sealed = sorted(self.segments)[:-1]
+        candidates = [segment for segment in sealed
+                      if self.garbage(segment) >= min_garbage]
+        if not candidates:
+            return 0
+        compacted = set(segment for segment in sealed
+                        if segment <= candidates[-1])
+        keys = [key for key, entry in self.index.items()
+                if entry[0] in compacted]
+        for start in xrange(0, len(keys), batch):
+            records = []
+            for key in keys[start:start + batch]:
+                entry = self.index.get(key)
+                if entry is not None and entry[0] in compacted:
+                    records.append((key, self._read(key, entry), 0, entry))
+            if records:
+                self._append(records)
+            eventlet.sleep(0)
+        self._lock()
+        try:
+            self.refresh()
+            if any(entry[0] in compacted for entry in self.index.values()):
+                return 0
+            for segment in compacted:
+                mm = self.maps.pop(segment, None)
+                if mm is not None:
+                    mm.close()
+                self.segments.pop(segment, None)
+                try:
+                    os.unlink(self._segment_path(segment))
+                except OSError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+        finally:
+            self._unlock()
+        return len(compacted)
+
+    def stats(self):
+        self._sync()
+        return {'keys': len(self.index),
+                'segments': len(self.segments),
+                'bytes': sum(info['size'] for info in self.segments.values()),
+                'live_bytes': sum(info['live']
+                                  for info in self.segments.values())}
+
+    def close(self):
+        """
+        Releases maps and the lock file. The lock file of a store locked by
+        another greenthread is closed when the lock is released. A closed
+        store still works, it opens the lock file for every append.
+        """
+        self._close_maps()
+        if self.counter is not None:
+            self.counter.close()
+            self.counter = None
+        self.closed = True
+        if not self.lockers:
+            self._close_lock()
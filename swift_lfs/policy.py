@@ -0,0 +1,124 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+
+from swift.common.swob import HTTPInsufficientStorage, HTTPServiceUnavailable
+
+from swift_lfs.utils import list_from_csv
+
+
+WRITE_METHODS = ('PUT', 'POST', 'DELETE')
+
+# default number of writes in flight per device status, negative means
+# unlimited and 0 rejects all writes
+DEFAULT_MAX_WRITES = {
+    'online': -1,
+    'degraded': 8,
+    'timeout': 0,
+}
+
+
+def request_device(env):
+    """
+    Returns device name from storage server path /device/partition/...
+
+    :param env: WSGI environment
+    :returns: device name or None
+    """
+    path = env.get('PATH_INFO', '')
+    if not path.startswith('/'):
+        return None
+    return path[1:].split('/', 1)[0] or None
+
+
+def request_account(env):
+    """
+    Returns account from storage server path /device/partition/account/...
+
+    :param env: WSGI environment
+    :returns: account name or None
+    """
+    parts = env.get('PATH_INFO', '').split('/', 4)
+    if len(parts) < 4 or not parts[3]:
+        return None
+    return parts[3]
+
+
+class DevicePolicy(object):
+    """
+    Health and capacity aware admission of requests to local devices.
+    Requests to devices with a rejected status fail fast with 507, writes to
+    devices with a limited status are rejected with 503 once the limit of
+    writes in flight is reached. PUTs to full devices fail with 507 and PUTs
+    to nearly full devices are limited like writes to degraded devices.
+    Clients can retry on another replica right away.
+
+    :param conf: middleware configuration
+    :param storage: LFS storage class
+    """
+
+    def __init__(self, conf, storage):
+        self.storage = storage
+        self.reject_statuses = set(list_from_csv(
+            conf.get('reject_statuses', 'faulted, unavailable')))
+        self.max_writes = {}
+        for status, default in DEFAULT_MAX_WRITES.items():
+            self.max_writes[status] = int(
+                conf.get('%s_max_writes' % status, default))
+        self.nearfull_max_writes = int(conf.get('nearfull_max_writes', 4))
+        # {<device name>: <writes in flight>}
+        self.writes = defaultdict(int)
+
+    def admit(self, env, device):
+        """
+        Decides whether request may go to the device.
+
+        :param env: WSGI environment
+        :param device: local device name
+        :returns: tuple (<error response or None>, <release function or None>)
+                  release function must be called when admitted request
+                  is finished
+        """
+        status = self.storage.status_snapshot.statuses.get(device, 'online')
+        if status in self.reject_statuses:
+            return HTTPInsufficientStorage(
+                body='%s is %s' % (device, status),
+                content_type='text/plain'), None
+        method = env['REQUEST_METHOD']
+        if method not in WRITE_METHODS:
+            return None, None
+        limits = [(self.max_writes.get(status, -1), status)]
+        if method == 'PUT':
+            fill = self.storage.fill_states.get(device)
+            if fill == 'full':
+                return HTTPInsufficientStorage(
+                    body='%s is full' % device,
+                    content_type='text/plain'), None
+            if fill == 'nearfull':
+                limits.append((self.nearfull_max_writes, fill))
+        limits = [limit for limit in limits if limit[0] >= 0]
+        if not limits:
+            return None, None
+        limit, reason = min(limits)
+        if self.writes[device] >= limit:
+            return HTTPServiceUnavailable(
+                body='%s is %s, too many writes' % (device, reason),
+                content_type='text/plain'), None
+        self.writes[device] += 1
+
+        def release():
+            self.writes[device] -= 1
+        return None, release
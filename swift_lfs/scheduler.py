@@ -0,0 +1,210 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import deque
+
+from eventlet import Timeout
+from eventlet.event import Event
+
+from swift.common.swob import HTTPServiceUnavailable
+
+from swift_lfs.utils import list_from_csv
+
+
+IO_CLASSES = ('client', 'background')
+
+DEFAULT_BACKGROUND_USER_AGENTS = \
+    'object-replicator, object-updater, obj-replicator, obj-updater, ' \
+    'container-replicator, container-updater, object-auditor'
+
+# weight of the latest sample in the client queue wait average
+LATENCY_DECAY = 0.2
+
+
+class DeviceQueue(object):
+    """
+    Concurrency slots of one device shared by I/O classes. Requests which
+    can't run right away wait in a queue per class, freed slots are handed
+    to the waiting class with the lowest pass, every grant advances the
+    pass of the class by 1 / weight (stride scheduling), so under load
+    classes get slots in proportion to their weights.
+
+    :param slots: requests running on the device at once
+    :param weights: dict {<I/O class>: <weight>}
+    """
+
+    def __init__(self, slots, weights):
+        self.slots = slots
+        self.weights = weights
+        # background requests running at once, adjusted by IOScheduler
+        self.background_slots = slots
+        self.running = dict((io_class, 0) for io_class in IO_CLASSES)
+        self.waiting = dict((io_class, deque()) for io_class in IO_CLASSES)
+        self.passes = dict((io_class, 0.0) for io_class in IO_CLASSES)
+        self.vtime = 0.0
+        # moving average of seconds client requests wait for a slot, time
+        # spent streaming to a slow client doesn't count
+        self.latency = None
+
+    def runnable(self, io_class):
+        if sum(self.running.values()) >= self.slots:
+            return False
+        if io_class == 'background':
+            return self.running[io_class] < self.background_slots
+        return True
+
+    def _grant(self, io_class):
+        self.running[io_class] += 1
+        self.vtime = self.passes[io_class]
+        self.passes[io_class] += 1.0 / self.weights[io_class]
+
+    def acquire(self, io_class, timeout):
+        """
+        Waits for a slot.
+
+        :param io_class: one of IO_CLASSES
+        :param timeout: seconds to wait in the queue
+        :returns: True if the slot was granted, release it with release
+        """
+        queue = self.waiting[io_class]
+        if not queue:
+            if self.runnable(io_class):
+                self._grant(io_class)
+                return True
+            # idle class doesn't collect credit for the time it was idle
+            self.passes[io_class] = max(self.passes[io_class], self.vtime)
+        event = Event()
+        queue.append(event)
+        with Timeout(timeout, False):
+            event.wait()
+        if event.ready():
+            return True
+        queue.remove(event)
+        return False
+
+    def release(self, io_class):
+        self.running[io_class] -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Hands free slots to waiting requests.
+        """
+        while True:
+            ready = [io_class for io_class in IO_CLASSES
+                     if self.waiting[io_class] and self.runnable(io_class)]
+            if not ready:
+                return
+            io_class = min(ready, key=self.passes.get)
+            self._grant(io_class)
+            self.waiting[io_class].popleft().send()
+
+    def add_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * LATENCY_DECAY
+
+
+class IOScheduler(object):
+    """
+    Prioritizes client requests over background traffic of replicators,
+    updaters and auditors on local devices. Each device runs at most
+    device_slots requests at once, waiting requests are served in
+    proportion to client_weight and background_weight. Background requests
+    use at most background_slots, halved when the device is not online and
+    halved again when client requests wait for a slot of the device longer
+    than client_latency_target on average, but never less than one slot, so
+    replication keeps going. Requests waiting longer than queue_timeout get
+    503. Disabled unless device_slots is set.
+
+    :param conf: middleware configuration
+    :param storage: LFS storage class
+    """
+
+    def __init__(self, conf, storage):
+        self.storage = storage
+        self.device_slots = int(conf.get('device_slots', 0))
+        self.weights = {
+            'client': float(conf.get('client_weight', 4)),
+            'background': float(conf.get('background_weight', 1))}
+        self.background_slots = int(conf.get(
+            'background_slots', max(self.device_slots / 2, 1)))
+        self.background_user_agents = tuple(list_from_csv(
+            conf.get('background_user_agents',
+                     DEFAULT_BACKGROUND_USER_AGENTS)))
+        self.client_latency_target = float(
+            conf.get('client_latency_target', 0.25))
+        self.queue_timeout = float(conf.get('queue_timeout', 10))
+        # {<device name>: DeviceQueue}
+        self.devices = {}
+
+    def classify(self, env):
+        """
+        Returns I/O class of the request.
+
+        :param env: WSGI environment
+        :returns: one of IO_CLASSES
+        """
+        if env['REQUEST_METHOD'] == 'REPLICATE':
+            return 'background'
+        if env.get('HTTP_USER_AGENT', '').startswith(
+                self.background_user_agents):
+            return 'background'
+        return 'client'
+
+    def background_limit(self, device, queue):
+        limit = self.background_slots
+        if self.storage.status_snapshot.statuses.get(device,
+                                                     'online') != 'online':
+            limit /= 2
+        if queue.latency is not None and \
+                queue.latency > self.client_latency_target:
+            limit /= 2
+        return max(limit, 1)
+
+    def admit(self, env, device):
+        """
+        Waits for a slot of the device.
+
+        :param env: WSGI environment
+        :param device: local device name
+        :returns: tuple (<error response or None>, <release function or None>)
+                  release function must be called when admitted request
+                  is finished
+        """
+        if self.device_slots <= 0:
+            return None, None
+        queue = self.devices.get(device)
+        if queue is None:
+            queue = self.devices[device] = DeviceQueue(self.device_slots,
+                                                       self.weights)
+        limit = self.background_limit(device, queue)
+        if limit != queue.background_slots:
+            queue.background_slots = limit
+            queue.dispatch()
+        io_class = self.classify(env)
+        start = time.time()
+        granted = queue.acquire(io_class, self.queue_timeout)
+        if io_class == 'client':
+            queue.add_latency(time.time() - start)
+        if not granted:
+            return HTTPServiceUnavailable(
+                body='%s is busy' % device, content_type='text/plain'), None
+
+        def release():
+            queue.release(io_class)
+        return None, release
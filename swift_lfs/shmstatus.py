@@ -0,0 +1,124 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import fcntl
+import struct
+
+from swift.common.utils import mkdirs
+
+from swift_lfs.exceptions import LFSException
+
+
+# sequence, payload length
+HEADER = struct.Struct('<QI')
+DEFAULT_SIZE = 65536
+
+
+class SharedStatus(object):
+    """
+    Device status shared by all workers of a node through a small mmap'd
+    file. One process, the leader, writes the segment, the others only read
+    it. Writes are guarded by a sequence lock: the writer makes the sequence
+    odd, copies the payload and makes it even again, a reader retries until
+    it sees the same even sequence before and after copying the payload, so
+    readers never take a lock.
+
+    The leader is elected by a POSIX record lock on <path>.lock. The lock
+    belongs to the process, so it is released when the leader dies and is
+    never inherited by forked workers.
+
+    :param path: path of the segment file
+    :param size: size of the segment in bytes
+    """
+
+    def __init__(self, path, size=DEFAULT_SIZE):
+        self.path = path
+        self.size = size
+        mkdirs(os.path.dirname(path))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.lock_fd = None
+        self.leader_pid = None
+
+    @property
+    def leader(self):
+        return self.leader_pid == os.getpid()
+
+    def elect(self):
+        """
+        Tries to become the leader.
+
+        :returns: True if this process is the leader
+        """
+        if self.leader:
+            return True
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.path + '.lock',
+                                   os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        self.leader_pid = os.getpid()
+        return True
+
+    def sequence(self):
+        """
+        Returns current sequence, cheap check whether the payload changed.
+        """
+        return HEADER.unpack_from(self.mm, 0)[0]
+
+    def write(self, payload):
+        """
+        Publishes the payload, only the leader may call it.
+
+        :param payload: string
+        :returns: new sequence
+        """
+        if len(payload) > self.size - HEADER.size:
+            raise LFSException(_('Status payload of %d bytes does not fit '
+                                 'into %s') % (len(payload), self.path))
+        seq = self.sequence()
+        if seq & 1:
+            # previous leader died in the middle of a write
+            seq += 1
+        HEADER.pack_into(self.mm, 0, seq + 1, len(payload))
+        self.mm[HEADER.size:HEADER.size + len(payload)] = payload
+        HEADER.pack_into(self.mm, 0, seq + 2, len(payload))
+        return seq + 2
+
+    def read(self, retries=100):
+        """
+        Reads a consistent copy of the payload.
+
+        :param retries: attempts while the leader is writing
+        :returns: tuple (<sequence>, <payload>) or None if nothing was
+                  written yet or the segment kept changing
+        """
+        for _junk in xrange(retries):
+            seq, length = HEADER.unpack_from(self.mm, 0)
+            if seq & 1:
+                continue
+            payload = self.mm[HEADER.size:HEADER.size + length]
+            if self.sequence() == seq:
+                return (seq, payload) if seq else None
+        return None
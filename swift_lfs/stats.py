@@ -0,0 +1,154 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+# upper bounds of latency histogram buckets in seconds, the last bucket
+# counts everything slower
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+# latency percentiles reported as latency_p<percent>
+LATENCY_PERCENTILES = (50, 99)
+
+
+class IOStats(object):
+    """
+    Fixed size request counters and latency histogram.
+    """
+
+    __slots__ = ('requests', 'errors', 'bytes_in', 'bytes_out',
+                 'latency_sum', 'histogram')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_sum = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, latency, bytes_in, bytes_out, error):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.latency_sum += latency
+        self.histogram[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def percentile(self, fraction):
+        """
+        Returns upper bound of the bucket holding given fraction of requests
+
+        :param fraction: 0..1
+        :returns: seconds, None if there were no requests or the percentile
+                  is slower than the last bucket
+        """
+        if not self.requests:
+            return None
+        need = self.requests * fraction
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= need:
+                break
+        if i < len(LATENCY_BUCKETS):
+            return LATENCY_BUCKETS[i]
+        return None
+
+    def to_dict(self):
+        if self.requests:
+            latency_avg = self.latency_sum / self.requests
+        else:
+            latency_avg = 0.0
+        buckets = [str(bound) for bound in LATENCY_BUCKETS] + ['inf']
+        values = {'requests': self.requests,
+                  'errors': self.errors,
+                  'bytes_in': self.bytes_in,
+                  'bytes_out': self.bytes_out,
+                  'latency_avg': latency_avg,
+                  'latency_histogram': dict(zip(buckets, self.histogram))}
+        for percent in LATENCY_PERCENTILES:
+            values['latency_p%d' % percent] = self.percentile(percent / 100.0)
+        return values
+
+
+class StatsCollector(object):
+    """
+    Per device and per storage type I/O statistics of a storage server.
+
+    :param storage_type: storage type of the server
+    """
+
+    def __init__(self, storage_type):
+        self.storage_type = storage_type
+        self.total = IOStats()
+        # {<device name>: IOStats}
+        self.devices = {}
+
+    def record(self, device, latency, bytes_in, bytes_out, error):
+        """
+        Accounts finished request.
+
+        :param device: local device name or None
+        :param latency: request duration in seconds
+        :param bytes_in: bytes received
+        :param bytes_out: bytes sent
+        :param error: True if request failed with server error
+        """
+        self.total.add(latency, bytes_in, bytes_out, error)
+        if device:
+            stats = self.devices.get(device)
+            if stats is None:
+                stats = self.devices[device] = IOStats()
+            stats.add(latency, bytes_in, bytes_out, error)
+
+    def to_dict(self):
+        return {'storage_type': self.storage_type,
+                'total': self.total.to_dict(),
+                'devices': dict((device, stats.to_dict())
+                                for device, stats in self.devices.items())}
+
+    def render_json(self):
+        return json.dumps(self.to_dict())
+
+    def render_text(self):
+        lines = []
+        items = [(self.storage_type, self.total)] + sorted(
+            self.devices.items())
+        for name, stats in items:
+            values = stats.to_dict()
+            fields = ['%s=%s' % (key, values[key])
+                      for key in ('requests', 'errors', 'bytes_in',
+                                  'bytes_out')]
+            fields.append('latency_avg=%.6f' % values['latency_avg'])
+            for percent in LATENCY_PERCENTILES:
+                # unknown without requests or beyond the last bucket
+                value = values['latency_p%d' % percent]
+                fields.append('latency_p%d=%s' % (
+                    percent, '-' if value is None else value))
+            fields.extend('latency_le_%s=%d' % (bound, count) for bound, count
+                          in zip(LATENCY_BUCKETS, stats.histogram))
+            fields.append('latency_gt_%s=%d' % (LATENCY_BUCKETS[-1],
+                                                stats.histogram[-1]))
+            lines.append('%s %s' % (name, ' '.join(fields)))
+        return '\n'.join(lines)
@@ -0,0 +1,102 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import defaultdict
+
+import eventlet
+
+from swift.common.swob import HTTPServiceUnavailable
+
+from swift_lfs.policy import request_account
+from swift_lfs.utils import LRUCache
+
+
+class AccountThrottle(object):
+    """
+    Per account token buckets on each local device. Every account may send
+    account_rate requests per second to a device with bursts up to
+    account_burst. A request over the rate borrows a future token and
+    waits until the token is due, so requests of one account queue behind
+    each other without holding back other accounts. Requests which would
+    wait longer than account_max_wait get 503 and the client retries on
+    another replica. Buckets live in an LRU cache of account_cache_size
+    entries, an evicted account starts again with a full bucket. Disabled
+    unless account_rate is set.
+
+    :param conf: middleware configuration
+    :param storage: LFS storage class
+    :param clock: function returning current time in seconds
+    :param sleep: function waiting given number of seconds
+    """
+
+    def __init__(self, conf, storage, clock=time.time, sleep=eventlet.sleep):
+        self.storage = storage
+        self.clock = clock
+        self.sleep = sleep
+        self.rate = float(conf.get('account_rate', 0))
+        self.burst = float(conf.get('account_burst', max(self.rate, 1)))
+        self.max_wait = float(conf.get('account_max_wait', 1))
+        # {(<device name>, <account>): [<tokens>, <last update>]}
+        self.buckets = LRUCache(int(conf.get('account_cache_size', 100000)))
+        # {<device name>: {'queued': .., 'throttled': ..}}
+        self.counters = defaultdict(lambda: {'queued': 0, 'throttled': 0})
+
+    def admit(self, env, device):
+        """
+        Waits until the account of the request may use the device.
+
+        :param env: WSGI environment
+        :param device: local device name
+        :returns: tuple (<error response or None>, None)
+        """
+        if self.rate <= 0:
+            return None, None
+        account = request_account(env)
+        if account is None:
+            return None, None
+        key = (device, account)
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self.buckets.set(key, bucket)
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return None, None
+        wait = (1 - tokens) / self.rate
+        if wait > self.max_wait:
+            bucket[0] = tokens
+            self.counters[device]['throttled'] += 1
+            return HTTPServiceUnavailable(
+                body='Too many requests for %s on %s' % (account, device),
+                content_type='text/plain'), None
+        bucket[0] = tokens - 1
+        self.counters[device]['queued'] += 1
+        self.sleep(wait)
+        return None, None
+
+    def publish(self):
+        """
+        Reports counters through ?status&info.
+        """
+        if self.rate <= 0:
+            return
+        self.storage.set_status_info('account_throttle', {
+            'accounts': len(self.buckets),
+            'devices': dict((device, dict(counters)) for device, counters
+                            in self.counters.items())})
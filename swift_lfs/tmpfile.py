@@ -0,0 +1,158 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import time
+import errno
+from collections import deque
+from tempfile import mkstemp
+
+import eventlet
+
+from swift.common.utils import fallocate
+
+
+POOL_PREFIX = 'lfs-'
+
+
+def pool_prefix(pid=None):
+    return '%s%d-' % (POOL_PREFIX, pid or os.getpid())
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class TmpFilePool(object):
+    """
+    Pool of pre-created temporary files in tmp directory of one device.
+    Files are named lfs-<pid>-*, so files of a crashed worker can be told
+    apart from files of live workers.
+
+    :param tmpdir: tmp directory of the device
+    :param size: number of files kept ready
+    :param logger: logger object
+    :param preallocate: fallocate files when expected size is known
+    """
+
+    def __init__(self, tmpdir, size, logger, preallocate=False):
+        self.tmpdir = tmpdir
+        self.size = size
+        self.logger = logger
+        self.preallocate = preallocate
+        self.files = deque()
+        self.filling = False
+
+    def _create(self):
+        return mkstemp(dir=self.tmpdir, prefix=pool_prefix())
+
+    def fill(self):
+        """
+        Creates files until the pool is full.
+        """
+        try:
+            while len(self.files) < self.size:
+                self.files.append(self._create())
+                # let requests run between file creations
+                eventlet.sleep(0)
+        except OSError:
+            self.logger.exception(_('Cannot fill tmp pool in %s'),
+                                  self.tmpdir)
+        finally:
+            self.filling = False
+
+    def get(self, size=None):
+        """
+        Hands out a temporary file. The caller owns the file and must
+        rename or unlink it.
+
+        :param size: expected file size or None
+        :returns: tuple (<fd>, <path>)
+        """
+        try:
+            fd, path = self.files.popleft()
+        except IndexError:
+            fd, path = self._create()
+        if self.size and not self.filling and \
+                len(self.files) <= self.size / 2:
+            self.filling = True
+            eventlet.spawn_n(self.fill)
+        if self.preallocate and size:
+            fallocate(fd, size)
+        return fd, path
+
+    def close(self):
+        """
+        Removes all pooled files.
+        """
+        while self.files:
+            fd, path = self.files.popleft()
+            os.close(fd)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def cleanup_orphans(tmpdir, max_age, logger):
+    """
+    Removes pool files of dead workers and any other file older than
+    max_age from tmp directory of a device. Pool files of live workers are
+    never expired, the worker still holds them in its pool.
+
+    :param tmpdir: tmp directory of the device
+    :param max_age: age in seconds after which any file is an orphan
+    :param logger: logger object
+    :returns: number of removed files
+    """
+    removed = 0
+    try:
+        names = os.listdir(tmpdir)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return removed
+    too_old = time.time() - max_age
+    for name in names:
+        path = os.path.join(tmpdir, name)
+        orphan = False
+        pid = None
+        if name.startswith(POOL_PREFIX):
+            try:
+                pid = int(name.split('-', 2)[1])
+            except (IndexError, ValueError):
+                pass
+        if pid is not None:
+            if pid_alive(pid):
+                continue
+            orphan = True
+        try:
+            if not orphan:
+                st = os.stat(path)
+                orphan = st.st_mtime < too_old and \
+                    not stat.S_ISDIR(st.st_mode)
+            if orphan:
+                os.unlink(path)
+                removed += 1
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                logger.exception(_('Cannot remove orphaned tmp file %s'),
+                                 path)
+    return removed
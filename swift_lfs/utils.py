@@ -0,0 +1,130 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6
+    from ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded mapping which evicts the least recently used key once it holds
+    more than maxsize entries.
+
+    :param maxsize: maximum number of entries, 0 disables the cache
+    :param on_evict: function called with key and value of evicted entries
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            evicted = self._data.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(*evicted)
+
+    def items(self):
+        return self._data.items()
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+class CloseCallback(object):
+    """
+    Wraps WSGI app_iter, counts bytes sent and calls callback once the
+    server closes it.
+
+    :param app_iter: iterable returned by WSGI application
+    :param callback: function taking number of bytes sent
+    """
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+        self.bytes_out = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.bytes_out += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            callback, self.callback = self.callback, None
+            if callback:
+                callback(self.bytes_out)
+
+
+class CountingInput(object):
+    """
+    Wraps wsgi.input and counts bytes read.
+
+    :param wsgi_input: file like object
+    """
+
+    def __init__(self, wsgi_input):
+        self.wsgi_input = wsgi_input
+        self.bytes_in = 0
+
+    def read(self, *args, **kwargs):
+        data = self.wsgi_input.read(*args, **kwargs)
+        self.bytes_in += len(data)
+        return data
+
+    def readline(self, *args, **kwargs):
+        data = self.wsgi_input.readline(*args, **kwargs)
+        self.bytes_in += len(data)
+        return data
+
+
+def list_from_csv(value):
+    """
+    Splits comma separated config value.
+
+    :param value: string like 'a, b,c'
+    :returns: list of stripped non empty items
+    """
+    return [item.strip() for item in (value or '').split(',')
+            if item.strip()]
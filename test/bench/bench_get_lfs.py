@@ -0,0 +1,85 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Startup benchmark for swift_lfs.fs.get_lfs """
+
+import os
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift.common.utils import whataremyips
+
+from swift_lfs import fs
+
+
+class FakeRing(object):
+    def __init__(self, devs):
+        self.devs = devs
+
+
+CONF_TEMPLATE = """
+[DEFAULT]
+devices = %(devices)s
+
+[pipeline:main]
+pipeline = lfs object-server
+
+[filter:lfs]
+use = egg:swift_lfs#swift_lfs
+storage_type = object
+fs = xfs
+xfs = yes
+
+[xfs]
+partition_cache_size = 1024
+"""
+
+
+def run(conf, ring, count, cold):
+    module = 'swift_lfs.fs.%s' % conf['fs']
+    start = time.time()
+    for _junk in xrange(count):
+        if cold:
+            # as in a fresh process: backend module is imported again and
+            # the config file is parsed again
+            sys.modules.pop(module, None)
+            fs._backends.clear()
+            fs._backend_confs.clear()
+        fs.get_lfs(conf, ring, 'objects', 6000, None)
+    return time.time() - start
+
+
+def main(count=1000):
+    testdir = mkdtemp()
+    try:
+        conf_path = os.path.join(testdir, 'object-server.conf')
+        with open(conf_path, 'w') as fp:
+            fp.write(CONF_TEMPLATE % {'devices': testdir})
+        conf = {'__file__': conf_path, 'fs': 'xfs', 'xfs': 'yes',
+                'devices': testdir, 'bind_port': 6000}
+        ring = FakeRing([{'device': 'sda1', 'ip': whataremyips()[0],
+                          'port': 6000}])
+        for name, cold in (('cold', True), ('cached', False)):
+            elapsed = run(conf, ring, count, cold)
+            print '%-6s %8.3fs %8.2fus/get_lfs' % (name, elapsed,
+                                                   elapsed * 1e6 / count)
+    finally:
+        rmtree(testdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,97 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmark for swift_lfs.lfs.LFSMiddleware request overhead """
+
+import os
+import sys
+import time
+import cPickle as pickle
+from gzip import GzipFile
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift.common.ring import RingData
+from swift.common.swob import Request
+from swift.common.utils import whataremyips
+
+from swift_lfs import lfs
+
+
+class FakeApp(object):
+    def __call__(self, env, start_response):
+        return ['FAKE APP']
+
+
+def start_response(*args):
+    pass
+
+
+def legacy_call(middleware, env, start_response):
+    """LFSMiddleware.__call__ as it was before the QUERY_STRING fast path"""
+    if env['REQUEST_METHOD'] == 'GET':
+        req = Request(env)
+        if 'status' in req.GET:
+            res = middleware.GET(req, middleware.storage)
+            return res(env, start_response)
+    env['swift.storage'] = middleware.storage
+    return middleware.app(env, start_response)
+
+
+def make_envs(count, status_every):
+    envs = []
+    for i in xrange(count):
+        if status_every and i % status_every == 0:
+            query = 'status'
+        elif i % 2:
+            query = 'multipart-manifest=get'
+        else:
+            query = ''
+        envs.append({'REQUEST_METHOD': 'GET', 'QUERY_STRING': query,
+                     'PATH_INFO': '/sda1/%d/a/c/o%d' % (i % 1024, i),
+                     'SCRIPT_NAME': '', 'SERVER_NAME': 'localhost',
+                     'SERVER_PORT': '6000', 'wsgi.url_scheme': 'http'})
+    return envs
+
+
+def run(call, envs):
+    start = time.time()
+    for env in envs:
+        call(dict(env), start_response)
+    return time.time() - start
+
+
+def main(count=100000, status_every=1000):
+    testdir = mkdtemp()
+    try:
+        pickle.dump(RingData([[0]], [{'id': 0, 'zone': 0, 'device': 'sda1',
+                                      'ip': whataremyips()[0],
+                                      'port': 6000}], 30),
+                    GzipFile(os.path.join(testdir, 'object.ring.gz'), 'wb'))
+        middleware = lfs.LFSMiddleware(FakeApp(), {
+            'storage_type': 'object', 'swift_dir': testdir,
+            'devices': testdir, 'bind_port': 6000})
+        envs = make_envs(count, status_every)
+        before = run(lambda env, sr: legacy_call(middleware, env, sr), envs)
+        after = run(middleware, envs)
+        for name, elapsed in (('before', before), ('after', after)):
+            print '%-6s %8.3fs %8.2fus/request' % (name, elapsed,
+                                                   elapsed * 1e6 / count)
+    finally:
+        rmtree(testdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
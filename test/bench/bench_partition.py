@@ -0,0 +1,61 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Micro-benchmark for swift_lfs.fs.LFS.setup_partition """
+
+import sys
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift.common.utils import whataremyips
+
+from swift_lfs.fs import LFS
+
+
+class FakeRing(object):
+    def __init__(self, devs):
+        self.devs = devs
+
+
+def run(storage, partitions, rounds):
+    start = time.time()
+    for _junk in xrange(rounds):
+        for partition in partitions:
+            storage.setup_partition(partition)
+    return time.time() - start
+
+
+def main(rounds=100, partition_count=1000):
+    testdir = mkdtemp()
+    try:
+        ring = FakeRing([{'device': 'sda1', 'ip': whataremyips()[0],
+                          'port': 6000}])
+        partitions = [str(p) for p in xrange(partition_count)]
+        calls = rounds * partition_count
+        for name, cache_size in (('uncached', 0),
+                                 ('cached', partition_count)):
+            conf = {'devices': testdir, 'bind_port': 6000,
+                    'partition_cache_size': cache_size}
+            storage = LFS(conf, ring, 'objects', 6000, None)
+            elapsed = run(storage, partitions, rounds)
+            print '%-9s %8.3fs %8.2fus/call' % (name, elapsed,
+                                                elapsed * 1e6 / calls)
+    finally:
+        rmtree(testdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
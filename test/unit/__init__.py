@@ -0,0 +1,65 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Helpers shared by swift_lfs unit tests """
+
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift_lfs import fs
+
+
+LOCAL_IP = '10.0.0.1'
+
+
+class FakeLogger(object):
+    def __init__(self):
+        self.lines = []
+
+    def _log(self, *args):
+        self.lines.append(args)
+    debug = info = warning = error = exception = timing_since = _log
+
+
+class FakeRing(object):
+    def __init__(self, devs, serialized_path=None):
+        self.devs = devs
+        if serialized_path:
+            self.serialized_path = serialized_path
+
+
+def local_devs(devices, port=6000):
+    """
+    Returns ring devices of the local node
+
+    :param devices: device names
+    :param port: server port
+    """
+    return [{'device': device, 'ip': LOCAL_IP, 'port': port}
+            for device in devices]
+
+
+class LocalNodeTestCase(unittest.TestCase):
+    """ Runs tests on node LOCAL_IP with a scratch directory in testdir """
+
+    def setUp(self):
+        self.orig_my_ips = fs._my_ips
+        fs._my_ips = set([LOCAL_IP])
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        fs._my_ips = self.orig_my_ips
+        rmtree(self.testdir)
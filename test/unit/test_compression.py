@@ -0,0 +1,99 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.fs.compression """
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift_lfs.fs import compression
+from swift_lfs.exceptions import LFSException
+
+
+class TestCompressionTuner(unittest.TestCase):
+    """ Tests swift_lfs.fs.compression.CompressionTuner """
+
+    def test_bounds(self):
+        tuner = compression.CompressionTuner('gzip-9', 'lz4', 'gzip-6')
+        self.assertEqual(tuner.level, 'gzip-6')
+        tuner = compression.CompressionTuner('on', 'gzip-1', 'gzip-6')
+        self.assertEqual(tuner.level, 'gzip-1')
+        self.assertRaises(LFSException, compression.CompressionTuner,
+                          'lz4', 'gzip-6', 'lz4')
+        self.assertRaises(LFSException, compression.CompressionTuner,
+                          'brotli')
+
+    def test_hysteresis(self):
+        tuner = compression.CompressionTuner('lz4', hysteresis=3)
+        self.assertEqual(tuner.sample(2.0, 10), None)
+        self.assertEqual(tuner.sample(2.0, 10), None)
+        # one sample against resets the votes
+        self.assertEqual(tuner.sample(1.3, 10), None)
+        self.assertEqual(tuner.sample(2.0, 10), None)
+        self.assertEqual(tuner.sample(2.0, 10), None)
+        self.assertEqual(tuner.sample(2.0, 10), 'gzip-1')
+        for _junk in range(2):
+            self.assertEqual(tuner.sample(2.0, 90), None)
+        self.assertEqual(tuner.sample(2.0, 90), 'lz4')
+
+    def test_incompressible(self):
+        tuner = compression.CompressionTuner('lz4', hysteresis=1,
+                                             probe_samples=2)
+        self.assertEqual(tuner.sample(1.0, 10), 'off')
+        self.assertEqual(tuner.sample(1.0, 10), None)
+        # probe compression again after probe_samples
+        self.assertEqual(tuner.sample(1.0, 10), 'lz4')
+
+    def test_sample_usage(self):
+        tuner = compression.CompressionTuner('lz4', hysteresis=1,
+                                             min_written=100)
+        # cumulative ratio of old data doesn't matter
+        self.assertEqual(tuner.sample_usage(3000, 1000, 10), None)
+        self.assertEqual(tuner.sample_usage(3050, 1050, 10), None)
+        self.assertEqual(tuner.level, 'lz4')
+        # ratio of the data written since the last sample
+        self.assertEqual(tuner.sample_usage(3100, 1100, 10), 1.0)
+        self.assertEqual(tuner.level, 'off')
+        # deleted data starts over
+        self.assertEqual(tuner.sample_usage(1000, 500, 10), None)
+        self.assertEqual(tuner.last_usage, (1000, 500))
+
+    def test_max_level(self):
+        tuner = compression.CompressionTuner('gzip-6', hysteresis=1)
+        self.assertEqual(tuner.sample(5.0, 10), None)
+        self.assertEqual(tuner.level, 'gzip-6')
+
+
+class TestCPUMeter(unittest.TestCase):
+    """ Tests swift_lfs.fs.compression.CPUMeter """
+
+    def test_usage(self):
+        testdir = mkdtemp()
+        try:
+            stat_path = os.path.join(testdir, 'stat')
+            with open(stat_path, 'w') as fp:
+                fp.write('cpu  100 0 100 700 100 0 0 0 0 0\n')
+            meter = compression.CPUMeter(stat_path)
+            with open(stat_path, 'w') as fp:
+                fp.write('cpu  200 0 200 1300 100 0 0 0 0 0\n')
+            self.assertEqual(meter.usage(), 25.0)
+        finally:
+            rmtree(testdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
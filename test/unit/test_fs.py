@@ -31,10 +31,7 @@ from swift.common.ring import Ring, RingData
 from swift_lfs.fs import SWIFT_DEVICE_ONLINE, SWIFT_DEVICE_MISCONFIGURED,\
     SWIFT_DEVICE_DEGRADED, SWIFT_DEVICE_FAULTED
 from swift_lfs import fs as lfs
-
-
-class FakeLogger(object):
-    pass
+from test.unit import FakeLogger
 
 
 class TestLFS(unittest.TestCase):
@@ -23,17 +23,17 @@ from gzip import GzipFile
 from shutil import rmtree
 from tempfile import mkdtemp
 
+import eventlet
+
 from swift.common import utils
 from swift.common.utils import mkdirs
 from swift.common.ring import Ring, RingData
 from swift.common.exceptions import SwiftConfigurationError
 
 from swift_lfs import fs as lfs
-from swift_lfs.exceptions import LFSException
-
-
-class FakeLogger(object):
-    pass
+from swift_lfs.exceptions import LFSException, LFSTimeout
+from swift_lfs.shmstatus import SharedStatus
+from test.unit import FakeLogger, FakeRing, LocalNodeTestCase, local_devs
 
 
 class TestGetLFS(unittest.TestCase):
@@ -86,5 +86,507 @@ class TestGetLFS(unittest.TestCase):
                 lambda:lfs.get_lfs(conf, self.ring, 'devices', 'test_lfs'))
 
 
+class TestGetLocalDevices(LocalNodeTestCase):
+    """ Test swift_lfs.fs.get_local_devices """
+
+    def setUp(self):
+        super(TestGetLocalDevices, self).setUp()
+        lfs._my_ips.add('10.0.1.1')
+        self.devs = [
+            {'id': 0, 'device': 'sda1', 'ip': '10.0.0.1', 'port': 6000},
+            None,
+            {'id': 2, 'device': 'sdb1', 'ip': '10.0.0.2', 'port': 6000},
+            {'id': 3, 'device': 'sdc1', 'ip': '10.0.1.1', 'port': '6000'},
+            {'id': 4, 'device': 'sdd1', 'ip': '10.0.0.1', 'port': 6001}]
+
+    def tearDown(self):
+        super(TestGetLocalDevices, self).tearDown()
+        lfs._ring_indexes.clear()
+
+    def test_get_local_devices(self):
+        devs = lfs.get_local_devices(FakeRing(self.devs), 6000)
+        self.assertEqual([dev['device'] for dev in devs], ['sda1', 'sdc1'])
+        devs = lfs.get_local_devices(FakeRing(self.devs), 6001)
+        self.assertEqual([dev['device'] for dev in devs], ['sdd1'])
+        self.assertEqual(lfs.get_local_devices(FakeRing(self.devs), 6002),
+                         [])
+
+    def test_index_cached_by_mtime(self):
+        path = os.path.join(self.testdir, 'object.ring.gz')
+        open(path, 'w').close()
+        os.utime(path, (100, 100))
+        ring = FakeRing(self.devs, path)
+        self.assertEqual(len(lfs.get_local_devices(ring, 6000)), 2)
+        ring.devs = self.devs[:1]
+        self.assertEqual(len(lfs.get_local_devices(ring, 6000)), 2)
+        os.utime(path, (200, 200))
+        self.assertEqual(len(lfs.get_local_devices(ring, 6000)), 1)
+
+
+class TestReloadDevices(LocalNodeTestCase):
+    """ Test swift_lfs.fs.LFS.reload_devices """
+
+    def test_swap_devices(self):
+        ring = FakeRing(local_devs(('sda1', 'sdb1')))
+        storage = lfs.LFS({'devices': self.testdir}, ring, 'objects', 6000,
+                          FakeLogger())
+        storage.set_device_status('sda1', 'faulted')
+        self.assertEqual(storage.reload_devices(), None)
+        self.assertFalse(storage._reloading)
+        ring.devs = [None,
+                     {'device': 'sdb1', 'ip': '10.0.0.1', 'port': 6000,
+                      'mirror_copies': 2},
+                     {'device': 'sdc1', 'ip': '10.0.0.1', 'port': 6000}]
+        setup = []
+        storage.setup_device = setup.append
+        storage.logger.info = lambda *args: None
+        storage._swap_devices(storage.get_ring_devices())
+        self.assertEqual(setup, ['sdc1'])
+        self.assertEqual(storage.local_devices.keys(), ['sdb1', 'sdc1'])
+        self.assertEqual(storage.device, 'sdb1')
+        self.assertEqual(storage.device_mirror_copies, 2)
+        self.assertEqual(storage.faulted_devices, set())
+        self.assertEqual(storage.get_device_status(),
+                         {'sdb1': 'online', 'sdc1': 'online'})
+
+
+class TestStatusSnapshot(unittest.TestCase):
+    """ Test swift_lfs.fs.StatusSnapshot """
+
+    def test_snapshot(self):
+        snapshot = lfs.StatusSnapshot(3, {'sdb1': 'faulted',
+                                          'sda1': 'online'})
+        self.assertEqual(snapshot.version, 3)
+        self.assertEqual(snapshot.body, 'sda1:online\nsdb1:faulted')
+        self.assertEqual(snapshot.etag,
+                         lfs.StatusSnapshot(4, dict(snapshot.statuses)).etag)
+        self.assertNotEqual(snapshot.etag,
+                            lfs.StatusSnapshot(4, {'sda1': 'online'}).etag)
+        self.assertRaises(AttributeError,
+                          lambda: setattr(snapshot, 'other', 1))
+
+    def test_info(self):
+        snapshot = lfs.StatusSnapshot(1, {'sda1': 'online'},
+                                      {'zfs_profile': {'atime': 'off'}})
+        self.assertEqual(snapshot.info_body,
+                         '{"devices": {"sda1": "online"}, '
+                         '"zfs_profile": {"atime": "off"}}')
+
+
+class TestBackends(LocalNodeTestCase):
+    """ Test swift_lfs.fs backend resolution """
+
+    def setUp(self):
+        super(TestBackends, self).setUp()
+        self.orig_backends = dict(lfs._backends)
+        self.orig_load_entry_point = lfs._load_entry_point
+        lfs._backends.clear()
+        lfs._backend_confs.clear()
+
+    def tearDown(self):
+        super(TestBackends, self).tearDown()
+        lfs._backends.clear()
+        lfs._backends.update(self.orig_backends)
+        lfs._backend_confs.clear()
+        lfs._load_entry_point = self.orig_load_entry_point
+
+    def test_load_backend(self):
+        from swift_lfs.fs.xfs import LFSXFS
+        self.assertTrue(lfs.load_backend('xfs') is LFSXFS)
+        self.assertTrue(lfs._backends['xfs'] is LFSXFS)
+        lfs._load_entry_point = lambda fs: None
+        self.assertRaises(ImportError, lfs.load_backend, 'nofs')
+        self.assertFalse('nofs' in lfs._backends)
+        # backends of other packages come from the entry point group
+        lfs._load_entry_point = lambda fs: {'myfs': lfs.LFS}.get(fs)
+        self.assertTrue(lfs.load_backend('myfs') is lfs.LFS)
+        lfs._load_entry_point = lambda fs: None
+        self.assertTrue(lfs.load_backend('myfs') is lfs.LFS)
+
+    def test_register_backend(self):
+        class MyXFS(lfs.LFS):
+            pass
+
+        lfs.register_backend('xfs', MyXFS)
+        self.assertTrue(lfs.load_backend('xfs') is MyXFS)
+        lfs.register_backend('other', MyXFS)
+        self.assertTrue(lfs.load_backend('other') is MyXFS)
+
+    def test_get_backend_conf(self):
+        conf_path = os.path.join(self.testdir, 'object-server.conf')
+        with open(conf_path, 'w') as fp:
+            fp.write('[xfs]\nprobe_timeout = 5\n')
+        conf = lfs.get_backend_conf(conf_path, 'xfs')
+        self.assertEqual(conf['probe_timeout'], '5')
+        # unchanged file is not parsed again
+        self.assertTrue(lfs.get_backend_conf(conf_path, 'xfs') is conf)
+        with open(conf_path, 'w') as fp:
+            fp.write('[xfs]\nprobe_timeout = 7\n')
+        mtime = os.path.getmtime(conf_path)
+        os.utime(conf_path, (mtime + 1, mtime + 1))
+        self.assertEqual(
+            lfs.get_backend_conf(conf_path, 'xfs')['probe_timeout'], '7')
+
+
+class TestTiers(LocalNodeTestCase):
+    """ Test swift_lfs.fs.LFS datadir and tmp placement """
+
+    def setUp(self):
+        super(TestTiers, self).setUp()
+        self.ring = FakeRing(local_devs(['sda1'], 6002))
+
+    def test_get_tier_roots(self):
+        conf = {'datadir_roots': 'account:/srv/ssd, container:/srv/ssd',
+                'tmp_roots': 'object:/srv/tmp'}
+        self.assertEqual(lfs.get_tier_roots(conf, 'account', '/srv/node'),
+                         {'datadir': '/srv/ssd', 'tmp': '/srv/ssd'})
+        self.assertEqual(lfs.get_tier_roots(conf, 'object', '/srv/node'),
+                         {'datadir': '/srv/node', 'tmp': '/srv/tmp'})
+        self.assertEqual(lfs.get_tier_roots({}, 'chunk', '/srv/node'),
+                         {'datadir': '/srv/node', 'tmp': '/srv/node'})
+        self.assertRaises(SwiftConfigurationError, lfs.get_tier_roots,
+                          {'datadir_roots': '/srv/ssd'}, 'account',
+                          '/srv/node')
+
+    def test_setup_and_check(self):
+        ssd = os.path.join(self.testdir, 'ssd')
+        conf = {'devices': os.path.join(self.testdir, 'node'),
+                'storage_type': 'account', 'datadir_roots': 'account:' + ssd}
+        storage = lfs.LFS(conf, self.ring, 'accounts', 6002, FakeLogger())
+        self.assertTrue(storage.tiered)
+        self.assertRaises(LFSException, storage.setup_devices, ['sda1'])
+        os.mkdir(ssd)
+        storage.setup_devices(['sda1'])
+        self.assertTrue(os.path.isdir(os.path.join(ssd, 'sda1', 'accounts')))
+        self.assertTrue(os.path.isdir(os.path.join(ssd, 'sda1', 'tmp')))
+        self.assertEqual(storage.setup_partition('1'),
+                         os.path.join(ssd, 'sda1', 'accounts', '1'))
+        self.assertEqual(storage.check_tiers(), None)
+        rmtree(os.path.join(ssd, 'sda1'))
+        self.assertEqual(storage.check_tiers(),
+                         (storage.tier_error_callback, ()))
+        self.assertEqual(storage.get_device_status(),
+                         {'sda1': 'unavailable'})
+        # device checks of the backend don't clear tier faults
+        storage.set_device_status('sda1', 'online')
+        self.assertEqual(storage.get_device_status(),
+                         {'sda1': 'unavailable'})
+
+    def test_tmp_on_other_filesystem(self):
+        tmp = os.path.join(self.testdir, 'tmp')
+        os.mkdir(tmp)
+        conf = {'devices': os.path.join(self.testdir, 'node'),
+                'storage_type': 'account', 'tmp_roots': 'account:' + tmp}
+        os.mkdir(conf['devices'])
+        storage = lfs.LFS(conf, self.ring, 'accounts', 6002, FakeLogger())
+        storage.setup_devices(['sda1'])
+        orig_same_filesystem = lfs.same_filesystem
+        lfs.same_filesystem = lambda path, other: False
+        try:
+            self.assertRaises(SwiftConfigurationError, storage.setup_devices,
+                              ['sda1'])
+        finally:
+            lfs.same_filesystem = orig_same_filesystem
+
+
+class TestPartitionCache(LocalNodeTestCase):
+    """ Test swift_lfs.fs.LFS partition cache """
+
+    def test_with_partition(self):
+        storage = lfs.LFS({'devices': self.testdir},
+                          FakeRing(local_devs(['sda1'])), 'objects', 6000,
+                          FakeLogger())
+        path = storage.setup_partition('1')
+        self.assertTrue(os.path.isdir(path))
+        tmp = os.path.join(self.testdir, 'data')
+        open(tmp, 'w').close()
+
+        def rename(partition_path):
+            os.rename(tmp, os.path.join(partition_path, 'data'))
+            return partition_path
+
+        # removed by a replicator in another process, path stays cached
+        rmtree(os.path.join(self.testdir, 'sda1'))
+        self.assertEqual(storage.setup_partition('1'), path)
+        self.assertEqual(storage.with_partition(rename, '1'), path)
+        self.assertTrue(os.path.exists(os.path.join(path, 'data')))
+        # source is gone now, retried once and the error is raised
+        self.assertRaises(OSError, storage.with_partition, rename, '1')
+        self.assertTrue(storage.get_env_hooks()['swift.with_partition'])
+
+
+class TestPackStores(LocalNodeTestCase):
+    """ Test swift_lfs.fs.LFS pack stores """
+
+    def setUp(self):
+        super(TestPackStores, self).setUp()
+        ring = FakeRing(local_devs(['sda1'], 6004))
+        self.storage = lfs.LFS(
+            {'devices': self.testdir, 'storage_type': 'chunk',
+             'pack_store_cache_size': 1}, ring, 'chunks', 6004, FakeLogger())
+
+    def test_get_pack_store(self):
+        hooks = self.storage.get_env_hooks()
+        self.assertEqual(hooks['swift.get_pack_store'],
+                         self.storage.get_pack_store)
+        store = self.storage.get_pack_store('1')
+        self.assertEqual(store.path,
+                         os.path.join(self.testdir, 'sda1', 'chunks', '1',
+                                      'packs'))
+        self.assertTrue(self.storage.get_pack_store('1') is store)
+        store.put('a', 'data')
+        # evicted store is closed
+        self.storage.get_pack_store('2')
+        self.assertEqual(store.lock_fd, None)
+        # and keeps working for its users
+        store.put('b', 'more')
+        self.assertEqual(store.get('a'), 'data')
+        self.assertEqual(self.storage.get_pack_store('1').get('b'), 'more')
+        self.assertEqual(self.storage.get_pack_store('1').get('a'), 'data')
+        self.storage.invalidate_partition(device='sda1')
+        self.assertEqual(len(self.storage.pack_stores), 0)
+
+
+class TestStatusEvents(LocalNodeTestCase):
+    """ Test swift_lfs.fs.LFS status transitions for ?status&watch """
+
+    def setUp(self):
+        super(TestStatusEvents, self).setUp()
+        self.ring = FakeRing(local_devs(('sda1', 'sdb1')))
+
+    def test_events(self):
+        storage = lfs.LFS({}, self.ring, 'objects', 6000, FakeLogger())
+        self.assertEqual(storage.get_status_events(0),
+                         [(1, 'sda1', 'online'), (1, 'sdb1', 'online')])
+        self.assertEqual(storage.get_status_events(1), [])
+        storage.set_device_status('sda1', 'degraded')
+        storage.set_status_info('capacity', {})
+        storage.set_device_status('sda1', 'faulted')
+        self.assertEqual(storage.status_snapshot.version, 4)
+        self.assertEqual(storage.get_status_events(1),
+                         [(2, 'sda1', 'degraded'), (4, 'sda1', 'faulted')])
+        self.assertEqual(storage.get_status_events(2),
+                         [(4, 'sda1', 'faulted')])
+        # since from a restarted server
+        self.assertEqual(storage.get_status_events(5), None)
+
+    def test_history_overflow(self):
+        storage = lfs.LFS({'status_event_history': 2}, self.ring, 'objects',
+                          6000, FakeLogger())
+        storage.set_device_status('sda1', 'faulted')
+        self.assertEqual(storage.get_status_events(0), None)
+        self.assertEqual(storage.get_status_events(1),
+                         [(2, 'sda1', 'faulted')])
+
+    def test_wait(self):
+        storage = lfs.LFS({}, self.ring, 'objects', 6000, FakeLogger())
+        self.assertEqual(storage.wait_status_events(1, 0.01), [])
+        eventlet.spawn_n(storage.set_device_status, 'sdb1', 'unavailable')
+        self.assertEqual(storage.wait_status_events(1, 1),
+                         [(2, 'sdb1', 'unavailable')])
+
+
+class TestSharedStatus(LocalNodeTestCase):
+    """ Test swift_lfs.fs.LFS statuses shared between workers """
+
+    def setUp(self):
+        super(TestSharedStatus, self).setUp()
+        ring = FakeRing(local_devs(('sda1', 'sdb1')))
+        conf = {'shared_status': 'yes', 'shared_status_dir': self.testdir}
+        path = os.path.join(self.testdir, 'lfs.status')
+        self.leader = lfs.LFS(conf, ring, 'objects', 6000, FakeLogger())
+        self.leader.shared_status = SharedStatus(path)
+        self.leader.shared_status.elect()
+        self.follower = lfs.LFS(conf, ring, 'objects', 6000, FakeLogger())
+        # never elected, as if it ran in another worker
+        self.follower.shared_status = SharedStatus(path)
+        self.follower.shared_status.elect = lambda: False
+
+    def test_follow(self):
+        checks = []
+        checker = self.follower.create_status_checker(
+            lambda: checks.append(1))
+        self.assertFalse(checker.check())
+        self.assertEqual(checks, [])
+        self.leader.set_device_status('sdb1', 'faulted')
+        self.assertEqual(self.follower.get_device_status(),
+                         {'sda1': 'online', 'sdb1': 'faulted'})
+        self.assertEqual(self.follower.faulted_devices, set(['sdb1']))
+        self.leader.set_device_status('sdb1', 'online')
+        self.follower.refresh_status()
+        self.assertEqual(self.follower.status_snapshot.statuses,
+                         {'sda1': 'online', 'sdb1': 'online'})
+        self.assertEqual(self.follower.get_status_events(2)[-1][1:],
+                         ('sdb1', 'online'))
+        self.leader.create_status_checker(lambda: checks.append(1)).check()
+        self.assertEqual(checks, [1])
+
+    def test_lazy_election(self):
+        conf = {'shared_status': 'yes', 'shared_status_dir': self.testdir,
+                'ring_check_interval': 0, 'tmp_cleanup_interval': 0}
+        storage = lfs.LFS(conf, FakeRing(local_devs(['sda1'], 6001)),
+                          'objects', 6001, FakeLogger())
+        storage.sample_capacity = lambda device: {'size': 100,
+                                                  'available': 2}
+        storage.setup_node()
+        # process which set up the node before fork holds no lock
+        self.assertEqual(storage.shared_status.lock_fd, None)
+        self.assertFalse(storage.shared_status.leader)
+        # first pass of a checker in the worker takes part in the election
+        storage.capacity_checker.check()
+        self.assertTrue(storage.shared_status.leader)
+        self.assertEqual(storage.fill_states, {'sda1': 'full'})
+        # capacity is shared with the other workers
+        follower = lfs.LFS(conf, FakeRing(local_devs(['sda1'], 6001)),
+                           'objects', 6001, FakeLogger())
+        follower.shared_status = SharedStatus(storage.shared_status.path)
+        follower.shared_status.elect = lambda: False
+        follower._leader_only(follower.check_capacity)()
+        self.assertEqual(follower.fill_states, {'sda1': 'full'})
+        self.assertEqual(follower.status_snapshot.info['capacity']['sda1']
+                         ['used_percent'], 98.0)
+
+    def test_sequence(self):
+        self.leader.write_shared_status()
+        self.follower.refresh_status()
+        self.assertEqual(self.follower.status_epoch,
+                         self.leader.status_epoch)
+        self.leader.set_device_status('sdb1', 'faulted')
+        self.follower.refresh_status()
+        # followers number transitions like the leader
+        self.assertEqual(self.follower.status_sequence(), 4)
+        self.assertEqual(self.leader.status_sequence(), 4)
+        self.assertEqual(self.follower.get_status_events(2),
+                         [(4, 'sdb1', 'faulted')])
+        self.assertEqual(self.leader.get_status_events(2),
+                         [(4, 'sdb1', 'faulted')])
+        self.assertEqual(self.follower.get_status_events(6), None)
+        # new leader goes on with the sequence and its epoch
+        epoch = self.leader.status_epoch
+        self.leader.shared_status.leader_pid = None
+        del self.follower.shared_status.elect
+        self.follower.sync_shared_status()
+        self.assertTrue(self.follower.shared_status.leader)
+        self.assertEqual(self.follower.status_epoch, epoch)
+        self.follower.set_device_status('sdb1', 'online')
+        self.assertEqual(self.follower.get_status_events(4),
+                         [(8, 'sdb1', 'online')])
+
+
+class TestCallInThread(LocalNodeTestCase):
+    """ Test swift_lfs.fs.call_in_thread """
+
+    def setUp(self):
+        super(TestCallInThread, self).setUp()
+        self.orig_timeout = lfs.Timeout
+        self.orig_execute = lfs.tpool.execute
+
+    def tearDown(self):
+        super(TestCallInThread, self).tearDown()
+        lfs.Timeout = self.orig_timeout
+        lfs.tpool.execute = self.orig_execute
+
+    def test_hung_call(self):
+        timers = []
+        hung = []
+
+        class FakeTimeout(Exception):
+            def __init__(self, seconds):
+                timers.append(self)
+
+            def cancel(self):
+                pass
+
+        def execute(func):
+            hung.append(func)
+            raise timers[-1]
+
+        lfs.Timeout = FakeTimeout
+        lfs.tpool.execute = execute
+        self.assertRaises(LFSTimeout, lfs.call_in_thread, 1, os.getpid,
+                          key='sda1')
+        # while the thread hangs, probes of the device are skipped
+        self.assertRaises(LFSTimeout, lfs.call_in_thread, 1, os.getpid,
+                          key='sda1')
+        self.assertEqual(len(hung), 1)
+        lfs.tpool.execute = lambda func: func()
+        self.assertEqual(lfs.call_in_thread(1, os.getpid, key='sdb1'),
+                         os.getpid())
+        self.assertRaises(LFSTimeout, lfs.call_in_thread, 1, os.getpid,
+                          key='sda1')
+        # hung thread has returned
+        hung[0]()
+        self.assertEqual(lfs.call_in_thread(1, os.getpid, key='sda1'),
+                         os.getpid())
+
+    def test_setup_timeout(self):
+        ring = FakeRing(local_devs(('sda1', 'sdb1')))
+        storage = lfs.LFS({'capacity_check_interval': 0,
+                           'tmp_cleanup_interval': 0}, ring, 'objects', 6000,
+                          FakeLogger())
+        hung = set(['sdb1'])
+
+        def setup_device(device):
+            if device in hung:
+                raise LFSTimeout('hung')
+
+        storage.setup_device = setup_device
+        storage.setup_node()
+        self.assertEqual(storage.get_device_status(),
+                         {'sda1': 'online', 'sdb1': 'timeout'})
+        # status checks don't bring the device back before its setup
+        storage.set_device_status('sdb1', 'online')
+        self.assertEqual(storage.get_device_status()['sdb1'], 'timeout')
+        hung.clear()
+        storage.reload_devices()
+        self.assertEqual(storage.get_device_status(),
+                         {'sda1': 'online', 'sdb1': 'online'})
+
+
+class TestLFSStatus(unittest.TestCase):
+    """ Test swift_lfs.fs.LFSStatus """
+
+    def test_backoff(self):
+        calls = []
+        checker = lfs.LFSStatus(30, FakeLogger(), lambda: calls.append(1),
+                                min_interval=2, backoff=2)
+        self.assertFalse(checker.check())
+        self.assertEqual(calls, [1])
+        self.assertEqual([checker.get_sleep(False) for _junk in range(6)],
+                         [2, 4, 8, 16, 30, 30])
+        self.assertEqual(checker.get_sleep(True), 2)
+        checker.get_sleep(False)
+        checker.poke()
+        self.assertEqual(checker.get_sleep(False), 2)
+
+    def test_failed_check(self):
+        callbacks = []
+        checker = lfs.LFSStatus(30, FakeLogger(), lambda: None)
+        checker.add(lambda: (callbacks.append, ('cb',)))
+        self.assertTrue(checker.check())
+        self.assertEqual(callbacks, ['cb'])
+
+    def test_backoff_while_unhealthy(self):
+        results = [None, (lambda: None, ())]
+        checker = lfs.LFSStatus(30, FakeLogger(), lambda: results[-1],
+                                min_interval=2, backoff=2)
+        sleeps = []
+        for _junk in range(4):
+            checker.check()
+            sleeps.append(checker.get_sleep(checker.changed))
+        # fault resets the interval once, then it backs off again
+        self.assertEqual(sleeps, [2, 4, 8, 16])
+        results.pop()
+        checker.check()
+        self.assertTrue(checker.changed)
+        self.assertEqual(checker.get_sleep(checker.changed), 2)
+
+    def test_jitter(self):
+        checker = lfs.LFSStatus(10, FakeLogger(), lambda: None, jitter=0.5)
+        for _junk in range(100):
+            sleep = checker.get_sleep(True)
+            self.assertTrue(5 <= sleep <= 15)
+
+
 if __name__ == '__main__':
     unittest.main()
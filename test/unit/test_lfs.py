@@ -15,64 +15,238 @@
 
 import os
 import unittest
-from tempfile import mkdtemp
-import cPickle as pickle
-from gzip import GzipFile
-from shutil import rmtree
+from StringIO import StringIO
 
-from swift.common.utils import mkdirs
-from swift.common.ring import RingData
+from swift.common.swob import Request
 
-from swift_lfs import lfs
+from swift_lfs import fs, lfs
+from test.unit import FakeLogger, FakeRing, LocalNodeTestCase, local_devs
 
-
-class FakeApp(object):
-    def __call__(self, env, start_response):
-        return "FAKE APP"
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 
-RESPONSE = ''
-
+class FakeApp(object):
+    def __init__(self, body='FAKE APP', status='200 OK'):
+        self.body = body
+        self.status = status
+        self.calls = []
 
-def start_response(*args):
-    global RESPONSE
-    RESPONSE = args
+    def __call__(self, env, start_response):
+        self.calls.append(env)
+        env['wsgi.input'].read()
+        start_response(self.status,
+                       [('Content-Length', str(len(self.body)))])
+        return [self.body]
 
 
-class TestLFSMiddleware(unittest.TestCase):
+class TestLFSMiddleware(LocalNodeTestCase):
 
     def setUp(self):
-        self.testdir = os.path.join(mkdtemp(), 'lfs_middleware')
-        mkdirs(self.testdir)
-        pickle.dump(RingData([[0, 1, 0, 1], [1, 0, 1, 0]],
-            [{'id': 0, 'zone': 0, 'device': 'sda1', 'ip': '127.0.0.1',
-              'port': '6010', 'mirror_copies': 1},
-                    {'id': 1, 'zone': 1, 'device': 'sdb1', 'ip': '127.0.0.1',
-                     'port': '6020', 'mirror_copies': 1}], 30),
-            GzipFile(os.path.join(self.testdir, 'account.ring.gz'), 'wb'))
-        conf = {'storage_type': 'account', 'swift_dir': self.testdir}
-        self.app = lfs.LFSMiddleware(FakeApp(), conf)
+        super(TestLFSMiddleware, self).setUp()
+        self.orig_ring = lfs.Ring
+        self.orig_get_logger = lfs.get_logger
+        self.orig_backends = dict(fs._backends)
+        lfs.Ring = lambda swift_dir, ring_name: \
+            FakeRing(local_devs(('sda1', 'sdb1'), 6002))
+        lfs.get_logger = lambda conf, log_route: FakeLogger()
+        fs.register_backend('lfs', fs.LFS)
+        self.conf = {'storage_type': 'account', 'fs': 'lfs',
+                     'swift_dir': self.testdir, 'devices': self.testdir,
+                     'ring_check_interval': 0, 'capacity_check_interval': 0,
+                     'tmp_cleanup_interval': 0}
+        self.fake_app = FakeApp()
+        self.app = lfs.LFSMiddleware(self.fake_app, self.conf)
 
     def tearDown(self):
-        rmtree(self.testdir)
+        super(TestLFSMiddleware, self).tearDown()
+        lfs.Ring = self.orig_ring
+        lfs.get_logger = self.orig_get_logger
+        fs._backends.clear()
+        fs._backends.update(self.orig_backends)
+
+    def request(self, path, **kwargs):
+        return Request.blank(path, **kwargs).get_response(self.app)
+
+    def call(self, path, method='GET', body=None):
+        """
+        Calls the middleware as WSGI server does, returns status line and
+        app_iter, which is left open.
+        """
+        env = Request.blank(path, environ={'REQUEST_METHOD': method}).environ
+        if body is not None:
+            # chunked upload, bytes are counted as read
+            env.pop('CONTENT_LENGTH', None)
+            env['wsgi.input'] = StringIO(body)
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+        app_iter = self.app(env, start_response)
+        return status[0], app_iter
 
     def test_STATUS(self):
-        env = {'REQUEST_METHOD': 'STATUS', 'PATH_INFO': ''}
-        resp = self.app(env, start_response)[0]
-        self.assertEqual(RESPONSE[0][:3], '200')
-        resp_body = resp.split()
-        resp_body.sort()
-        self.assertEqual('\n'.join(resp_body), 'sda1:online:1\nsdb1:online:1')
-
-        for c in ('a', 'b'):
-            env['PATH_INFO'] = '/sd%s1' % c
-            resp = self.app(env, start_response)[0]
-            self.assertEqual(RESPONSE[0][:3], '200')
-            self.assertEqual(resp, 'sd%s1:online:1' % c)
-
-        env['PATH_INFO'] = '/sdz1'
-        self.app(env, start_response)[0]
-        self.assertEqual(RESPONSE[0][:3], '404')
+        resp = self.request('/?status')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, 'sda1:online\nsdb1:online')
+        for device in ('sda1', 'sdb1'):
+            resp = self.request('/%s?status' % device)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.body, '%s:online' % device)
+        self.assertEqual(self.fake_app.calls, [])
+
+    def test_STATUS_not_modified(self):
+        resp = self.request('/?status')
+        etag = resp.headers['Etag'].strip('"')
+        resp = self.request('/?status',
+                            headers={'If-None-Match': '"x", "%s"' % etag})
+        self.assertEqual(resp.status_int, 304)
+        self.assertEqual(resp.body, '')
+        self.assertEqual(self.request(
+            '/?status', headers={'If-None-Match': '*'}).status_int, 304)
+        self.app.storage.set_device_status('sdb1', 'faulted')
+        resp = self.request('/?status', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, 'sda1:online\nsdb1:faulted')
+        self.assertNotEqual(resp.headers['Etag'].strip('"'), etag)
+
+    def test_STATUS_watch(self):
+        storage = self.app.storage
+        seq = storage.status_sequence()
+        resp = self.request('/?status&watch&since=%d&timeout=0' % seq)
+        self.assertEqual(resp.status_int, 204)
+        self.assertEqual(resp.headers['X-Status-Sequence'], str(seq))
+        self.assertEqual(resp.headers['X-Status-Epoch'], storage.status_epoch)
+        self.assertFalse('X-Status-Resync' in resp.headers)
+        storage.set_device_status('sdb1', 'faulted')
+        resp = self.request('/?status&watch&since=%d&epoch=%s' %
+                            (seq, storage.status_epoch))
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, '%d sdb1 faulted\n' % (seq + 1))
+        self.assertEqual(resp.headers['X-Status-Sequence'], str(seq + 1))
+        # since ahead of the sequence or another epoch: full resync
+        for query in ('since=%d' % (seq + 5),
+                      'since=%d&epoch=other' % seq):
+            resp = self.request('/?status&watch&timeout=0&' + query)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['X-Status-Resync'], 'true')
+            self.assertEqual(resp.headers['X-Status-Epoch'],
+                             storage.status_epoch)
+            self.assertEqual(resp.body, '%d sda1 online\n%d sdb1 faulted\n'
+                             % (seq + 1, seq + 1))
+        for query in ('since=x', 'since=1&timeout=x'):
+            resp = self.request('/?status&watch&' + query)
+            self.assertEqual(resp.status_int, 400)
+        self.assertEqual(self.fake_app.calls, [])
+
+    def test_stats(self):
+        status, app_iter = self.call('/sda1/1/a/c/o')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(''.join(app_iter), 'FAKE APP')
+        # accounted when the server closes app_iter
+        self.assertEqual(self.app.stats.total.requests, 0)
+        app_iter.close()
+        self.assertEqual(self.app.stats.total.requests, 1)
+        _junk, app_iter = self.call('/sdb1/1/a/c/o', 'PUT', body='x' * 100)
+        list(app_iter)
+        app_iter.close()
+        self.fake_app.status = '500 Internal Error'
+        _junk, app_iter = self.call('/sdb1/1/a/c/o')
+        app_iter.close()
+        self.fake_app.status = '200 OK'
+        # not a local device
+        _junk, app_iter = self.call('/sdz1/1/a/c/o')
+        app_iter.close()
+        resp = self.request('/?stats')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.content_type, 'text/plain')
+        lines = resp.body.split('\n')
+        self.assertEqual([line.split()[0] for line in lines],
+                         ['account', 'sda1', 'sdb1'])
+        self.assertTrue(lines[0].startswith('account requests=4 errors=1 '))
+        self.assertTrue(lines[2].startswith(
+            'sdb1 requests=2 errors=1 bytes_in=100 bytes_out=8 '))
+        for path in ('/?stats=json', '/?stats&format=json'):
+            resp = self.request(path)
+            self.assertEqual(resp.content_type, 'application/json')
+            data = json.loads(resp.body)
+            self.assertEqual(data['storage_type'], 'account')
+            self.assertEqual(data['total']['requests'], 4)
+            self.assertEqual(data['devices']['sda1']['bytes_out'], 8)
+            self.assertEqual(data['devices']['sdb1']['bytes_in'], 100)
+        # ?stats itself is not accounted
+        self.assertEqual(self.app.stats.total.requests, 4)
+
+    def test_admission(self):
+        self.app.policy.max_writes['degraded'] = 1
+        self.app.storage.set_device_status('sdb1', 'degraded')
+        status, app_iter = self.call('/sdb1/1/a/c/o', 'PUT', body='x')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.app.policy.writes['sdb1'], 1)
+        status, _junk = self.call('/sdb1/1/a/c/o', 'PUT', body='x')
+        self.assertEqual(status[:3], '503')
+        self.assertEqual(len(self.fake_app.calls), 1)
+        # write slot is held until the response is closed
+        list(app_iter)
+        self.assertEqual(self.app.policy.writes['sdb1'], 1)
+        app_iter.close()
+        self.assertEqual(self.app.policy.writes['sdb1'], 0)
+        app_iter.close()
+        self.assertEqual(self.app.policy.writes['sdb1'], 0)
+        # reads are not limited, faulted devices fail fast
+        status, app_iter = self.call('/sdb1/1/a/c/o')
+        self.assertEqual(status, '200 OK')
+        self.app.storage.set_device_status('sdb1', 'faulted')
+        status, _junk = self.call('/sdb1/1/a/c/o')
+        self.assertEqual(status[:3], '507')
+        self.assertEqual(len(self.fake_app.calls), 2)
+
+    def test_device_hooks(self):
+        for device in ('sda1', 'sdb1'):
+            _junk, app_iter = self.call('/%s/7/a' % device)
+            app_iter.close()
+            env = self.fake_app.calls[-1]
+            self.assertEqual(env['swift.setup_partition']('7'),
+                             os.path.join(self.testdir, device, 'accounts',
+                                          '7'))
+            self.assertEqual(env['swift.setup_tmp'](),
+                             os.path.join(self.testdir, device, 'tmp'))
+            fd, path = env['swift.get_tmp_file']()
+            os.close(fd)
+            self.assertEqual(os.path.dirname(path),
+                             os.path.join(self.testdir, device, 'tmp'))
+        # device passed by the caller wins
+        self.assertEqual(env['swift.setup_partition']('7', 'sda1'),
+                         os.path.join(self.testdir, 'sda1', 'accounts', '7'))
+        self.assertEqual(
+            env['swift.setup_partition']('7', device='sda1'),
+            os.path.join(self.testdir, 'sda1', 'accounts', '7'))
+        self.assertEqual(env['swift.storage'], self.app.storage)
+
+    def test_pass_through(self):
+        for path in ('/sda1/1/a?statuses', '/sda1/1/a?a=status',
+                     '/sda1/1/a'):
+            resp = self.request(path)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.body, 'FAKE APP')
+        self.assertEqual(len(self.fake_app.calls), 3)
+        # status is only served to GET
+        self.request('/sda1/1/a?status', method='HEAD')
+        self.assertEqual(len(self.fake_app.calls), 4)
+
+
+class TestHasQueryParam(unittest.TestCase):
+
+    def test_has_query_param(self):
+        self.assertTrue(lfs.has_query_param('status', 'status'))
+        self.assertTrue(lfs.has_query_param('a=1&status', 'status'))
+        self.assertTrue(lfs.has_query_param('status=1&a=1', 'status'))
+        self.assertFalse(lfs.has_query_param('', 'status'))
+        self.assertFalse(lfs.has_query_param(None, 'status'))
+        self.assertFalse(lfs.has_query_param('statuses', 'status'))
+        self.assertFalse(lfs.has_query_param('a=status', 'status'))
 
 
 if __name__ == '__main__':
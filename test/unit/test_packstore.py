@@ -0,0 +1,274 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.packstore """
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift_lfs import packstore
+from swift_lfs.exceptions import LFSException
+from test.unit import FakeLogger
+
+
+class TestPackStore(unittest.TestCase):
+    """ Tests swift_lfs.packstore.PackStore """
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, 'packs')
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(packstore.SEGMENT_SUFFIX))
+
+    def test_put_get_delete(self):
+        store = packstore.PackStore(self.path, fsync=False)
+        self.assertEqual(store.get('a'), None)
+        store.put('a', 'x' * 100)
+        store.put('b', '')
+        store.put('a', 'y' * 10)
+        self.assertEqual(store.get('a'), 'y' * 10)
+        self.assertEqual(store.get('b'), '')
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store.delete('a'))
+        self.assertFalse(store.delete('a'))
+        self.assertFalse('a' in store)
+        self.assertEqual(self.segments(), ['00000000.pack'])
+        # index is rebuilt from the segments
+        store.close()
+        store = packstore.PackStore(self.path)
+        self.assertEqual(store.keys(), ['b'])
+        self.assertEqual(store.get('a'), None)
+
+    def test_rotation(self):
+        store = packstore.PackStore(self.path, segment_size=50, fsync=False)
+        for i in range(5):
+            store.put('k%d' % i, 'v' * 60)
+        self.assertEqual(len(self.segments()), 5)
+        self.assertEqual(store.get('k0'), 'v' * 60)
+        self.assertEqual(store.get('k4'), 'v' * 60)
+
+    def test_shared(self):
+        writer = packstore.PackStore(self.path, segment_size=100)
+        reader = packstore.PackStore(self.path, segment_size=100)
+        writer.put('a', '1')
+        self.assertEqual(reader.get('a'), '1')
+        writer.put('a', '2' * 100)
+        writer.put('b', '3')
+        self.assertEqual(reader.get('a'), '2' * 100)
+        self.assertEqual(reader.get('b'), '3')
+        writer.delete('b')
+        self.assertEqual(reader.get('b'), None)
+        reader.put('c', '4')
+        self.assertEqual(writer.get('c'), '4')
+
+    def test_read_without_syscalls(self):
+        writer = packstore.PackStore(self.path)
+        reader = packstore.PackStore(self.path)
+        writer.put('a', '1')
+        self.assertEqual(reader.get('a'), '1')
+        calls = []
+        orig_open = packstore.os.open
+        orig_refresh = reader.refresh
+
+        def fake_open(*args):
+            calls.append('open')
+            return orig_open(*args)
+
+        def fake_refresh():
+            calls.append('refresh')
+            return orig_refresh()
+
+        packstore.os.open = fake_open
+        reader.refresh = fake_refresh
+        try:
+            # nothing was appended since the last scan
+            self.assertEqual(reader.get('a'), '1')
+            self.assertEqual(reader.get('b'), None)
+            self.assertFalse('b' in reader)
+            self.assertEqual(calls, [])
+            writer.put('b', '2')
+            del calls[:]
+            self.assertEqual(reader.get('b'), '2')
+            self.assertEqual(reader.get('a'), '1')
+        finally:
+            packstore.os.open = orig_open
+        # one scan of the last segment
+        self.assertEqual(calls, ['refresh', 'open'])
+
+    def test_torn_record(self):
+        store = packstore.PackStore(self.path)
+        store.put('a', '1' * 10)
+        store.put('b', '2' * 10)
+        path = os.path.join(self.path, self.segments()[-1])
+        with open(path, 'r+b') as fp:
+            fp.truncate(os.path.getsize(path) - 5)
+        size = os.path.getsize(path)
+        store = packstore.PackStore(self.path)
+        self.assertEqual(store.keys(), ['a'])
+        store.put('c', '3')
+        self.assertEqual(store.get('c'), '3')
+        # the torn segment is sealed rather than truncated
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(self.segments(), ['00000000.pack',
+                                           '00000001.pack'])
+        self.assertEqual(sorted(packstore.PackStore(self.path).keys()),
+                         ['a', 'c'])
+
+    def test_corrupted(self):
+        store = packstore.PackStore(self.path)
+        store.put('a', '1' * 10)
+        path = os.path.join(self.path, self.segments()[-1])
+        with open(path, 'r+b') as fp:
+            fp.seek(-1, os.SEEK_END)
+            fp.write('x')
+        store = packstore.PackStore(self.path)
+        self.assertRaises(LFSException, store.get, 'a')
+        # header fields are covered by the crc
+        with open(path, 'r+b') as fp:
+            fp.seek(-1, os.SEEK_END)
+            fp.write('1')
+            fp.seek(4)
+            fp.write('\x02')
+        store = packstore.PackStore(self.path)
+        self.assertRaises(LFSException, store.get, 'a')
+
+    def test_corrupted_header(self):
+        store = packstore.PackStore(self.path, segment_size=100)
+        store.put('a', '1' * 10)
+        store.put('b', '2' * 10)
+        store.put('c', '3' * 60)
+        store.put('d', '4')
+        store.put('e', '5')
+        self.assertEqual(self.segments(), ['00000000.pack',
+                                           '00000001.pack'])
+        path = os.path.join(self.path, self.segments()[0])
+        size = os.path.getsize(path)
+        # length of a is too long, b and c follow it
+        with open(path, 'r+b') as fp:
+            fp.seek(7)
+            fp.write(packstore.struct.pack('<I', 1000))
+        logger = FakeLogger()
+        store = packstore.PackStore(self.path, segment_size=100,
+                                    logger=logger)
+        # scan goes on with b, the skipped record is logged
+        self.assertEqual(sorted(store.keys()), ['b', 'c', 'd', 'e'])
+        self.assertEqual(store.get('c'), '3' * 60)
+        self.assertEqual(len(logger.lines), 1)
+        self.assertEqual(store.segments[0]['skipped'],
+                         packstore.RECORD.size + 11)
+        self.assertEqual(os.path.getsize(path), size)
+        # valid records are moved out of the damaged segment
+        self.assertEqual(store.compact(min_garbage=0.1), 1)
+        self.assertEqual(self.segments(), ['00000001.pack'])
+        self.assertEqual(sorted(store.keys()), ['b', 'c', 'd', 'e'])
+        self.assertEqual(store.get('b'), '2' * 10)
+        # magic of d is broken, e follows it
+        path = os.path.join(self.path, self.segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as fp:
+            fp.write('XXXX')
+        store = packstore.PackStore(self.path, segment_size=100,
+                                    logger=logger)
+        self.assertEqual(sorted(store.keys()), ['b', 'c', 'e'])
+        self.assertEqual(len(logger.lines), 2)
+        # the damaged segment is sealed, appends go on in the next one
+        store.put('f', '6')
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(self.segments(), ['00000001.pack',
+                                           '00000002.pack'])
+        store = packstore.PackStore(self.path, segment_size=100,
+                                    logger=logger)
+        self.assertEqual(sorted(store.keys()), ['b', 'c', 'e', 'f'])
+        self.assertEqual(store.get('f'), '6')
+
+    def test_close_in_use(self):
+        store = packstore.PackStore(self.path)
+        store.put('a', '1')
+        store.close()
+        self.assertEqual(store.lock_fd, None)
+        # closed store is reopened on use
+        store.put('b', '2')
+        self.assertEqual(store.lock_fd, None)
+        self.assertEqual(store.get('a'), '1')
+        # closed by another greenthread while the lock is held
+        store._lock()
+        lock_fd = store.lock_fd
+        store.close()
+        self.assertEqual(store.lock_fd, lock_fd)
+        store._unlock()
+        self.assertEqual(store.lock_fd, None)
+        self.assertEqual(store.get('b'), '2')
+
+    def test_blocking_calls_in_thread(self):
+        store = packstore.PackStore(self.path)
+        calls = []
+        lock_fd = os.open(os.path.join(self.path, 'lock'),
+                          os.O_RDWR | os.O_CREAT)
+
+        def execute(func, *args):
+            calls.append(func)
+            if func is packstore.fcntl.flock:
+                # the other worker is done
+                packstore.fcntl.flock(lock_fd, packstore.fcntl.LOCK_UN)
+            return func(*args)
+
+        orig_execute = packstore.tpool.execute
+        packstore.tpool.execute = execute
+        try:
+            store.put('a', '1')
+            self.assertEqual(calls, [os.fsync])
+            # lock held by another worker is waited for in a thread
+            packstore.fcntl.flock(lock_fd, packstore.fcntl.LOCK_EX)
+            store.put('b', '2')
+            self.assertEqual(calls, [os.fsync, packstore.fcntl.flock,
+                                     os.fsync])
+        finally:
+            packstore.tpool.execute = orig_execute
+            os.close(lock_fd)
+        self.assertEqual(store.get('b'), '2')
+
+    def test_compact(self):
+        store = packstore.PackStore(self.path, segment_size=50, fsync=False)
+        reader = packstore.PackStore(self.path, segment_size=50)
+        # one record per segment, k1 and k2 are replaced in the last one
+        for i in range(4):
+            store.put('k%d' % i, str(i) * 60)
+        store.delete('k1')
+        store.put('k2', 'new')
+        self.assertEqual(reader.get('k0'), '0' * 60)
+        self.assertEqual(store.compact(min_garbage=0.9), 3)
+        self.assertEqual(self.segments(), ['00000003.pack',
+                                           '00000004.pack'])
+        self.assertEqual(sorted(store.keys()), ['k0', 'k2', 'k3'])
+        self.assertEqual(store.get('k0'), '0' * 60)
+        self.assertEqual(store.get('k2'), 'new')
+        # other worker follows records moved by compaction
+        self.assertEqual(reader.get('k0'), '0' * 60)
+        self.assertEqual(reader.get('k1'), None)
+        self.assertEqual(store.compact(min_garbage=0.9), 0)
+        stats = store.stats()
+        self.assertEqual(stats['keys'], 3)
+        self.assertEqual(stats['segments'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.policy """
+
+import unittest
+
+from swift_lfs import policy
+from swift_lfs.fs import StatusSnapshot
+
+
+class FakeStorage(object):
+    def __init__(self, statuses):
+        self.status_snapshot = StatusSnapshot(1, statuses)
+        self.fill_states = {}
+
+
+class TestDevicePolicy(unittest.TestCase):
+    """ Tests swift_lfs.policy.DevicePolicy """
+
+    def test_request_device(self):
+        self.assertEqual(policy.request_device({'PATH_INFO': '/sda1/1/a'}),
+                         'sda1')
+        self.assertEqual(policy.request_device({'PATH_INFO': '/sda1'}),
+                         'sda1')
+        self.assertEqual(policy.request_device({'PATH_INFO': '/'}), None)
+        self.assertEqual(policy.request_device({}), None)
+
+    def test_reject_faulted(self):
+        storage = FakeStorage({'sda1': 'faulted', 'sdb1': 'online'})
+        dev_policy = policy.DevicePolicy({}, storage)
+        error, release = dev_policy.admit({'REQUEST_METHOD': 'GET'}, 'sda1')
+        self.assertEqual(error.status_int, 507)
+        self.assertEqual(release, None)
+        error, release = dev_policy.admit({'REQUEST_METHOD': 'PUT'}, 'sdb1')
+        self.assertEqual(error, None)
+        self.assertEqual(release, None)
+
+    def test_degraded_writes(self):
+        storage = FakeStorage({'sda1': 'degraded'})
+        dev_policy = policy.DevicePolicy({'degraded_max_writes': '1'},
+                                         storage)
+        env = {'REQUEST_METHOD': 'PUT'}
+        error, release = dev_policy.admit(env, 'sda1')
+        self.assertEqual(error, None)
+        error2, release2 = dev_policy.admit(env, 'sda1')
+        self.assertEqual(error2.status_int, 503)
+        error, _junk = dev_policy.admit({'REQUEST_METHOD': 'GET'}, 'sda1')
+        self.assertEqual(error, None)
+        release()
+        error, release = dev_policy.admit(env, 'sda1')
+        self.assertEqual(error, None)
+
+    def test_fill_states(self):
+        storage = FakeStorage({'sda1': 'online', 'sdb1': 'online'})
+        storage.fill_states = {'sda1': 'full', 'sdb1': 'nearfull'}
+        dev_policy = policy.DevicePolicy({'nearfull_max_writes': '1'},
+                                         storage)
+        put = {'REQUEST_METHOD': 'PUT'}
+        delete = {'REQUEST_METHOD': 'DELETE'}
+        error, release = dev_policy.admit(put, 'sda1')
+        self.assertEqual(error.status_int, 507)
+        self.assertEqual(dev_policy.admit(delete, 'sda1'), (None, None))
+        error, release = dev_policy.admit(put, 'sdb1')
+        self.assertEqual(error, None)
+        error, _junk = dev_policy.admit(put, 'sdb1')
+        self.assertEqual(error.status_int, 503)
+        self.assertTrue('nearfull' in error.body)
+
+
+if __name__ == '__main__':
+    unittest.main()
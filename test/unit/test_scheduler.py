@@ -0,0 +1,127 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.scheduler """
+
+import unittest
+
+import eventlet
+
+from swift_lfs import scheduler
+from swift_lfs.fs import StatusSnapshot
+
+
+class FakeStorage(object):
+    def __init__(self, statuses):
+        self.status_snapshot = StatusSnapshot(1, statuses)
+
+
+def request(method='GET', user_agent=None):
+    env = {'REQUEST_METHOD': method, 'PATH_INFO': '/sda1/1/a/c/o'}
+    if user_agent:
+        env['HTTP_USER_AGENT'] = user_agent
+    return env
+
+
+class TestDeviceQueue(unittest.TestCase):
+    """ Tests swift_lfs.scheduler.DeviceQueue """
+
+    def test_weighted_order(self):
+        queue = scheduler.DeviceQueue(1, {'client': 2, 'background': 1})
+        self.assertTrue(queue.acquire('client', 0))
+        order = []
+
+        def wait(io_class):
+            if queue.acquire(io_class, 1):
+                order.append(io_class)
+
+        for io_class in ('background',) * 3 + ('client',) * 4:
+            eventlet.spawn_n(wait, io_class)
+        eventlet.sleep(0)
+        for _junk in range(7):
+            queue.release(order[-1] if order else 'client')
+            eventlet.sleep(0)
+        self.assertEqual(order, ['background', 'client', 'client',
+                                 'background', 'client', 'client',
+                                 'background'])
+
+    def test_background_slots(self):
+        queue = scheduler.DeviceQueue(4, {'client': 4, 'background': 1})
+        queue.background_slots = 1
+        self.assertTrue(queue.acquire('background', 0))
+        self.assertFalse(queue.acquire('background', 0.01))
+        self.assertTrue(queue.acquire('client', 0))
+        self.assertEqual(queue.waiting['background'], scheduler.deque())
+
+    def test_timeout(self):
+        queue = scheduler.DeviceQueue(1, {'client': 1, 'background': 1})
+        self.assertTrue(queue.acquire('client', 0))
+        self.assertFalse(queue.acquire('client', 0.01))
+        queue.release('client')
+        self.assertEqual(queue.running['client'], 0)
+
+
+class TestIOScheduler(unittest.TestCase):
+    """ Tests swift_lfs.scheduler.IOScheduler """
+
+    def test_disabled(self):
+        sched = scheduler.IOScheduler({}, FakeStorage({}))
+        self.assertEqual(sched.admit(request(), 'sda1'), (None, None))
+
+    def test_classify(self):
+        sched = scheduler.IOScheduler({}, FakeStorage({}))
+        self.assertEqual(sched.classify(request()), 'client')
+        self.assertEqual(sched.classify(request('REPLICATE')), 'background')
+        self.assertEqual(
+            sched.classify(request('PUT', 'object-replicator 1234')),
+            'background')
+        self.assertEqual(sched.classify(request('PUT', 'curl/7.22')),
+                         'client')
+
+    def test_background_limit(self):
+        storage = FakeStorage({'sda1': 'online'})
+        sched = scheduler.IOScheduler({'device_slots': 16}, storage)
+        queue = scheduler.DeviceQueue(16, sched.weights)
+        self.assertEqual(sched.background_limit('sda1', queue), 8)
+        storage.status_snapshot = StatusSnapshot(2, {'sda1': 'degraded'})
+        self.assertEqual(sched.background_limit('sda1', queue), 4)
+        queue.add_latency(1)
+        self.assertEqual(sched.background_limit('sda1', queue), 2)
+        sched.background_slots = 1
+        self.assertEqual(sched.background_limit('sda1', queue), 1)
+
+    def test_admit(self):
+        sched = scheduler.IOScheduler(
+            {'device_slots': 1, 'queue_timeout': 0.01}, FakeStorage({}))
+        error, release = sched.admit(request(), 'sda1')
+        self.assertEqual(error, None)
+        queue = sched.devices['sda1']
+        latency = queue.latency
+        self.assertTrue(latency < 0.01)
+        error, _junk = sched.admit(request(), 'sda1')
+        self.assertEqual(error.status_int, 503)
+        # latency is the time spent waiting for a slot
+        self.assertTrue(queue.latency > latency)
+        latency = queue.latency
+        release()
+        self.assertEqual(queue.running['client'], 0)
+        self.assertEqual(queue.latency, latency)
+        # background waits don't count
+        sched.admit(request('REPLICATE'), 'sda1')
+        self.assertEqual(queue.latency, latency)
+
+
+if __name__ == '__main__':
+    unittest.main()
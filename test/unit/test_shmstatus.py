@@ -0,0 +1,70 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.shmstatus """
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift_lfs import shmstatus
+from swift_lfs.exceptions import LFSException
+
+
+class TestSharedStatus(unittest.TestCase):
+    """ Test swift_lfs.shmstatus.SharedStatus """
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, 'run', 'lfs-object.status')
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_write_read(self):
+        writer = shmstatus.SharedStatus(self.path, size=64)
+        reader = shmstatus.SharedStatus(self.path, size=64)
+        self.assertEqual(reader.read(), None)
+        self.assertEqual(writer.write('sda1:online'), 2)
+        self.assertEqual(reader.sequence(), 2)
+        self.assertEqual(reader.read(), (2, 'sda1:online'))
+        writer.write('sda1:faulted')
+        self.assertEqual(reader.read(), (4, 'sda1:faulted'))
+        self.assertRaises(LFSException, writer.write, 'x' * 64)
+
+    def test_read_during_write(self):
+        status = shmstatus.SharedStatus(self.path, size=64)
+        status.write('sda1:online')
+        shmstatus.HEADER.pack_into(status.mm, 0, 3, 11)
+        self.assertEqual(status.read(retries=3), None)
+        # writer died in the middle, next write makes sequence even again
+        self.assertEqual(status.write('sda1:online'), 6)
+
+    def test_elect(self):
+        status = shmstatus.SharedStatus(self.path, size=64)
+        self.assertFalse(status.leader)
+        self.assertTrue(status.elect())
+        self.assertTrue(status.leader)
+        pid = os.fork()
+        if not pid:
+            # the lock is not inherited and is held by the parent
+            other = shmstatus.SharedStatus(self.path, size=64)
+            os._exit(int(status.leader or other.elect()))
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
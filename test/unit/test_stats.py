@@ -0,0 +1,70 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.stats """
+
+import unittest
+
+from swift_lfs import stats
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class TestStatsCollector(unittest.TestCase):
+    """ Tests swift_lfs.stats.StatsCollector """
+
+    def test_record(self):
+        collector = stats.StatsCollector('object')
+        collector.record('sda1', 0.002, 100, 0, False)
+        collector.record('sda1', 0.3, 0, 4096, True)
+        collector.record(None, 20, 0, 10, False)
+        self.assertEqual(collector.total.requests, 3)
+        sda1 = collector.devices['sda1']
+        self.assertEqual(sda1.requests, 2)
+        self.assertEqual(sda1.errors, 1)
+        self.assertEqual(sda1.bytes_in, 100)
+        self.assertEqual(sda1.bytes_out, 4096)
+        self.assertEqual(sda1.histogram[1], 1)
+        self.assertEqual(sda1.histogram[8], 1)
+        self.assertEqual(collector.total.histogram[-1], 1)
+        self.assertEqual(sda1.percentile(0.5), 0.0025)
+        self.assertEqual(sda1.percentile(0.99), 0.5)
+        self.assertEqual(collector.total.percentile(1), None)
+
+    def test_render(self):
+        collector = stats.StatsCollector('object')
+        collector.record('sda1', 0.002, 100, 0, False)
+        data = json.loads(collector.render_json())
+        self.assertEqual(data['storage_type'], 'object')
+        self.assertEqual(data['devices']['sda1']['bytes_in'], 100)
+        self.assertEqual(data['total']['requests'], 1)
+        lines = collector.render_text().split('\n')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('object requests=1 '))
+        self.assertTrue(lines[1].startswith('sda1 requests=1 '))
+        self.assertTrue('latency_le_0.0025=1' in lines[1])
+        self.assertTrue('latency_p50=0.0025 latency_p99=0.0025' in lines[1])
+        self.assertEqual(data['devices']['sda1']['latency_p99'], 0.0025)
+        collector.record('sda1', 20, 0, 0, False)
+        data = json.loads(collector.render_json())
+        self.assertEqual(data['devices']['sda1']['latency_p99'], None)
+        self.assertTrue('latency_p99=- ' in collector.render_text())
+
+
+if __name__ == '__main__':
+    unittest.main()
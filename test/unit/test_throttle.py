@@ -0,0 +1,99 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.throttle """
+
+import unittest
+
+from swift_lfs import throttle
+from swift_lfs.policy import request_account
+
+
+class FakeStorage(object):
+    def __init__(self):
+        self.status_info = {}
+
+    def set_status_info(self, section, value):
+        self.status_info[section] = value
+
+
+def request(account='AUTH_a'):
+    return {'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/sda1/1/%s/c/o' % account}
+
+
+class TestAccountThrottle(unittest.TestCase):
+    """ Tests swift_lfs.throttle.AccountThrottle """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def get_throttle(self, conf, storage):
+        return throttle.AccountThrottle(conf, storage,
+                                        clock=lambda: self.now,
+                                        sleep=self.sleeps.append)
+
+    def test_request_account(self):
+        self.assertEqual(request_account(request()), 'AUTH_a')
+        self.assertEqual(request_account({'PATH_INFO': '/sda1/1'}), None)
+        self.assertEqual(request_account({'PATH_INFO': '/sda1/1/'}), None)
+
+    def test_disabled(self):
+        storage = FakeStorage()
+        limiter = self.get_throttle({}, storage)
+        self.assertEqual(limiter.admit(request(), 'sda1'), (None, None))
+        limiter.publish()
+        self.assertEqual(storage.status_info, {})
+
+    def test_token_bucket(self):
+        storage = FakeStorage()
+        limiter = self.get_throttle(
+            {'account_rate': 10, 'account_burst': 2, 'account_max_wait': 0.25},
+            storage)
+        for _junk in range(2):
+            self.assertEqual(limiter.admit(request(), 'sda1'), (None, None))
+        self.assertEqual(self.sleeps, [])
+        # over the rate, queued behind each other
+        self.assertEqual(limiter.admit(request(), 'sda1'), (None, None))
+        self.assertEqual(limiter.admit(request(), 'sda1'), (None, None))
+        self.assertEqual([round(sleep, 3) for sleep in self.sleeps],
+                         [0.1, 0.2])
+        error, _junk = limiter.admit(request(), 'sda1')
+        self.assertEqual(error.status_int, 503)
+        # other accounts and devices are not affected
+        self.assertEqual(limiter.admit(request('AUTH_b'), 'sda1'),
+                         (None, None))
+        self.assertEqual(limiter.admit(request(), 'sdb1'), (None, None))
+        self.assertEqual(len(self.sleeps), 2)
+        self.now += 1
+        self.assertEqual(limiter.admit(request(), 'sda1'), (None, None))
+        self.assertEqual(len(self.sleeps), 2)
+        limiter.publish()
+        self.assertEqual(storage.status_info['account_throttle'],
+                         {'accounts': 3,
+                          'devices': {'sda1': {'queued': 2,
+                                               'throttled': 1}}})
+
+    def test_bounded(self):
+        limiter = self.get_throttle(
+            {'account_rate': 1, 'account_cache_size': 10}, FakeStorage())
+        for account in range(100):
+            limiter.admit(request('AUTH_%d' % account), 'sda1')
+        self.assertEqual(len(limiter.buckets), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
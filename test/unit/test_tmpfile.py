@@ -0,0 +1,81 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.tmpfile """
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift_lfs import tmpfile
+from test.unit import FakeLogger
+
+
+class TestTmpFilePool(unittest.TestCase):
+    """ Tests swift_lfs.tmpfile.TmpFilePool """
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_get(self):
+        pool = tmpfile.TmpFilePool(self.testdir, 4, FakeLogger())
+        pool.filling = True
+        pool.fill()
+        self.assertEqual(len(pool.files), 4)
+        self.assertFalse(pool.filling)
+        pooled = pool.files[0][1]
+        fd, path = pool.get()
+        self.assertEqual(path, pooled)
+        self.assertTrue(os.path.basename(path).startswith(
+            tmpfile.pool_prefix()))
+        os.close(fd)
+        pool.close()
+        self.assertEqual(os.listdir(self.testdir),
+                         [os.path.basename(path)])
+
+    def test_get_empty_pool(self):
+        pool = tmpfile.TmpFilePool(self.testdir, 0, FakeLogger())
+        fd, path = pool.get()
+        os.close(fd)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(pool.filling)
+
+    def test_cleanup_orphans(self):
+        dead = os.path.join(self.testdir, tmpfile.pool_prefix(2 ** 22 + 1))
+        live = os.path.join(self.testdir, tmpfile.pool_prefix() + 'x')
+        old = os.path.join(self.testdir, 'tmpold')
+        new = os.path.join(self.testdir, 'tmpnew')
+        for path in (dead, live, old, new):
+            open(path, 'w').close()
+        os.utime(old, (0, 0))
+        # idle pooled file of a live worker is still in its pool
+        os.utime(live, (0, 0))
+        os.mkdir(os.path.join(self.testdir, 'dir'))
+        os.utime(os.path.join(self.testdir, 'dir'), (0, 0))
+        self.assertEqual(
+            tmpfile.cleanup_orphans(self.testdir, 3600, FakeLogger()), 2)
+        self.assertEqual(sorted(os.listdir(self.testdir)),
+                         sorted(['dir', os.path.basename(live), 'tmpnew']))
+        self.assertEqual(
+            tmpfile.cleanup_orphans(os.path.join(self.testdir, 'none'),
+                                    3600, FakeLogger()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.utils """
+
+import unittest
+
+from swift_lfs import utils
+
+
+class TestLRUCache(unittest.TestCase):
+    """ Tests swift_lfs.utils.LRUCache """
+
+    def test_eviction(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = utils.LRUCache(1, on_evict=lambda *item: evicted.append(item))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(evicted, [('a', 1)])
+        self.assertEqual(cache.items(), [('b', 2)])
+
+    def test_disabled(self):
+        cache = utils.LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_pop_clear(self):
+        cache = utils.LRUCache(10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
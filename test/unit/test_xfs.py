@@ -0,0 +1,123 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.fs.xfs """
+
+import os
+import unittest
+
+from swift_lfs import fs
+from swift_lfs.fs import xfs
+from test.unit import FakeLogger, FakeRing, LocalNodeTestCase, local_devs
+
+
+MOUNTINFO = """\
+15 20 0:14 / /sys rw,nosuid,nodev,noexec,relatime shared:7 - sysfs sysfs rw
+40 20 8:17 / %(devices)s/sda1 rw,noatime shared:30 - xfs /dev/sdb1 rw,inode64
+41 20 8:33 / %(devices)s/sdb1 ro,noatime shared:31 - xfs /dev/sdc1 rw
+42 20 8:49 / %(devices)s/sdc1 rw,noatime - ext4 /dev/sdd1 rw,data=ordered
+43 20 8:65 / %(devices)s/sd\\040e1 rw,noatime - xfs /dev/sde1 rw
+"""
+
+
+class TestLFSXFS(LocalNodeTestCase):
+    """ Tests swift_lfs.fs.xfs.LFSXFS """
+
+    def setUp(self):
+        super(TestLFSXFS, self).setUp()
+        self.mountinfo = os.path.join(self.testdir, 'mountinfo')
+        with open(self.mountinfo, 'w') as fp:
+            fp.write(MOUNTINFO % {'devices': self.testdir})
+        devs = local_devs(('sda1', 'sdb1', 'sdc1', 'sdd1', 'sd e1'))
+        self.storage = xfs.LFSXFS(
+            {'devices': self.testdir, 'mountinfo_path': self.mountinfo},
+            FakeRing(devs), 'objects', 6000, FakeLogger())
+        self.storage.probe_timeout = None
+
+    def test_parse_mountinfo(self):
+        mounts = xfs.parse_mountinfo(self.mountinfo)
+        self.assertEqual(mounts['/sys']['fstype'], 'sysfs')
+        sda1 = mounts[os.path.join(self.testdir, 'sda1')]
+        self.assertEqual(sda1['source'], '/dev/sdb1')
+        self.assertTrue('inode64' in sda1['options'])
+        self.assertTrue('noatime' in sda1['options'])
+        self.assertTrue(os.path.join(self.testdir, 'sd e1') in mounts)
+
+    def test_get_mount_status(self):
+        mounts = xfs.parse_mountinfo(self.mountinfo)
+        statuses = dict((device,
+                         self.storage.get_mount_status(mounts, device))
+                        for device in self.storage.local_devices)
+        self.assertEqual(statuses, {'sda1': 'online', 'sdb1': 'faulted',
+                                    'sdc1': 'unavailable',
+                                    'sdd1': 'unavailable',
+                                    'sd e1': 'online'})
+        self.storage.mount_check = False
+        self.assertEqual(self.storage.get_mount_status(mounts, 'sdd1'),
+                         'online')
+        self.assertEqual(self.storage.get_mount_status(mounts, 'sdc1'),
+                         'unavailable')
+
+    def test_check_device(self):
+        xfs.call_in_thread = lambda timeout, func, *args, **kwargs: \
+            func(*args)
+        try:
+            ret = self.storage.check_device()
+        finally:
+            xfs.call_in_thread = fs.call_in_thread
+        self.assertEqual(ret, (self.storage.error_callback, ()))
+        self.assertEqual(self.storage.faulted_devices, set(['sdb1']))
+        self.assertEqual(self.storage.unavailable_devices,
+                         set(['sdc1', 'sdd1']))
+        self.assertEqual(self.storage.status_snapshot.statuses['sda1'],
+                         'online')
+
+    def test_setup_device(self):
+        calls = []
+
+        def fake_call_in_thread(timeout, func, *args, **kwargs):
+            calls.append((func, kwargs.get('key')))
+            return func(*args)
+
+        geometry = {'agcount': 4, 'agsize': 6553600, 'bsize': 4096}
+
+        def fake_get_geometry(path):
+            return geometry
+
+        orig_get_geometry = xfs.get_geometry
+        xfs.call_in_thread = fake_call_in_thread
+        xfs.get_geometry = fake_get_geometry
+        try:
+            self.storage.setup_device('sda1')
+        finally:
+            xfs.call_in_thread = fs.call_in_thread
+            xfs.get_geometry = orig_get_geometry
+        self.assertEqual(self.storage.geometry['sda1'], geometry)
+        # mount table is read in a thread like by check_device
+        self.assertEqual(calls, [(fake_get_geometry, 'sda1'),
+                                 (xfs.parse_mountinfo, self.mountinfo)])
+
+    def test_geometry_re(self):
+        out = ('meta-data=/dev/sdb1    isize=512    agcount=4, '
+               'agsize=6553600 blks\n'
+               '         =             sectsz=512   attr=2\n'
+               'data     =             bsize=4096   blocks=26214400\n')
+        match = xfs.GEOMETRY_RE.search(out)
+        self.assertEqual(match.groups(), ('4', '6553600'))
+        self.assertEqual(xfs.BSIZE_RE.search(out).group(1), '4096')
+
+
+if __name__ == '__main__':
+    unittest.main()
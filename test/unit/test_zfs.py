@@ -0,0 +1,508 @@
+# Copyright (c) 2011-2012 Nexenta Systems Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests swift_lfs.fs.zfs against a stand-in for nspyzfs """
+
+import os
+import sys
+import types
+import unittest
+from shutil import rmtree
+from StringIO import StringIO
+
+from swift.common.exceptions import SwiftConfigurationError
+
+from swift_lfs import fs
+from swift_lfs.exceptions import LFSException, LFSTimeout
+from test.unit import FakeLogger, FakeRing, LocalNodeTestCase, local_devs
+
+
+class NSPyZFSError(Exception):
+    pass
+
+
+class FakeDataset(object):
+
+    def __init__(self):
+        # {<dataset name>: {<property>: <value>}}
+        self.datasets = {}
+        self.calls = []
+
+    def exists_fs(self, name):
+        return name in self.datasets
+
+    def create_fs(self, name, recursive, **props):
+        self.calls.append(('create_fs', name))
+        self.datasets[name] = dict(props, mounted='yes')
+
+    def get(self, name, prop):
+        return self.datasets[name].get(prop, '-')
+
+    def set(self, name, prop, value):
+        self.calls.append(('set', name, prop, value))
+        self.datasets[name][prop] = value
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.health = {}
+
+    def status(self, name):
+        if name not in self.health:
+            raise NSPyZFSError(name)
+        return {'health': self.health[name]}
+
+
+nspyzfs = types.ModuleType('nspyzfs')
+nspyzfs.NSPyZFSError = NSPyZFSError
+nspyzfs.dataset = FakeDataset()
+nspyzfs.pool = FakePool()
+sys.modules.setdefault('nspyzfs', nspyzfs)
+# imported once the stand-in is registered
+zfs = __import__('swift_lfs.fs.zfs', fromlist=['LFSZFS'])
+
+
+class FakeProc(object):
+
+    def __init__(self, args, stdout='', stderr='', returncode=0):
+        self.args = args
+        self.stdout = StringIO(stdout)
+        self.stderr = StringIO(stderr)
+        self.stdin = StringIO()
+        self.stdin.close = lambda: None
+        self.returncode = None
+        self._returncode = returncode
+        self.killed = False
+
+    def communicate(self):
+        self.returncode = self._returncode
+        return self.stdout.read(), self.stderr.read()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.returncode = self._returncode
+        return self.returncode
+
+    def kill(self):
+        self.killed = True
+
+
+class TestLFSZFS(LocalNodeTestCase):
+    """ Tests swift_lfs.fs.zfs.LFSZFS """
+
+    def setUp(self):
+        super(TestLFSZFS, self).setUp()
+        self.orig_call_in_thread = zfs.call_in_thread
+        zfs.call_in_thread = self.fake_call_in_thread
+        self.call_keys = []
+        self.orig_popen_zfs = zfs.popen_zfs
+        self.procs = []
+        self.proc_output = {}
+        zfs.popen_zfs = self.fake_popen_zfs
+        self.orig_dataset = zfs.dataset
+        self.orig_pool = zfs.pool
+        zfs.dataset = FakeDataset()
+        zfs.pool = FakePool()
+        devs = local_devs(('sda1', 'sdb1'))
+        self.logger = FakeLogger()
+        self.storage = zfs.LFSZFS(
+            {'devices': '/srv/node', 'storage_type': 'object'},
+            FakeRing(devs), 'objects', 6000, self.logger)
+
+    def tearDown(self):
+        super(TestLFSZFS, self).tearDown()
+        zfs.call_in_thread = self.orig_call_in_thread
+        zfs.popen_zfs = self.orig_popen_zfs
+        zfs.dataset = self.orig_dataset
+        zfs.pool = self.orig_pool
+
+    def fake_call_in_thread(self, timeout, func, *args, **kwargs):
+        self.call_keys.append(kwargs.pop('key', None))
+        return func(*args, **kwargs)
+
+    def fake_popen_zfs(self, args, **kwargs):
+        output = self.proc_output.get(args[0], ())
+        if not output and args[0] == 'get':
+            props = args[4].split(',')
+            lines = ['%s\t%s\t%s\n' % (name, prop, zfs.dataset.get(name, prop))
+                     for name in args[5:] for prop in props]
+            output = (''.join(lines),)
+        elif not output and args[0] == 'set':
+            for arg in args[1:-1]:
+                zfs.dataset.set(args[-1], *arg.split('=', 1))
+        proc = FakeProc(list(args), *output)
+        self.procs.append(proc)
+        return proc
+
+    def test_profile(self):
+        self.assertEqual(zfs.get_profile({}, 'object'), {})
+        self.assertEqual(zfs.get_profile({'object_xattr': 'sa',
+                                          'account_atime': 'off'}, 'object'),
+                         {'xattr': 'sa'})
+        profile = zfs.get_profile({'default_profile': 'yes',
+                                   'object_recordsize': '1M'}, 'object')
+        self.assertEqual(profile['recordsize'], '1M')
+        self.assertEqual(profile['logbias'], 'throughput')
+        self.assertFalse('xattr' in profile)
+        # nothing but mountpoint and compression is managed by default
+        self.assertEqual(self.storage.wanted_properties('sda1'),
+                         {'mountpoint': '/srv/node/sda1',
+                          'compression': 'off'})
+
+    def test_setup_device(self):
+        self.storage.profile = zfs.get_profile({'default_profile': 'yes'},
+                                               'object')
+        self.storage.setup_device('sda1')
+        props = zfs.dataset.datasets['sda1']
+        self.assertEqual(props['mountpoint'], '/srv/node/sda1')
+        self.assertEqual(props['recordsize'], '128K')
+        self.assertEqual(props['logbias'], 'throughput')
+        zfs.dataset.calls = []
+        zfs.dataset.datasets['sda1']['atime'] = 'on'
+        self.storage.setup_device('sda1')
+        self.assertEqual(zfs.dataset.calls,
+                         [('set', 'sda1', 'atime', 'off')])
+
+    def test_setup_devices(self):
+        self.storage.profile = zfs.get_profile(
+            {'default_profile': 'yes', 'object_xattr': 'sa'}, 'object')
+        self.storage.setup_devices(['sda1', 'sdb1'])
+        zfs.dataset.calls = []
+        self.procs = []
+        zfs.dataset.datasets['sda1']['atime'] = 'on'
+        zfs.dataset.datasets['sda1']['xattr'] = 'on'
+        zfs.dataset.datasets['sdb1']['recordsize'] = '131072'
+        self.storage.setup_devices(['sda1', 'sdb1'])
+        # one bulk read for both datasets, one write for the changed one
+        self.assertEqual([proc.args[0] for proc in self.procs],
+                         ['get', 'set'])
+        self.assertEqual(self.procs[0].args[5:], ['sda1', 'sdb1'])
+        self.assertEqual(self.procs[1].args,
+                         ['set', 'atime=off', 'xattr=sa', 'sda1'])
+        self.assertEqual(self.storage.status_info['zfs_reconcile']['changed'],
+                         1)
+
+    def test_setup_devices_fallback(self):
+        fake_popen_zfs = self.fake_popen_zfs
+        broken = set(['sdb1'])
+
+        def failing_popen_zfs(args, **kwargs):
+            if args[0] == 'get' and broken.intersection(args[5:]):
+                return FakeProc(list(args), '', 'I/O error', 1)
+            return fake_popen_zfs(args, **kwargs)
+
+        zfs.popen_zfs = failing_popen_zfs
+        self.storage.setup_devices(['sda1', 'sdb1'])
+        # the bulk read failed, sda1 is set up on its own
+        self.assertEqual(zfs.dataset.datasets['sda1']['mountpoint'],
+                         '/srv/node/sda1')
+        self.assertEqual(self.storage.setup_pending, set(['sdb1']))
+        self.assertEqual(self.storage.status_snapshot.statuses['sdb1'],
+                         'timeout')
+        self.assertEqual(self.storage.status_snapshot.statuses['sda1'],
+                         'online')
+        # a single device is not retried in the same pass
+        self.assertRaises(LFSException, self.storage.setup_devices,
+                          ['sdb1'])
+        # the ring watcher retries the pending device
+        broken.clear()
+        self.storage.setup_each_device(['sdb1'])
+        self.assertEqual(self.storage.setup_pending, set())
+
+    def test_run_zfs_timeout(self):
+        timers = []
+
+        class FakeTimeout(zfs.Timeout):
+            def __init__(self, seconds=None):
+                self.seconds = seconds
+                timers.append(self)
+
+            def cancel(self):
+                pass
+
+        def hang():
+            raise timers[-1]
+
+        def popen_hung_zfs(args, **kwargs):
+            proc = FakeProc(list(args))
+            proc.communicate = hang
+            self.procs.append(proc)
+            return proc
+
+        orig_timeout = zfs.Timeout
+        zfs.Timeout = FakeTimeout
+        zfs.popen_zfs = popen_hung_zfs
+        try:
+            self.assertRaises(LFSTimeout, zfs.get_bulk_properties,
+                              ['sda1'], ['mounted'], timeout=5)
+            # a hung zfs set is not retried property by property
+            self.assertRaises(LFSTimeout, zfs.set_bulk_properties, 'sda1',
+                              {'atime': 'off', 'xattr': 'sa'}, timeout=5)
+        finally:
+            zfs.Timeout = orig_timeout
+        self.assertEqual([timer.seconds for timer in timers], [5, 5])
+        self.assertEqual(len(self.procs), 2)
+        self.assertTrue(self.procs[0].killed)
+        self.assertTrue(self.procs[1].killed)
+
+    def test_tier_dataset(self):
+        devs = local_devs(('sda1', 'sdb1'))
+        storage = zfs.LFSZFS(
+            {'devices': '/srv/node', 'storage_type': 'object',
+             'datadir_roots': 'object:ssd/lfs',
+             'partition_datasets': 'yes'},
+            FakeRing(devs), 'objects', 6000, self.logger)
+        self.assertRaises(LFSException, storage.setup_devices, ['sda1'])
+        zfs.dataset.datasets['ssd/lfs'] = {'mountpoint': self.testdir}
+        storage.setup_devices(['sda1'])
+        self.assertEqual(storage.tier_roots['datadir'], self.testdir)
+        self.assertEqual(
+            zfs.dataset.datasets['ssd/lfs/sda1']['mountpoint'],
+            os.path.join(self.testdir, 'sda1'))
+        self.assertEqual(zfs.dataset.datasets['sda1']['mountpoint'],
+                         '/srv/node/sda1')
+        self.assertTrue(os.path.isdir(os.path.join(self.testdir, 'sda1',
+                                                   'objects')))
+        self.assertEqual(storage.get_dataset('sda1', '5'),
+                         'ssd/lfs/sda1/objects/5')
+        zfs.pool.health = {'ssd': 'ONLINE'}
+        self.assertEqual(storage.get_tier_faults(), set(['sdb1']))
+        zfs.pool.health = {'ssd': 'FAULTED'}
+        self.assertEqual(storage.get_tier_faults(),
+                         set(['sda1', 'sdb1']))
+
+    def test_tmp_tier_dataset(self):
+        devs = local_devs(['sda1'])
+        for tiers in ({'tmp_roots': 'object:ssd/tmp'},
+                      {'datadir_roots': 'object:ssd/lfs',
+                       'tmp_roots': 'object:ssd/tmp'}):
+            conf = dict(tiers, devices='/srv/node', storage_type='object')
+            self.assertRaises(SwiftConfigurationError, zfs.LFSZFS, conf,
+                              FakeRing(devs), 'objects', 6000, self.logger)
+        storage = zfs.LFSZFS(
+            {'devices': '/srv/node', 'storage_type': 'object',
+             'datadir_roots': 'object:ssd/lfs'},
+            FakeRing(devs), 'objects', 6000, self.logger)
+        self.assertEqual(storage.tier_datasets,
+                         {'datadir': 'ssd/lfs', 'tmp': 'ssd/lfs'})
+
+    def test_sample_capacity(self):
+        zfs.dataset.datasets['ssd/lfs/sda1'] = {'available': '3G',
+                                                'used': '1G'}
+        storage = zfs.LFSZFS(
+            {'devices': '/srv/node', 'storage_type': 'object',
+             'datadir_roots': 'object:ssd/lfs'},
+            FakeRing(local_devs(['sda1'])), 'objects', 6000, self.logger)
+        popen_args = []
+        output = ['ssd\tfragmentation\t12\t-\n']
+
+        def fake_popen(args, **kwargs):
+            popen_args.append(args)
+            return FakeProc(args, *output)
+
+        orig_popen = zfs.native_subprocess.Popen
+        zfs.native_subprocess.Popen = fake_popen
+        try:
+            sample = storage.sample_capacity('sda1')
+            self.assertEqual(popen_args,
+                             [['zpool', 'get', '-Hp', 'fragmentation',
+                               'ssd']])
+            self.assertEqual(sample, {'size': 4 * 1024 ** 3,
+                                      'available': 3 * 1024 ** 3,
+                                      'used': 1024 ** 3,
+                                      'fragmentation': 12})
+            # pool without spacemap_histogram feature
+            output[0] = 'ssd\tfragmentation\t-\t-\n'
+            self.assertEqual(storage.sample_capacity('sda1')['fragmentation'],
+                             None)
+            # space is still sampled when zpool fails
+            output[:] = ['', 'no such pool', 1]
+            sample = storage.sample_capacity('sda1')
+        finally:
+            zfs.native_subprocess.Popen = orig_popen
+        self.assertFalse('fragmentation' in sample)
+        self.assertEqual(sample['available'], 3 * 1024 ** 3)
+
+    def test_tune_compression(self):
+        self.storage.cpu_meter = type('FakeCPUMeter', (object,),
+                                      {'usage': lambda self: 10.0})()
+        self.storage.compression_bounds.update(hysteresis=1, min_written=1)
+        for device in ('sda1', 'sdb1'):
+            zfs.dataset.datasets[device] = {
+                'compression': 'lz4', 'logicalused': '30G', 'used': '10G'}
+        self.storage.tune_compression()
+        # incompressible data written since the first sample
+        zfs.dataset.datasets['sda1'].update(logicalused='31G', used='11G')
+        self.storage.tune_compression()
+        self.assertEqual(zfs.dataset.datasets['sda1']['compression'], 'off')
+        self.assertEqual(zfs.dataset.datasets['sdb1']['compression'], 'lz4')
+        info = self.storage.status_snapshot.info['compression']
+        self.assertEqual(info['devices']['sda1'],
+                         {'compression': 'off', 'compressratio': 1.0})
+        self.assertEqual(info['devices']['sdb1'],
+                         {'compression': 'lz4', 'compressratio': None})
+
+    def test_set_bulk_properties_fallback(self):
+        zfs.dataset.datasets['sda1'] = {}
+        self.proc_output['set'] = ('', 'too many arguments', 1)
+        self.assertRaises(LFSException, zfs.set_bulk_properties, 'sda1',
+                          {'atime': 'off', 'xattr': 'sa'})
+        self.assertEqual([proc.args for proc in self.procs],
+                         [['set', 'atime=off', 'xattr=sa', 'sda1'],
+                          ['set', 'atime=off', 'sda1']])
+
+    def test_check_device(self):
+        zfs.pool.health = {'sda1': 'ONLINE', 'sdb1': 'DEGRADED'}
+        self.assertEqual(self.storage.check_device(),
+                         (self.storage.error_callback, ()))
+        # hung probes are tracked per pool
+        self.assertEqual(self.call_keys, ['sda1', 'sdb1'])
+        self.assertEqual(self.storage.get_device_status(),
+                         {'sda1': 'online', 'sdb1': 'degraded'})
+        zfs.pool.health = {'sda1': 'ONLINE', 'sdb1': 'ONLINE'}
+        self.assertEqual(self.storage.check_device(), None)
+        self.assertEqual(self.storage.get_device_status(),
+                         {'sda1': 'online', 'sdb1': 'online'})
+
+    def test_parse_size(self):
+        self.assertEqual(zfs.parse_size('1024'), 1024)
+        self.assertEqual(zfs.parse_size('1.5K'), 1536)
+        self.assertEqual(zfs.parse_size('2T'), 2 * 1024 ** 4)
+
+    def test_snapshot(self):
+        self.assertEqual(self.storage.snapshot('s1'), 'sda1@s1')
+        self.assertEqual(self.procs[-1].args, ['snapshot', 'sda1@s1'])
+        self.storage.snapshot('s1', device='sdb1')
+        self.assertEqual(self.procs[-1].args, ['snapshot', 'sdb1@s1'])
+        self.assertRaises(LFSException, self.storage.snapshot, 's 1')
+        self.assertRaises(LFSException, self.storage.snapshot, 's1',
+                          partition='1')
+
+    def test_snapshot_failure(self):
+        self.proc_output['snapshot'] = ('', 'dataset is busy', 1)
+        try:
+            self.storage.snapshot('s1')
+        except LFSException, e:
+            self.assertTrue('dataset is busy' in str(e))
+        else:
+            self.fail('LFSException not raised')
+
+    def test_list_snapshots(self):
+        self.proc_output['list'] = ('sda1@s1\nsda1@s2\n',)
+        self.assertEqual(self.storage.list_snapshots(), ['s1', 's2'])
+        self.assertEqual(self.procs[-1].args[-1], 'sda1')
+
+    def test_send_snapshot(self):
+        self.proc_output['send'] = ('x' * 10,)
+        chunks = list(self.storage.send_snapshot('s2', base='s1',
+                                                 chunk_size=4))
+        self.assertEqual(chunks, ['xxxx', 'xxxx', 'xx'])
+        self.assertEqual(self.procs[-1].args,
+                         ['send', '-i', 'sda1@s1', 'sda1@s2'])
+        self.proc_output['send'] = ('', 'no such snapshot', 1)
+        self.assertRaises(LFSException, list,
+                          self.storage.send_snapshot('s3'))
+
+    def test_receive_snapshot(self):
+        self.storage.partition_datasets = True
+        self.storage.partition_cache['sdb1'] = fs.LRUCache(10)
+        self.storage.partition_cache['sdb1'].set('1', '/srv/node/sdb1/1')
+        self.storage.partition_cache['sdb1'].set('2', '/srv/node/sdb1/2')
+        self.storage.receive_snapshot(iter(['ab', 'cd']), device='sdb1',
+                                      partition='1')
+        proc = self.procs[-1]
+        self.assertEqual(proc.args, ['receive', 'sdb1/objects/1'])
+        self.assertEqual(proc.stdin.getvalue(), 'abcd')
+        self.assertFalse('1' in self.storage.partition_cache['sdb1'])
+        self.assertTrue('2' in self.storage.partition_cache['sdb1'])
+        # device dataset is never overwritten
+        self.assertRaises(LFSException, self.storage.receive_snapshot,
+                          iter(['ab']), device='sdb1')
+        self.proc_output['receive'] = ('', 'destination has been modified', 1)
+        self.assertRaises(LFSException, self.storage.receive_snapshot,
+                          iter(['ab']), device='sdb1', partition='1')
+
+    def test_partition_datasets(self):
+        self.assertRaises(LFSException, self.storage.get_dataset,
+                          partition='1')
+        self.storage.partition_datasets = True
+        self.assertEqual(self.storage.get_dataset('sdb1', '1'),
+                         'sdb1/objects/1')
+        path = self.storage.setup_partition('1', 'sdb1')
+        self.assertEqual(path, '/srv/node/sdb1/objects/1')
+        self.assertEqual(zfs.dataset.calls, [('create_fs', 'sdb1/objects'),
+                                             ('create_fs', 'sdb1/objects/1')])
+        self.assertEqual(
+            zfs.dataset.datasets['sdb1/objects/1']['mountpoint'], path)
+        zfs.dataset.calls = []
+        self.assertEqual(self.storage.setup_partition('1', 'sdb1'), path)
+        self.storage.setup_partition('2', 'sdb1')
+        self.assertEqual(zfs.dataset.calls,
+                         [('create_fs', 'sdb1/objects/2')])
+
+        zfs.dataset.datasets['sdb1/objects/1']['used'] = '2K'
+        self.assertEqual(self.storage.partition_usage('1', 'sdb1'), 2048)
+        self.assertEqual(self.storage.partition_usage('3', 'sdb1'), None)
+
+        self.storage.destroy_partition('1', 'sdb1')
+        self.assertEqual(self.procs[-1].args,
+                         ['destroy', '-r', 'sdb1/objects/1'])
+        self.assertFalse('1' in self.storage.partition_cache['sdb1'])
+
+    def test_plain_datadir(self):
+        self.storage.devices = self.testdir
+        self.storage.tier_roots = {'datadir': self.testdir,
+                                   'tmp': self.testdir}
+        self.storage.partition_datasets = True
+        os.makedirs(os.path.join(self.testdir, 'sdb1', 'objects'))
+        path = self.storage.setup_partition('1', 'sdb1')
+        self.assertEqual(path, os.path.join(self.testdir, 'sdb1', 'objects',
+                                            '1'))
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(zfs.dataset.calls, [])
+        self.assertEqual(self.storage.plain_datadirs, set(['sdb1']))
+        # device is remounted with a datadir dataset
+        self.storage.invalidate_partition(device='sdb1')
+        self.assertEqual(self.storage.datadirs_ready, set())
+        self.assertEqual(self.storage.plain_datadirs, set())
+        rmtree(os.path.join(self.testdir, 'sdb1', 'objects'))
+        self.storage.setup_partition('2', 'sdb1')
+        self.assertEqual(zfs.dataset.calls,
+                         [('create_fs', 'sdb1/objects'),
+                          ('create_fs', 'sdb1/objects/2')])
+
+    def test_env_hooks(self):
+        hooks = self.storage.get_env_hooks()
+        self.assertEqual(hooks['swift.send_snapshot'],
+                         self.storage.send_snapshot)
+        self.assertFalse('swift.receive_snapshot' in hooks)
+        self.storage.snapshot_receive = True
+        self.assertEqual(
+            self.storage.get_env_hooks()['swift.receive_snapshot'],
+            self.storage.receive_snapshot)
+        self.assertEqual(hooks['swift.storage'], self.storage)
+        # hooks of a request work on its device
+        hooks = self.storage.get_env_hooks('sdb1')
+        hooks['swift.snapshot']('s1')
+        self.assertEqual(self.procs[-1].args, ['snapshot', 'sdb1@s1'])
+        hooks['swift.snapshot']('s1', 'sda1')
+        self.assertEqual(self.procs[-1].args, ['snapshot', 'sda1@s1'])
+
+
+if __name__ == '__main__':
+    unittest.main()